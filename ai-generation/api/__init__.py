@@ -0,0 +1,3 @@
+"""
+FastAPI service and job processing for AI image generation
+"""
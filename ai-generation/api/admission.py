@@ -0,0 +1,152 @@
+"""
+Admission control for generation requests
+Per-key token buckets bound how fast each caller can queue work, and a
+global controller turns away jobs the queue cannot finish in time
+"""
+
+import math
+import os
+import time
+from typing import Dict, Optional
+
+
+class Rejected(Exception):
+    """A request that should be retried after `retry_after` seconds"""
+
+    def __init__(self, detail: str, retry_after: float, reason: str):
+        super().__init__(detail)
+        self.detail = detail
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    """`rate` tokens per second up to `burst`; one token per queued job"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, tokens: float = 1) -> float:
+        """Take `tokens`; returns 0 on success, else the seconds until they are available"""
+        self._refill()
+        if tokens <= self.tokens:
+            self.tokens -= tokens
+            return 0.0
+        if tokens > self.burst:
+            return math.inf
+        return (tokens - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token bucket per API key, measured in jobs: each key may queue
+    `per_minute` jobs a minute on average and `burst` at once.
+    `per_minute=0` disables rate limiting.
+    """
+
+    def __init__(self, per_minute: Optional[float] = None, burst: Optional[int] = None):
+        self.per_minute = per_minute if per_minute is not None else float(os.getenv('RATE_LIMIT_JOBS_PER_MINUTE', 30))
+        self.burst = burst or int(os.getenv('RATE_LIMIT_BURST', 100))
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def check(self, key: str, jobs: int = 1):
+        """Charge `jobs` to `key` or raise Rejected"""
+        if self.per_minute <= 0:
+            return
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.per_minute / 60, self.burst)
+        wait = bucket.take(jobs)
+        if wait == math.inf:
+            raise Rejected(f"Request of {jobs} jobs exceeds the burst limit of {self.burst}", 60, "rate_limit")
+        if wait:
+            raise Rejected(f"Rate limit of {self.per_minute:g} jobs/minute exceeded", wait, "rate_limit")
+
+
+class AdmissionController:
+    """
+    Rejects work that cannot finish in time, counted in images.
+
+    Workers claim by priority, so new images wait behind pending images of
+    the same or higher priority plus whatever is running, and that work
+    drains one image every `duration / capacity` seconds, with `duration`
+    an EWMA of the time per image. An interactive request is refused when
+    its wait plus its own images would overrun `timeout`
+    (GENERATION_TIMEOUT), or, when `max_wait` is set, when the wait alone
+    exceeds it. Bulk batch submissions may wait up to `batch_max_wait`; a
+    batch is never refused for its own size. A `max_wait` or
+    `batch_max_wait` of 0 disables that check.
+    """
+
+    def __init__(
+        self,
+        max_wait: Optional[float] = None,
+        batch_max_wait: Optional[float] = None,
+        default_duration: Optional[float] = None,
+        timeout: Optional[float] = None,
+        smoothing: float = 0.2
+    ):
+        max_wait_env = os.getenv('ADMISSION_MAX_WAIT_SECONDS')
+        self.max_wait = max_wait if max_wait is not None else (float(max_wait_env) if max_wait_env else None)
+        self.batch_max_wait = batch_max_wait if batch_max_wait is not None else float(
+            os.getenv('ADMISSION_BATCH_MAX_WAIT_SECONDS', 3600)
+        )
+        # One SDXL image at the default 30 steps takes 10-30s on Apple Silicon or a mid-range GPU
+        self.duration = default_duration or float(os.getenv('ADMISSION_DEFAULT_JOB_SECONDS', 20))
+        self.timeout = timeout or float(os.getenv('GENERATION_TIMEOUT', 300))
+        self.smoothing = smoothing
+
+    def enabled(self, batch: bool = False) -> bool:
+        if batch:
+            return self.batch_max_wait > 0
+        return self.max_wait is None or self.max_wait > 0
+
+    def budget(self, images: int = 1, batch: bool = False) -> float:
+        """Seconds a request of `images` may wait to start"""
+        if batch:
+            return self.batch_max_wait
+        if self.max_wait is not None:
+            return self.max_wait
+        # A request too large to ever finish in time is still admitted onto an idle queue
+        return max(0.0, self.timeout - self.duration * images)
+
+    def observe(self, seconds: float, images: int = 1):
+        """Feed the duration of a finished job of `images` images into the estimate"""
+        self.duration += self.smoothing * (seconds / max(1, images) - self.duration)
+
+    def wait(self, ahead: int, running: int, capacity: int) -> float:
+        """Seconds until new work could start, behind `ahead` queued and `running` images"""
+        if capacity <= 0:
+            return math.inf
+        return self.duration * max(0, ahead + running - capacity + 1) / capacity
+
+    def estimate(self, ahead: int, running: int, images: int, capacity: int) -> float:
+        """Seconds until the last of `images` new images finishes"""
+        if capacity <= 0:
+            return math.inf
+        return self.wait(ahead, running, capacity) + self.duration * math.ceil(images / capacity)
+
+    def check(self, ahead: int, running: int, images: int, capacity: int, batch: bool = False):
+        """Raise Rejected if `images` new images would wait longer than their budget to start"""
+        if not self.enabled(batch):
+            return
+        if capacity <= 0:
+            raise Rejected("No healthy SD backend available", 30, "no_backend")
+        wait = self.wait(ahead, running, capacity)
+        budget = self.budget(images, batch)
+        if wait <= budget:
+            return
+        raise Rejected(
+            f"Queue is full: {images} image(s) would wait ~{wait:.0f}s to start, over the {budget:.0f}s limit; "
+            f"they would finish in ~{self.estimate(ahead, running, images, capacity):.0f}s",
+            wait - budget,
+            "queue_full"
+        )
@@ -0,0 +1,243 @@
+"""
+Retention and cold archival of finished jobs
+Finished jobs older than JOB_RETENTION_DAYS are moved out of
+generation_jobs into gzip-compressed JSONL files partitioned by completion
+date, with a row per job in archived_jobs so their status can still be read
+"""
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+import socket
+import uuid
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import DateTime, and_, delete, or_, select, update
+
+from api import metrics
+from api.database import ArchivedJob, GenerationJob
+from api.events import TERMINAL_STATUSES
+
+logger = logging.getLogger(__name__)
+
+# Completed, failed and cancelled: every status a job never leaves
+ARCHIVED_STATUSES = TERMINAL_STATUSES
+
+# Not worth keeping once a job is finished, and not safe to write out in the clear
+EXCLUDED_COLUMNS = {"callback_secret"}
+
+
+class JobArchive:
+    """
+    Moves finished jobs older than `retention_days` to files under `root`,
+    every `interval` seconds, `batch_size` jobs per transaction.
+
+    Each sweep appends one gzip member per completion date to
+    `<root>/<yyyy>/<mm>/jobs-<yyyy-mm-dd>.jsonl.gz`; gzip readers treat
+    the concatenated members as one stream. archived_jobs records the
+    byte range of the member holding each job, so a lookup decompresses
+    only that member. Jobs whose webhook is still pending stay until it is
+    delivered or given up. `retention_days=0` disables the sweep.
+
+    Every API process may run the sweep. Like a queue claim, each batch is
+    first stamped with a unique lease in one conditional UPDATE (picked
+    with FOR UPDATE SKIP LOCKED on Postgres), so concurrent sweeps never
+    write the same job. A lease left by a sweep that died expires after
+    `claim_seconds`.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        root: Optional[str] = None,
+        retention_days: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        interval: Optional[float] = None,
+        claim_seconds: Optional[float] = None
+    ):
+        self.session_factory = session_factory
+        self.root = root or os.getenv('ARCHIVE_DIR', './job-archive')
+        self.retention_days = retention_days if retention_days is not None else float(os.getenv('JOB_RETENTION_DAYS', 0))
+        self.batch_size = batch_size or int(os.getenv('ARCHIVE_BATCH_SIZE', 500))
+        self.interval = interval or float(os.getenv('ARCHIVE_INTERVAL_SECONDS', 3600))
+        self.claim_seconds = claim_seconds or float(os.getenv('ARCHIVE_CLAIM_SECONDS', 600))
+        self.worker_id = f"archive:{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.retention_days > 0
+
+    async def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._sweeper(), name="job-archive")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _sweeper(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Job archival failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self, now: Optional[datetime] = None) -> int:
+        """Archive every job past retention; returns how many were moved"""
+        cutoff = (now or datetime.utcnow()) - timedelta(days=self.retention_days)
+        archived = 0
+        while True:
+            moved = await self._archive_batch(cutoff)
+            archived += moved
+            if moved < self.batch_size:
+                break
+        if archived:
+            logger.info(f"Archived {archived} jobs finished before {cutoff.isoformat()}")
+        return archived
+
+    async def _claim_batch(self, db, cutoff: datetime) -> str:
+        """Lease up to `batch_size` archivable jobs to this sweep; returns the lease"""
+        now = datetime.utcnow()
+        lease = f"{self.worker_id}:{uuid.uuid4().hex[:12]}"
+        unclaimed = or_(GenerationJob.lease_owner.is_(None), GenerationJob.lease_expires_at < now)
+        archivable = and_(
+            GenerationJob.status.in_(ARCHIVED_STATUSES),
+            GenerationJob.completed_at < cutoff,
+            or_(GenerationJob.callback_status.is_(None), GenerationJob.callback_status != "pending"),
+            unclaimed
+        )
+        candidates = (
+            select(GenerationJob.id)
+            .where(archivable)
+            .order_by(GenerationJob.completed_at)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        await db.execute(
+            update(GenerationJob)
+            # Re-checked so a row leased by another sweep since it was selected is skipped
+            .where(GenerationJob.id.in_(candidates), unclaimed)
+            .values(lease_owner=lease, lease_expires_at=now + timedelta(seconds=self.claim_seconds))
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        return lease
+
+    async def _archive_batch(self, cutoff: datetime) -> int:
+        async with self.session_factory() as db:
+            lease = await self._claim_batch(db, cutoff)
+            jobs = (await db.execute(
+                select(GenerationJob)
+                .where(GenerationJob.lease_owner == lease)
+                .order_by(GenerationJob.completed_at)
+            )).scalars().all()
+            if not jobs:
+                return 0
+
+            by_day: Dict[date, List[GenerationJob]] = defaultdict(list)
+            for job in jobs:
+                by_day[job.completed_at.date()].append(job)
+
+            # Files first: if the commit fails the jobs stay in the table, and
+            # the members just written are never referenced
+            archived_at = datetime.utcnow()
+            entries = []
+            for day, day_jobs in by_day.items():
+                partition = self.partition(day)
+                lines = [json.dumps(self.record(job), default=str) for job in day_jobs]
+                offset, length = await asyncio.to_thread(self._append, partition, lines)
+                entries.extend(
+                    ArchivedJob(
+                        id=job.id,
+                        partition=partition,
+                        offset=offset,
+                        length=length,
+                        completed_at=job.completed_at,
+                        archived_at=archived_at
+                    )
+                    for job in day_jobs
+                )
+            deleted = (await db.execute(
+                delete(GenerationJob)
+                .where(GenerationJob.lease_owner == lease)
+                .execution_options(synchronize_session=False)
+            )).rowcount
+            if deleted != len(jobs):
+                # The lease expired mid-batch and another sweep took some jobs over
+                await db.rollback()
+                logger.warning(f"Archive lease {lease} lost; leaving its jobs to the sweep that took them")
+                return 0
+            db.add_all(entries)
+            await db.commit()
+        metrics.ARCHIVED.inc(len(jobs))
+        return len(jobs)
+
+    @staticmethod
+    def partition(day: date) -> str:
+        return f"{day:%Y}/{day:%m}/jobs-{day.isoformat()}.jsonl.gz"
+
+    @staticmethod
+    def record(job: GenerationJob) -> Dict[str, Any]:
+        """A job row as JSON; `id` comes first so lookups can match lines without parsing them"""
+        record = {}
+        for column in GenerationJob.__table__.columns:
+            if column.name in EXCLUDED_COLUMNS:
+                continue
+            value = getattr(job, column.name)
+            record[column.name] = value.isoformat() if isinstance(value, datetime) else value
+        return record
+
+    @staticmethod
+    def job_from(record: Dict[str, Any]) -> GenerationJob:
+        """Detached GenerationJob for an archived record; columns added since it was written stay unset"""
+        values = {}
+        for column in GenerationJob.__table__.columns:
+            if column.name not in record:
+                continue
+            value = record[column.name]
+            if isinstance(column.type, DateTime) and value is not None:
+                value = datetime.fromisoformat(value)
+            values[column.name] = value
+        return GenerationJob(**values)
+
+    def _append(self, partition: str, lines: List[str]) -> Tuple[int, int]:
+        path = os.path.join(self.root, partition)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        member = gzip.compress(("\n".join(lines) + "\n").encode(), mtime=0)
+        with open(path, 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(member)
+            f.flush()
+            os.fsync(f.fileno())
+        return offset, len(member)
+
+    def _read(self, entry: ArchivedJob) -> Optional[Dict[str, Any]]:
+        with open(os.path.join(self.root, entry.partition), 'rb') as f:
+            f.seek(entry.offset)
+            member = f.read(entry.length)
+        prefix = '{"id": ' + json.dumps(entry.id) + ','
+        for line in gzip.decompress(member).decode().splitlines():
+            if line.startswith(prefix):
+                return json.loads(line)
+        return None
+
+    async def get(self, job_id: str) -> Optional[GenerationJob]:
+        """An archived job, or None if it was never archived or its file is missing"""
+        async with self.session_factory() as db:
+            entry = await db.get(ArchivedJob, job_id)
+        if entry is None:
+            return None
+        try:
+            record = await asyncio.to_thread(self._read, entry)
+        except OSError as e:
+            logger.error(f"Archive file for job {job_id} is unreadable: {e}")
+            return None
+        return self.job_from(record) if record is not None else None
@@ -0,0 +1,415 @@
+"""
+Load balancer over several Stable Diffusion WebUI backends
+Routes each job to the least-loaded healthy backend, preferring one that
+already has the job's LoRAs loaded, and ejects failing ones
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import httpx
+
+from api.sd_client import SDAPIClient, load_sd_auth
+
+logger = logging.getLogger(__name__)
+
+JobIds = Union[str, Sequence[str], None]
+# Backend, jobs and WebUI task id of a call in flight
+Call = Tuple["SDBackend", Tuple[str, ...], Optional[str]]
+
+LORA_PATTERN = re.compile(r'<lora:([^:>]+)')
+
+
+def prompt_loras(prompt: str) -> Tuple[str, ...]:
+    """LoRA names referenced by a prompt, in order"""
+    return tuple(dict.fromkeys(LORA_PATTERN.findall(prompt or '')))
+
+
+class NoBackendAvailable(RuntimeError):
+    """Raised when no healthy backend frees up within the acquire timeout"""
+
+
+def is_backend_failure(error: Exception) -> bool:
+    """Whether an error says something about the backend rather than the request"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class SDBackend:
+    """One WebUI instance plus its load, circuit-breaker and warm LoRA state"""
+
+    def __init__(
+        self,
+        client: SDAPIClient,
+        max_concurrent: int,
+        failure_threshold: int,
+        cooldown: float,
+        lora_slots: int = 1
+    ):
+        self.client = client
+        self.max_concurrent = max_concurrent
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lora_slots = lora_slots
+
+        self.in_flight = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.total_jobs = 0
+        self.total_failures = 0
+        self.last_used = 0.0
+        # Most recently used LoRAs last; the WebUI keeps these loaded
+        self.warm_loras: "OrderedDict[str, None]" = OrderedDict()
+        self.lora_swaps = 0
+
+    @property
+    def url(self) -> str:
+        return self.client.base_url
+
+    @property
+    def circuit_open(self) -> bool:
+        return time.monotonic() < self.circuit_open_until
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and not self.circuit_open and self.in_flight < self.max_concurrent
+
+    @property
+    def load(self) -> float:
+        return self.in_flight / self.max_concurrent
+
+    def is_warm(self, loras: Sequence[str]) -> bool:
+        return all(lora in self.warm_loras for lora in loras)
+
+    def use_loras(self, loras: Sequence[str]):
+        """Record that a call with these LoRAs was sent here"""
+        for lora in loras:
+            if lora in self.warm_loras:
+                self.warm_loras.move_to_end(lora)
+                continue
+            self.warm_loras[lora] = None
+            self.lora_swaps += 1
+            while len(self.warm_loras) > self.lora_slots:
+                self.warm_loras.popitem(last=False)
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.healthy = True
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self.total_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.circuit_open_until = time.monotonic() + self.cooldown
+            logger.warning(
+                f"Backend {self.url} ejected for {self.cooldown:.0f}s after "
+                f"{self.consecutive_failures} consecutive failures"
+            )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "circuit_open": self.circuit_open,
+            "in_flight": self.in_flight,
+            "max_concurrent": self.max_concurrent,
+            "consecutive_failures": self.consecutive_failures,
+            "total_jobs": self.total_jobs,
+            "total_failures": self.total_failures,
+            "warm_loras": list(self.warm_loras),
+            "lora_swaps": self.lora_swaps
+        }
+
+
+class BackendPool:
+    """
+    Shared pool of SD backends.
+
+    Each backend runs at most `max_concurrent_per_backend` jobs. A background
+    task health-checks every backend through /sdapi/v1/progress; a backend
+    that fails `failure_threshold` times in a row is ejected for `cooldown`
+    seconds and rejoins once a health check succeeds.
+
+    Loading a LoRA costs the WebUI several seconds, so each backend tracks
+    the `lora_slots` LoRAs it used most recently. With `affinity` on, a job
+    goes to a free backend that already has all of its LoRAs warm when
+    there is one, and to the least-loaded free backend otherwise.
+    """
+
+    def __init__(
+        self,
+        urls: Optional[List[str]] = None,
+        auth: Optional[Tuple[str, str]] = None,
+        max_concurrent_per_backend: Optional[int] = None,
+        failure_threshold: Optional[int] = None,
+        cooldown: Optional[float] = None,
+        health_interval: Optional[float] = None,
+        acquire_timeout: Optional[float] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        lora_slots: Optional[int] = None,
+        affinity: Optional[bool] = None
+    ):
+        urls = urls or self.urls_from_env()
+        max_concurrent = max_concurrent_per_backend or int(os.getenv('MAX_CONCURRENT_GENERATIONS', 1))
+        failure_threshold = failure_threshold or int(os.getenv('SD_CIRCUIT_FAILURE_THRESHOLD', 3))
+        cooldown = cooldown or float(os.getenv('SD_CIRCUIT_COOLDOWN', 30))
+        self.health_interval = health_interval or float(os.getenv('SD_HEALTH_INTERVAL', 10))
+        self.acquire_timeout = acquire_timeout or float(os.getenv('SD_ACQUIRE_TIMEOUT', 600))
+        lora_slots = lora_slots or int(os.getenv('SD_LORA_SLOTS', 1))
+        self.affinity = affinity if affinity is not None else os.getenv('SD_LORA_AFFINITY', 'true').lower() == 'true'
+
+        self.backends = [
+            SDBackend(
+                SDAPIClient(url, auth=auth, transport=transport),
+                max_concurrent,
+                failure_threshold,
+                cooldown,
+                lora_slots
+            )
+            for url in dict.fromkeys(urls)
+        ]
+        self.assignments: Dict[str, SDBackend] = {}
+        self._calls: List[Call] = []
+        self._condition: Optional[asyncio.Condition] = None
+        self._health_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def urls_from_env() -> List[str]:
+        """SD_API_URLS (comma separated), falling back to SD_API_URL"""
+        urls = os.getenv('SD_API_URLS') or os.getenv('SD_API_URL', 'http://localhost:7860')
+        return [url.strip() for url in urls.split(',') if url.strip()]
+
+    @classmethod
+    def from_env(cls) -> "BackendPool":
+        return cls(auth=load_sd_auth())
+
+    @property
+    def capacity(self) -> int:
+        """Total number of jobs the pool can run at once"""
+        return sum(backend.max_concurrent for backend in self.backends)
+
+    @property
+    def healthy_capacity(self) -> int:
+        """Jobs the backends accepting work can run at once"""
+        return sum(
+            backend.max_concurrent for backend in self.backends
+            if backend.healthy and not backend.circuit_open
+        )
+
+    async def start(self):
+        """Open client pools and start health checking"""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        for backend in self.backends:
+            await backend.client.start()
+        if self._health_task is None:
+            await self.check_health()
+            self._health_task = asyncio.create_task(self._health_loop(), name="sd-health-check")
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        for backend in self.backends:
+            await backend.client.close()
+
+    async def __aenter__(self) -> "BackendPool":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def check_health(self):
+        """Probe every backend once"""
+        await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+        await self._notify()
+
+    async def _probe(self, backend: SDBackend):
+        try:
+            await backend.client.get_progress()
+        except Exception as e:
+            if backend.healthy:
+                logger.warning(f"Backend {backend.url} failed health check: {e}")
+            backend.healthy = False
+            return
+
+        if not backend.healthy:
+            logger.info(f"Backend {backend.url} is healthy again")
+        backend.healthy = True
+        # A successful probe after the cooldown closes the circuit
+        if backend.circuit_open_until and not backend.circuit_open:
+            backend.record_success()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health()
+
+    async def _notify(self):
+        if self._condition is None:
+            return
+        async with self._condition:
+            self._condition.notify_all()
+
+    def warm_loras(self) -> Set[str]:
+        """LoRAs warm on backends that can take a job right now"""
+        return {lora for backend in self.backends if backend.available for lora in backend.warm_loras}
+
+    def _pick(self, loras: Sequence[str] = ()) -> Optional[SDBackend]:
+        candidates = [backend for backend in self.backends if backend.available]
+        if not candidates:
+            return None
+        if self.affinity and loras:
+            warm = [backend for backend in candidates if backend.is_warm(loras)]
+            candidates = warm or candidates
+        return min(candidates, key=lambda b: (b.load, b.consecutive_failures, b.last_used))
+
+    async def acquire(self, loras: Sequence[str] = ()) -> SDBackend:
+        """Wait for and reserve a slot on the best healthy backend for `loras`"""
+        if self._condition is None:
+            await self.start()
+        deadline = time.monotonic() + self.acquire_timeout
+        async with self._condition:
+            while True:
+                backend = self._pick(loras)
+                if backend is not None:
+                    backend.in_flight += 1
+                    backend.total_jobs += 1
+                    backend.last_used = time.monotonic()
+                    backend.use_loras(loras)
+                    return backend
+                if time.monotonic() >= deadline:
+                    raise NoBackendAvailable(
+                        f"No healthy SD backend available after {self.acquire_timeout:.0f}s"
+                    )
+                # Re-check periodically so ejected backends can rejoin
+                try:
+                    await asyncio.wait_for(self._condition.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, backend: SDBackend, error: Optional[Exception] = None, record: bool = True):
+        """Free a slot; `record` feeds the outcome into the circuit breaker"""
+        backend.in_flight -= 1
+        if record:
+            if error is None:
+                backend.record_success()
+            elif is_backend_failure(error):
+                backend.record_failure()
+        await self._notify()
+
+    @asynccontextmanager
+    async def backend(self, job_id: JobIds = None, loras: Sequence[str] = (), task_id: Optional[str] = None):
+        """
+        Reserve a backend for the duration of the block, for one job or a
+        coalesced batch. `task_id` is the `force_task_id` the call was
+        submitted with, so the WebUI can tell whether it is running it.
+        """
+        job_ids = self.job_ids(job_id)
+        backend = await self.acquire(loras)
+        call = (backend, job_ids, task_id)
+        for assigned in job_ids:
+            self.assignments[assigned] = backend
+        self._calls.append(call)
+        try:
+            yield backend
+        except Exception as e:
+            await self.release(backend, e)
+            raise
+        except BaseException:
+            # Cancelled: says nothing about the backend's health
+            await self.release(backend, record=False)
+            raise
+        else:
+            await self.release(backend)
+        finally:
+            self._calls.remove(call)
+            for assigned in job_ids:
+                self.assignments.pop(assigned, None)
+
+    @staticmethod
+    def job_ids(job_id: JobIds) -> Tuple[str, ...]:
+        return (job_id,) if isinstance(job_id, str) else tuple(job_id or ())
+
+    @staticmethod
+    def task_id(job_ids: Tuple[str, ...]) -> Optional[str]:
+        """A fresh WebUI task id for a job's call; retries of the job get their own"""
+        if not job_ids:
+            return None
+        return f"task({job_ids[0]}-{uuid.uuid4().hex[:8]})"
+
+    def backend_for(self, job_id: str) -> Optional[SDBackend]:
+        """Backend currently running a job, if it runs in this process"""
+        return self.assignments.get(job_id)
+
+    def jobs_on(self, backend: SDBackend) -> List[Tuple[str, ...]]:
+        """Jobs of each call in flight on a backend, oldest call first; the WebUI runs them in that order"""
+        return [job_ids for assigned, job_ids, _ in self._calls if assigned is backend and job_ids]
+
+    async def interrupt(self, job_ids: JobIds) -> bool:
+        """
+        Interrupt the call this process runs for exactly these jobs, if the
+        WebUI is executing it. The WebUI can only interrupt whatever it is
+        running, which may be another process's call on a shared backend,
+        so it is asked about the call's task id first. A call that also
+        serves other jobs is left alone.
+        """
+        job_ids = set(self.job_ids(job_ids))
+        call = next((call for call in self._calls if call[2] and set(call[1]) == job_ids), None)
+        if call is None:
+            return False
+        backend, _, task_id = call
+        if not await backend.client.task_active(task_id):
+            return False
+        await backend.client.interrupt()
+        logger.info(f"Interrupted {task_id} on {backend.url}")
+        return True
+
+    async def txt2img(self, payload: Dict[str, Any], job_id: JobIds = None, stream: bool = False):
+        """Run txt2img on the best backend for the prompt's LoRAs; `stream` returns a Txt2ImgResult"""
+        job_ids = self.job_ids(job_id)
+        task_id = self.task_id(job_ids)
+        payload = {**payload, 'force_task_id': task_id} if task_id else payload
+        async with self.backend(job_ids, prompt_loras(payload.get('prompt', '')), task_id) as backend:
+            if stream:
+                return await backend.client.txt2img_stream(payload)
+            return await backend.client.txt2img(payload)
+
+    async def img2img(self, payload: Dict[str, Any], job_id: JobIds = None) -> Dict[str, Any]:
+        """Run img2img on the best backend for the prompt's LoRAs"""
+        job_ids = self.job_ids(job_id)
+        task_id = self.task_id(job_ids)
+        payload = {**payload, 'force_task_id': task_id} if task_id else payload
+        async with self.backend(job_ids, prompt_loras(payload.get('prompt', '')), task_id) as backend:
+            return await backend.client.img2img(payload)
+
+    async def extra_single_image(self, payload: Dict[str, Any], job_id: JobIds = None) -> Dict[str, Any]:
+        """Upscale one image on the least-loaded backend; the WebUI gives extras calls no task id, so they run to the end"""
+        async with self.backend(job_id) as backend:
+            return await backend.client.extra_single_image(payload)
+
+    async def generate_image(
+        self,
+        prompt: str,
+        negative_prompt: str,
+        job_id: JobIds = None,
+        stream: bool = False,
+        **kwargs
+    ):
+        payload = SDAPIClient.default_payload(prompt, negative_prompt, **kwargs)
+        return await self.txt2img(payload, job_id=job_id, stream=stream)
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [backend.to_dict() for backend in self.backends]
@@ -0,0 +1,193 @@
+"""
+Database models and async session setup for the generation API
+"""
+
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import event, inspect, text, Column, String, DateTime, JSON, Integer, BigInteger, Float, Index
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+
+logger = logging.getLogger(__name__)
+
+# Synchronous URLs in settings.env are mapped onto their asyncio drivers
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'postgresql+psycopg': 'postgresql+asyncpg',
+    'postgresql+pg8000': 'postgresql+asyncpg',
+}
+SUPPORTED_ASYNC_DRIVERS = set(ASYNC_DRIVERS.values())
+
+def async_database_url(url: str) -> str:
+    scheme, sep, rest = url.partition('://')
+    driver = ASYNC_DRIVERS.get(scheme, scheme)
+    if driver not in SUPPORTED_ASYNC_DRIVERS:
+        raise ValueError(
+            f"Unsupported DATABASE_URL driver {scheme!r}; use sqlite:// or postgresql:// "
+            f"(served by {', '.join(sorted(SUPPORTED_ASYNC_DRIVERS))})"
+        )
+    return f"{driver}{sep}{rest}"
+
+def engine_options(url: str) -> dict:
+    """Pool sizing for server databases; SQLite gets a short busy wait instead"""
+    if url.startswith('sqlite'):
+        return {'connect_args': {'timeout': float(os.getenv('SQLITE_BUSY_TIMEOUT', 5))}}
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+DATABASE_URL = async_database_url(os.getenv('DATABASE_URL', 'sqlite:///./ai_generation.db'))
+
+Base = declarative_base()
+engine = create_async_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+if engine.dialect.name == 'sqlite':
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets status reads proceed while a worker commits
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(float(os.getenv('SQLITE_BUSY_TIMEOUT', 5)) * 1000)}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-20000")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+
+# Database Models
+class GenerationJob(Base):
+    __tablename__ = "generation_jobs"
+
+    id = Column(String, primary_key=True)
+    character_id = Column(String)
+    status = Column(String)  # pending, processing, completed, failed, cancelled
+    prompt = Column(String)
+    tags = Column(JSON)
+    result = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime)
+    error_message = Column(String)
+
+    # Queue state
+    request = Column(JSON)  # GenerateImageRequest the job was submitted with
+    priority = Column(Integer, default=0)
+    attempts = Column(Integer, default=0)
+    lease_owner = Column(String)  # unique per claim; only the holder may finish the job
+    lease_expires_at = Column(DateTime)
+    started_at = Column(DateTime)
+    coalesce_key = Column(String)  # jobs sharing a key may be merged into one txt2img call
+    idempotency_key = Column(String)  # <client key fingerprint>:<Idempotency-Key> the job was submitted with
+    timings = Column(JSON)  # seconds per stage of the attempt that completed the job
+    stage = Column(String, default="base")  # base (txt2img), then upscale for hires jobs
+    stage_data = Column(JSON)  # inputs pinned for the current stage, e.g. base pass output for the upscale stage
+
+    # Draft-then-refine generation
+    mode = Column(String, default="full")  # full, or draft (few steps, no hires)
+    refined_from = Column(String)  # draft job whose seed this job re-runs at full quality
+    gpu_seconds = Column(Float)  # SD time spent on the job's images
+    gpu_seconds_saved = Column(Float)  # against full quality; a refine counts its own cost as negative
+
+    # Completion webhook
+    callback_url = Column(String)
+    callback_secret = Column(String)  # HMAC-SHA256 key for the X-Webhook-Signature header
+    callback_status = Column(String)  # pending, delivered, failed; NULL without a callback
+    callback_attempts = Column(Integer, default=0)
+    callback_error = Column(String)
+    callback_next_at = Column(DateTime)  # next attempt is due, or the current one's lease ends
+    callback_delivered_at = Column(DateTime)
+
+    __table_args__ = (
+        # Job listings: filter by character/status, newest first, keyset on (created_at, id)
+        Index('ix_generation_jobs_character_status_created', 'character_id', 'status', 'created_at', 'id'),
+        Index('ix_generation_jobs_status_created', 'status', 'created_at', 'id'),
+        # Retention sweep
+        Index('ix_generation_jobs_status_completed', 'status', 'completed_at'),
+        Index('ix_generation_jobs_created', 'created_at', 'id'),
+        # Queue claims and queue positions
+        Index('ix_generation_jobs_queue', 'status', 'priority', 'created_at'),
+        Index('ix_generation_jobs_stage_queue', 'status', 'stage', 'priority', 'created_at'),
+        Index('ix_generation_jobs_coalesce', 'status', 'coalesce_key', 'priority', 'created_at'),
+        Index('ix_generation_jobs_idempotency_key', 'idempotency_key', unique=True),
+        Index('ix_generation_jobs_refined_from', 'refined_from'),
+        # Webhook redelivery sweep
+        Index('ix_generation_jobs_callback', 'callback_status', 'callback_next_at'),
+    )
+
+class GenerationCacheEntry(Base):
+    """Stored result of a fully resolved, fixed-seed txt2img payload"""
+    __tablename__ = "generation_cache"
+
+    key = Column(String, primary_key=True)  # sha256 of the resolved payload
+    result = Column(JSON)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Least recently used entries are evicted first
+        Index('ix_generation_cache_last_used', 'last_used_at'),
+    )
+
+class ArchivedJob(Base):
+    """Where a job moved out of generation_jobs by the retention sweep is archived"""
+    __tablename__ = "archived_jobs"
+
+    id = Column(String, primary_key=True)  # the job's id
+    partition = Column(String)  # archive file, relative to ARCHIVE_DIR
+    offset = Column(BigInteger)  # byte offset of the gzip member holding the job
+    length = Column(Integer)  # compressed length of that member
+    completed_at = Column(DateTime)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+class Character(Base):
+    __tablename__ = "characters"
+
+    id = Column(String, primary_key=True)
+    name = Column(String)
+    character_metadata = Column(JSON)
+    lora_path = Column(String)
+    training_status = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+def _ensure_schema(conn):
+    Base.metadata.create_all(bind=conn)
+
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}'
+            if column.default is not None and column.default.is_scalar:
+                ddl += f' DEFAULT {column.default.arg!r}'
+            logger.info(f"Adding column {table.name}.{column.name}")
+            conn.execute(text(ddl))
+
+        # create_all only builds indexes together with new tables
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                logger.info(f"Creating index {index.name}")
+                index.create(conn)
+
+async def ensure_schema(bind=engine):
+    """Create missing tables and add columns introduced since the table was created"""
+    async with bind.begin() as conn:
+        await conn.run_sync(_ensure_schema)
+
+# Database dependency
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
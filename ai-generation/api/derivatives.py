@@ -0,0 +1,155 @@
+"""
+Image derivatives for generated PNGs
+Encodes a compressed WebP (or AVIF) master and a set of thumbnails in a
+process pool, so Pillow's CPU work never runs on the event loop or competes
+for the GIL with request handling
+"""
+
+import asyncio
+import io
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {'webp': 'image/webp', 'avif': 'image/avif'}
+
+
+@dataclass
+class Derivative:
+    """One encoded variant of an image; `size` is the thumbnail's longest side, None for the master"""
+    name: str
+    data: bytes
+    format: str
+    width: int
+    height: int
+    size: Optional[int] = None
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES[self.format]
+
+
+@dataclass
+class DerivativeSet:
+    derivatives: List[Derivative]
+    source_bytes: int
+    cpu_seconds: float
+
+
+def avif_supported() -> bool:
+    """AVIF needs Pillow >= 11.3 or the pillow-avif-plugin package"""
+    try:
+        import pillow_avif  # noqa: F401  registers AVIF with older Pillow
+    except ImportError:
+        pass
+    from PIL import Image
+    Image.init()
+    return 'AVIF' in Image.SAVE
+
+
+def _encode(image, image_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    options = {'quality': quality}
+    if image_format == 'webp':
+        options['method'] = 4  # Pillow's default is 4 of 0-6; higher is slower for little gain
+    image.save(buffer, format=image_format.upper(), **options)
+    return buffer.getvalue()
+
+
+def render_derivatives(
+    data: bytes,
+    master_format: str,
+    master_quality: int,
+    thumbnail_sizes: Sequence[int],
+    thumbnail_quality: int
+) -> DerivativeSet:
+    """Decode a PNG and encode its master and thumbnails; runs in a worker process"""
+    from PIL import Image
+
+    started = time.process_time()
+    with Image.open(io.BytesIO(data)) as source:
+        image = source.convert('RGBA' if 'A' in source.getbands() else 'RGB')
+
+    derivatives = [Derivative(
+        name='master',
+        data=_encode(image, master_format, master_quality),
+        format=master_format,
+        width=image.width,
+        height=image.height
+    )]
+    for size in sorted(thumbnail_sizes, reverse=True):
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        derivatives.append(Derivative(
+            name=f'thumb_{size}',
+            data=_encode(thumbnail, master_format, thumbnail_quality),
+            format=master_format,
+            width=thumbnail.width,
+            height=thumbnail.height,
+            size=size
+        ))
+    return DerivativeSet(derivatives, len(data), time.process_time() - started)
+
+
+class ImageProcessor:
+    """
+    Builds derivatives of generated images in a pool of `max_workers`
+    processes. IMAGE_FORMAT selects webp or avif for the master and
+    thumbnails; avif falls back to webp when Pillow cannot write it.
+    """
+
+    def __init__(
+        self,
+        image_format: Optional[str] = None,
+        quality: Optional[int] = None,
+        thumbnail_sizes: Optional[Sequence[int]] = None,
+        thumbnail_quality: Optional[int] = None,
+        max_workers: Optional[int] = None,
+        enabled: Optional[bool] = None
+    ):
+        self.enabled = enabled if enabled is not None else os.getenv('IMAGE_DERIVATIVES', 'true').lower() == 'true'
+        self.image_format = (image_format or os.getenv('IMAGE_FORMAT', 'webp')).lower()
+        self.quality = quality or int(os.getenv('IMAGE_QUALITY', 82))
+        sizes = thumbnail_sizes if thumbnail_sizes is not None else os.getenv('IMAGE_THUMBNAIL_SIZES', '512,256')
+        if isinstance(sizes, str):
+            sizes = [int(size) for size in sizes.split(',') if size.strip()]
+        self.thumbnail_sizes = list(sizes)
+        self.thumbnail_quality = thumbnail_quality or int(os.getenv('IMAGE_THUMBNAIL_QUALITY', 75))
+        self.max_workers = max_workers or int(os.getenv('IMAGE_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+        if self.image_format not in CONTENT_TYPES:
+            raise ValueError(f"Unsupported IMAGE_FORMAT {self.image_format!r}; use webp or avif")
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            if self.image_format == 'avif' and not avif_supported():
+                logger.warning("Pillow cannot write AVIF; encoding derivatives as WebP")
+                self.image_format = 'webp'
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    async def close(self):
+        """Stop the worker processes (called on app shutdown)"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def process(self, data: bytes) -> DerivativeSet:
+        """Encode the master and thumbnails of one PNG"""
+        executor = self.executor
+        return await asyncio.get_running_loop().run_in_executor(
+            executor,
+            render_derivatives,
+            data,
+            self.image_format,
+            self.quality,
+            self.thumbnail_sizes,
+            self.thumbnail_quality
+        )
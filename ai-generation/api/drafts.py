@@ -0,0 +1,56 @@
+"""
+Draft-then-refine generation
+Drafts are cheap low-step previews with recorded seeds; the seeds an admin
+picks are re-run at full quality, so GPU time is only spent in full on
+images that are kept
+"""
+
+import os
+from typing import Any, Dict, Optional
+
+from api.pipeline import HiresPass
+
+
+class DraftMode:
+    """
+    Draft settings and the GPU accounting against full quality.
+
+    A draft samples `steps` steps at `scale` times the full resolution
+    and never runs the hires stage. With a deterministic sampler such as
+    DPM++ 2M Karras a seed keeps its composition as steps are added, so
+    a refine reproduces the draft in detail; drafting below full
+    resolution (`scale` < 1) is cheaper still but changes the composition.
+    """
+
+    def __init__(self, steps: Optional[int] = None, scale: Optional[float] = None):
+        self.steps = steps or int(os.getenv('DRAFT_STEPS', 12))
+        self.scale = scale or float(os.getenv('DRAFT_SCALE', 1.0))
+
+    def payload(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Draft version of a full-quality txt2img payload"""
+        return {
+            **payload,
+            "steps": min(self.steps, payload["steps"]),
+            # The WebUI needs sizes in multiples of 8
+            "width": max(64, int(payload["width"] * self.scale) // 8 * 8),
+            "height": max(64, int(payload["height"] * self.scale) // 8 * 8),
+        }
+
+    @staticmethod
+    def full_quality_seconds(
+        seconds: float,
+        payload: Dict[str, Any],
+        full_payload: Dict[str, Any],
+        hires: Optional[HiresPass] = None
+    ) -> float:
+        """
+        Estimated GPU seconds for `full_payload`, given that `payload` took
+        `seconds`: sampling cost scales with steps times pixels. An img2img
+        hires pass is counted the same way; an extras upscale is not.
+        """
+        work = payload["steps"] * payload["width"] * payload["height"]
+        full_pixels = full_payload["width"] * full_payload["height"]
+        full_work = full_payload["steps"] * full_pixels
+        if hires is not None and hires.mode == 'img2img':
+            full_work += hires.steps * hires.denoise * full_pixels * hires.scale ** 2
+        return seconds * full_work / work if work else seconds
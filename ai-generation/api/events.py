@@ -0,0 +1,52 @@
+"""
+In-process publish/subscribe for job events
+Feeds the job event streams with status transitions and progress updates
+"""
+
+import asyncio
+import os
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Set
+
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+
+class JobEventBus:
+    """
+    Fan-out of events to subscribers of a job.
+
+    Each subscriber gets a bounded queue; when a slow subscriber falls
+    behind, its oldest event is dropped so publishers never block.
+    Events only reach subscribers in the same process, so streams also
+    re-check the database for jobs run by other workers.
+    """
+
+    def __init__(self, max_queued: Optional[int] = None):
+        self.max_queued = max_queued or int(os.getenv('JOB_EVENT_QUEUE_SIZE', 100))
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    @contextmanager
+    def subscribe(self, job_id: str) -> Iterator[asyncio.Queue]:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queued)
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers = self._subscribers.get(job_id)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self._subscribers[job_id]
+
+    def has_subscribers(self, job_id: str) -> bool:
+        return bool(self._subscribers.get(job_id))
+
+    def publish(self, job_id: str, event: Dict[str, Any]):
+        event = {"job_id": job_id, **event}
+        for queue in self._subscribers.get(job_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def publish_status(self, job_id: str, status: str, **fields):
+        self.publish(job_id, {"type": "status", "status": status, **fields})
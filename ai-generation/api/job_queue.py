@@ -0,0 +1,359 @@
+"""
+Durable job queue backed by the generation_jobs table
+Workers claim jobs with an expiring lease so several processes or hosts can
+share one database without double-processing, and crashed work is reclaimed
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Collection, Dict, Optional, Tuple
+
+from sqlalchemy import and_, func, or_, select, update
+
+from api.database import GenerationJob
+
+logger = logging.getLogger(__name__)
+
+CROCKFORD_BASE32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_id_lock = threading.Lock()
+_last_id = (0, 0)
+
+
+def new_job_id(suffix: Optional[str] = None) -> str:
+    """
+    Collision-free job id that sorts by creation time: `job_<ULID>[_suffix]`.
+
+    The ULID is a 48-bit millisecond timestamp followed by 80 random bits;
+    ids made in the same millisecond increment the random part, so ids from
+    one process are strictly increasing.
+    """
+    global _last_id
+    with _id_lock:
+        millis = time.time_ns() // 1_000_000
+        last_millis, last_random = _last_id
+        if millis <= last_millis:
+            millis, random_bits = last_millis, last_random + 1
+        else:
+            random_bits = int.from_bytes(os.urandom(10), 'big')
+        _last_id = (millis, random_bits)
+    value = millis << 80 | random_bits & ((1 << 80) - 1)
+    ulid = ''.join(CROCKFORD_BASE32[(value >> shift) & 31] for shift in range(125, -1, -5))
+    return f"job_{ulid}_{suffix}" if suffix else f"job_{ulid}"
+
+
+@dataclass
+class ClaimedJob:
+    """A job leased to this process"""
+    id: str
+    request: Optional[Dict[str, Any]]
+    attempts: int
+    lease: str
+    coalesce_key: Optional[str] = None
+    callback_url: Optional[str] = None
+    stage: str = "base"
+    stage_data: Optional[Dict[str, Any]] = None
+    created_at: Optional[datetime] = None
+    claimed_at: datetime = field(default_factory=datetime.utcnow)
+
+    @property
+    def queue_wait(self) -> Optional[float]:
+        """Seconds between submission and this claim"""
+        if self.created_at is None:
+            return None
+        return max(0.0, (self.claimed_at - self.created_at).total_seconds())
+
+
+class JobQueue:
+    """
+    Queue operations on GenerationJob rows.
+
+    A claim flips one `pending` row to `processing` in a single UPDATE and
+    stamps it with a unique lease. On Postgres the candidate row is picked
+    with FOR UPDATE SKIP LOCKED; SQLite serialises writers, so the
+    conditional UPDATE plus the lease column is enough. Every finishing
+    write is guarded by the lease, so a worker whose lease expired and was
+    reclaimed can no longer overwrite the job.
+
+    Each queue serves one pipeline `stage`: a job's base pass is claimed
+    from the "base" queue and, for hires jobs, its upscale pass from the
+    "upscale" queue once `advance` hands it over. `stage=None` spans all
+    stages.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        worker_id: Optional[str] = None,
+        lease_seconds: Optional[float] = None,
+        stage: Optional[str] = "base"
+    ):
+        self.session_factory = session_factory
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds or float(os.getenv('JOB_LEASE_SECONDS', 60))
+        self.stage = stage
+
+    def _pending(self):
+        """Filter for the pending jobs of this queue's stage"""
+        if self.stage is None:
+            return GenerationJob.status == "pending"
+        return and_(GenerationJob.status == "pending", GenerationJob.stage == self.stage)
+
+    def _lease_expiry(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    async def claim(
+        self,
+        coalesce_key: Optional[str] = None,
+        prefer: Optional[Collection[str]] = None,
+        window: int = 0,
+        max_delay: float = 0
+    ) -> Optional[ClaimedJob]:
+        """
+        Lease the next pending job, highest priority then oldest first;
+        with `coalesce_key`, only jobs that can share a batch with it.
+
+        With `prefer` (character ids) and a `window` above 1, the oldest
+        job for a preferred character among the next `window` jobs of the
+        top priority is claimed instead of the head of the queue, unless
+        the head has already waited `max_delay` seconds.
+        """
+        lease = f"{self.worker_id}:{uuid.uuid4().hex[:12]}"
+        candidate = select(GenerationJob.id).where(self._pending())
+        if coalesce_key is not None:
+            candidate = candidate.where(GenerationJob.coalesce_key == coalesce_key)
+        candidate = (
+            candidate
+            .order_by(GenerationJob.priority.desc(), GenerationJob.created_at, GenerationJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        async with self.session_factory() as db:
+            targets = [candidate]
+            if prefer and window > 1 and coalesce_key is None:
+                preferred = await self._preferred(db, prefer, window, max_delay)
+                if preferred is not None:
+                    # Fall back to the head if another worker took it first
+                    targets.insert(0, preferred)
+            for target in targets:
+                claimed = (await db.execute(
+                    update(GenerationJob)
+                    .where(GenerationJob.id == target, GenerationJob.status == "pending")
+                    .values(
+                        status="processing",
+                        lease_owner=lease,
+                        lease_expires_at=self._lease_expiry(),
+                        attempts=func.coalesce(GenerationJob.attempts, 0) + 1,
+                        started_at=func.coalesce(GenerationJob.started_at, datetime.utcnow())
+                    )
+                    .execution_options(synchronize_session=False)
+                )).rowcount
+                await db.commit()
+                if claimed:
+                    break
+            else:
+                return None
+
+            row = (await db.execute(
+                select(
+                    GenerationJob.id, GenerationJob.request, GenerationJob.attempts,
+                    GenerationJob.coalesce_key, GenerationJob.created_at, GenerationJob.callback_url,
+                    GenerationJob.stage, GenerationJob.stage_data
+                )
+                .where(GenerationJob.lease_owner == lease)
+            )).first()
+        return ClaimedJob(
+            id=row.id,
+            request=row.request,
+            attempts=row.attempts,
+            lease=lease,
+            coalesce_key=row.coalesce_key,
+            callback_url=row.callback_url,
+            stage=row.stage or "base",
+            stage_data=row.stage_data,
+            created_at=row.created_at
+        )
+
+    async def _preferred(self, db, prefer: Collection[str], window: int, max_delay: float) -> Optional[str]:
+        """Id of the job to claim ahead of the queue head, if any"""
+        rows = (await db.execute(
+            select(GenerationJob.id, GenerationJob.character_id, GenerationJob.priority, GenerationJob.created_at)
+            .where(self._pending())
+            .order_by(GenerationJob.priority.desc(), GenerationJob.created_at, GenerationJob.id)
+            .limit(window)
+        )).all()
+        if not rows or rows[0].character_id in prefer:
+            return None
+        head = rows[0]
+        if max_delay and head.created_at <= datetime.utcnow() - timedelta(seconds=max_delay):
+            return None
+        for row in rows[1:]:
+            if row.priority == head.priority and row.character_id in prefer:
+                return row.id
+        return None
+
+    async def _update_leased(self, claim: ClaimedJob, **values) -> bool:
+        async with self.session_factory() as db:
+            updated = (await db.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id == claim.id, GenerationJob.lease_owner == claim.lease)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )).rowcount
+            await db.commit()
+        return bool(updated)
+
+    async def renew(self, claim: ClaimedJob) -> bool:
+        """Extend the lease; False means it was lost to another worker"""
+        return await self._update_leased(claim, lease_expires_at=self._lease_expiry())
+
+    async def complete(self, claim: ClaimedJob, **values) -> bool:
+        """Mark a leased job completed along with its result columns"""
+        return await self._update_leased(
+            claim,
+            status="completed",
+            completed_at=datetime.utcnow(),
+            lease_owner=None,
+            lease_expires_at=None,
+            **values
+        )
+
+    async def fail(self, claim: ClaimedJob, error: Exception) -> bool:
+        return await self._update_leased(
+            claim,
+            status="failed",
+            error_message=str(error),
+            completed_at=datetime.utcnow(),
+            lease_owner=None,
+            lease_expires_at=None
+        )
+
+    async def cancel(self, job_id: str) -> Optional[str]:
+        """
+        Cancel a pending or processing job; returns the status it had, or
+        None if it had already finished. Clearing the lease makes a worker
+        still running the job unable to complete it.
+        """
+        async with self.session_factory() as db:
+            status = (await db.execute(
+                select(GenerationJob.status).where(GenerationJob.id == job_id)
+            )).scalar_one_or_none()
+            if status not in ("pending", "processing"):
+                return None
+            cancelled = (await db.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id == job_id, GenerationJob.status == status)
+                .values(
+                    status="cancelled",
+                    error_message="Cancelled",
+                    completed_at=datetime.utcnow(),
+                    lease_owner=None,
+                    lease_expires_at=None
+                )
+                .execution_options(synchronize_session=False)
+            )).rowcount
+            await db.commit()
+        if not cancelled:
+            # Claimed or finished in the meantime
+            return await self.cancel(job_id)
+        return status
+
+    async def advance(self, claim: ClaimedJob, stage: str, **values) -> bool:
+        """Hand a leased job to the next stage's queue; that stage gets its own attempts"""
+        return await self._update_leased(
+            claim,
+            status="pending",
+            stage=stage,
+            attempts=0,
+            lease_owner=None,
+            lease_expires_at=None,
+            **values
+        )
+
+    async def release(self, claim: ClaimedJob) -> bool:
+        """Hand a leased job back to the queue (e.g. on shutdown)"""
+        return await self._update_leased(claim, status="pending", lease_owner=None, lease_expires_at=None)
+
+    async def reclaim_expired(self, max_attempts: int) -> int:
+        """
+        Requeue processing jobs whose lease ran out (their worker died).
+        Jobs that already used `max_attempts` claims are failed instead, so a
+        job that crashes its worker cannot loop forever.
+        """
+        now = datetime.utcnow()
+        expired = and_(
+            GenerationJob.status == "processing",
+            or_(GenerationJob.lease_expires_at.is_(None), GenerationJob.lease_expires_at < now)
+        )
+        async with self.session_factory() as db:
+            failed = (await db.execute(
+                update(GenerationJob)
+                .where(expired, func.coalesce(GenerationJob.attempts, 0) >= max_attempts)
+                .values(
+                    status="failed",
+                    error_message=f"Worker lost after {max_attempts} attempts",
+                    completed_at=now,
+                    lease_owner=None,
+                    lease_expires_at=None
+                )
+                .execution_options(synchronize_session=False)
+            )).rowcount
+            requeued = (await db.execute(
+                update(GenerationJob)
+                .where(expired)
+                .values(status="pending", lease_owner=None, lease_expires_at=None)
+                .execution_options(synchronize_session=False)
+            )).rowcount
+            await db.commit()
+
+        if failed or requeued:
+            logger.warning(f"Reclaimed {requeued} expired job(s), failed {failed} exhausted job(s)")
+        return requeued
+
+    async def depth(self) -> int:
+        """Number of pending jobs of this stage across all workers"""
+        async with self.session_factory() as db:
+            return await db.scalar(select(func.count()).where(self._pending()))
+
+    async def backlog(self, min_priority: int = 0) -> Tuple[int, int]:
+        """Images of pending jobs at `min_priority` or above, and of jobs processing, across all workers and stages"""
+        images = func.coalesce(func.sum(func.coalesce(GenerationJob.request['batch_size'].as_integer(), 1)), 0)
+        async with self.session_factory() as db:
+            pending = await db.scalar(select(images).where(
+                GenerationJob.status == "pending",
+                GenerationJob.priority >= min_priority
+            ))
+            processing = await db.scalar(select(images).where(GenerationJob.status == "processing"))
+        return pending, processing
+
+    async def position(self, job_id: str) -> Optional[int]:
+        """1-based position of a pending job in this stage's queue, or None if it is not queued there"""
+        async with self.session_factory() as db:
+            job = (await db.execute(
+                select(GenerationJob.priority, GenerationJob.created_at)
+                .where(GenerationJob.id == job_id, self._pending())
+            )).first()
+            if job is None:
+                return None
+            ahead = await db.scalar(
+                select(func.count()).where(
+                    self._pending(),
+                    or_(
+                        GenerationJob.priority > job.priority,
+                        and_(
+                            GenerationJob.priority == job.priority,
+                            or_(
+                                GenerationJob.created_at < job.created_at,
+                                and_(GenerationJob.created_at == job.created_at, GenerationJob.id < job_id)
+                            )
+                        )
+                    )
+                )
+            )
+        return ahead + 1
@@ -0,0 +1,89 @@
+"""
+Prometheus metrics for the generation API
+Stage latency histograms, queue and backend gauges, and failure counters,
+served in the text exposition format from /metrics
+"""
+
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+import httpx
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from api.backend_pool import NoBackendAvailable
+from api.scheduler import LeaseLost
+from api.storage import UploadError
+
+# Job stages; queue_wait is measured once per job, derivatives once per image,
+# upscale once per hires job, the others once per txt2img call
+STAGES = ("queue_wait", "prompt_build", "sd_call", "decode", "upscale", "derivatives", "upload", "db_commit")
+
+STAGE_SECONDS = Histogram(
+    'generation_stage_seconds',
+    'Time spent in each stage of a generation job',
+    ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+QUEUE_DEPTH = Gauge('generation_queue_depth', 'Jobs waiting for a worker')
+JOBS_IN_FLIGHT = Gauge('generation_jobs_in_flight', 'Jobs running in this process')
+BACKEND_IN_FLIGHT = Gauge('generation_backend_in_flight', 'txt2img calls in flight per SD backend', ['backend'])
+BACKEND_HEALTHY = Gauge('generation_backend_healthy', 'Whether an SD backend is accepting jobs', ['backend'])
+FAILURES = Counter('generation_failures_total', 'Generation jobs that failed, by cause', ['cause'])
+REJECTED = Counter('generation_rejected_total', 'Generation requests refused with 429, by reason', ['reason'])
+ARCHIVED = Counter('generation_jobs_archived_total', 'Finished jobs moved from the jobs table to the archive')
+
+# Export every stage from the first scrape on, not only after its first observation
+for _stage in STAGES:
+    STAGE_SECONDS.labels(stage=_stage)
+
+
+def observe(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage=stage).observe(seconds)
+
+
+@contextmanager
+def timed(timings: Dict[str, float], stage: str) -> Iterator[None]:
+    """Record the duration of the block in `timings` and the stage histogram"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        timings[stage] = round(elapsed, 4)
+        observe(stage, elapsed)
+
+
+def failure_cause(error: BaseException) -> str:
+    """Coarse, low-cardinality label for why a job failed"""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return "timeout"
+    if isinstance(error, LeaseLost):
+        return "lease_lost"
+    if isinstance(error, NoBackendAvailable):
+        return "no_backend"
+    if isinstance(error, httpx.HTTPStatusError):
+        return "sd_http_error"
+    if isinstance(error, httpx.TransportError):
+        return "sd_unreachable"
+    if isinstance(error, UploadError):
+        return "upload"
+    if isinstance(error, ValueError):
+        return "invalid_request"
+    return "other"
+
+
+def record_failure(error: BaseException):
+    FAILURES.labels(cause=failure_cause(error)).inc()
+
+
+def render(queue_depth: int, in_flight: int, backends: List[Dict]) -> bytes:
+    """Refresh the point-in-time gauges and render every metric"""
+    QUEUE_DEPTH.set(queue_depth)
+    JOBS_IN_FLIGHT.set(in_flight)
+    for backend in backends:
+        BACKEND_IN_FLIGHT.labels(backend=backend['url']).set(backend['in_flight'])
+        BACKEND_HEALTHY.labels(backend=backend['url']).set(1 if backend['healthy'] and not backend['circuit_open'] else 0)
+    return generate_latest()
+
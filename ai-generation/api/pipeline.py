@@ -0,0 +1,125 @@
+"""
+Two-stage generation pipeline
+Hires jobs run a base txt2img pass, then an upscale pass on a separate queue
+and worker pool, so base passes for new jobs overlap with upscales of
+finished ones instead of one txt2img call holding the GPU for both
+"""
+
+import asyncio
+import base64
+import os
+import shutil
+import tempfile
+from typing import Any, BinaryIO, Dict, List, Optional
+
+UPSCALE_MODES = ('img2img', 'extras')
+
+
+class HiresPass:
+    """
+    Settings and payloads for the upscale stage.
+
+    In `img2img` mode the base image is resized `scale` times with
+    `upscaler` and re-sampled for `steps` steps at `denoise` strength with
+    the job's prompt and seed, like the WebUI's own hires fix. In `extras`
+    mode it is only upscaled, which is much cheaper but adds no detail.
+    """
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        mode: Optional[str] = None,
+        upscaler: Optional[str] = None,
+        scale: Optional[float] = None,
+        steps: Optional[int] = None,
+        denoise: Optional[float] = None
+    ):
+        self.enabled = enabled if enabled is not None else os.getenv('HIRES_ENABLED', 'false').lower() == 'true'
+        self.mode = mode or os.getenv('HIRES_MODE', 'img2img')
+        if self.mode not in UPSCALE_MODES:
+            raise ValueError(f"HIRES_MODE must be one of {', '.join(UPSCALE_MODES)}, not {self.mode!r}")
+        self.upscaler = upscaler or os.getenv('HIRES_UPSCALER', '4x-UltraSharp')
+        self.scale = scale or float(os.getenv('HIRES_SCALE', 1.5))
+        self.steps = steps or int(os.getenv('HIRES_STEPS', 20))
+        self.denoise = denoise if denoise is not None else float(os.getenv('HIRES_DENOISE', 0.25))
+
+    def settings(self) -> Dict[str, Any]:
+        """Everything that changes the upscaled pixels; part of the cache key and the job result"""
+        settings = {'mode': self.mode, 'upscaler': self.upscaler, 'scale': self.scale}
+        if self.mode == 'img2img':
+            settings.update(steps=self.steps, denoise=self.denoise)
+        return settings
+
+    def payload(self, image: bytes, base: Dict[str, Any], seed: Optional[int]) -> Dict[str, Any]:
+        """Upscale request for one base image; `base` is the txt2img payload that made it"""
+        encoded = base64.b64encode(image).decode()
+        if self.mode == 'extras':
+            return {
+                "image": encoded,
+                "resize_mode": 0,
+                "upscaling_resize": self.scale,
+                "upscaler_1": self.upscaler,
+            }
+        return {
+            "init_images": [encoded],
+            "prompt": base.get("prompt", ""),
+            "negative_prompt": base.get("negative_prompt", ""),
+            "sampler_name": base.get("sampler_name"),
+            "cfg_scale": base.get("cfg_scale"),
+            "steps": self.steps,
+            "denoising_strength": self.denoise,
+            "width": int(base.get("width", 1024) * self.scale),
+            "height": int(base.get("height", 1024) * self.scale),
+            "resize_mode": 0,
+            "seed": seed if seed is not None else -1,
+            "batch_size": 1,
+            "override_settings": {"upscaler_for_img2img": self.upscaler},
+            "override_settings_restore_afterwards": True,
+        }
+
+    def image_from(self, response: Dict[str, Any]) -> bytes:
+        """Decoded upscaled image from an img2img or extras response"""
+        encoded = response["image"] if self.mode == 'extras' else response["images"][0]
+        return base64.b64decode(encoded.split(",", 1)[-1])
+
+
+class StagingArea:
+    """
+    Base-pass images waiting for their upscale, one directory per job
+    under `root`. Workers on other hosts can only pick up a staged job if
+    `root` is on storage they share.
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        self.root = root or os.getenv('PIPELINE_STAGING_DIR') or os.path.join(tempfile.gettempdir(), 'sd-pipeline')
+
+    def _write(self, job_id: str, images: List[BinaryIO]) -> List[str]:
+        directory = os.path.join(self.root, job_id)
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for index, image in enumerate(images):
+            path = os.path.join(directory, f"{index}.png")
+            image.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(image, f)
+            paths.append(path)
+        return paths
+
+    async def write(self, job_id: str, images: List[BinaryIO]) -> List[str]:
+        """Copy a job's base images into the staging area; returns their paths"""
+        return await asyncio.to_thread(self._write, job_id, images)
+
+    @staticmethod
+    def _read(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    async def read(self, path: str) -> bytes:
+        return await asyncio.to_thread(self._read, path)
+
+    @staticmethod
+    def exists(paths: List[str]) -> bool:
+        return all(os.path.exists(path) for path in paths)
+
+    async def remove(self, job_id: str):
+        await asyncio.to_thread(shutil.rmtree, os.path.join(self.root, job_id), True)
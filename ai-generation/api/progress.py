@@ -0,0 +1,140 @@
+"""
+Shared progress polling for SD backends
+One task per backend polls /sdapi/v1/progress while it has work and caches
+the latest snapshot, so progress readers never call the GPU box themselves
+"""
+
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from api.backend_pool import BackendPool, SDBackend
+from api.events import JobEventBus
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ProgressSnapshot:
+    """Latest /sdapi/v1/progress reading for one backend"""
+    backend: str
+    job_ids: Tuple[str, ...]  # the job, or coalesced batch, this reading belongs to
+    progress: float
+    eta_relative: Optional[float]
+    step: Optional[int]
+    steps: Optional[int]
+    current_image: Optional[str]
+    updated_at: float  # time.monotonic()
+
+    @classmethod
+    def from_response(cls, backend: SDBackend, job_ids: Tuple[str, ...], data: Dict[str, Any]) -> "ProgressSnapshot":
+        state = data.get('state') or {}
+        return cls(
+            backend=backend.url,
+            job_ids=job_ids,
+            progress=float(data.get('progress') or 0.0),
+            eta_relative=data.get('eta_relative'),
+            step=state.get('sampling_step'),
+            steps=state.get('sampling_steps'),
+            current_image=data.get('current_image'),
+            updated_at=time.monotonic()
+        )
+
+    def to_event(self, preview: bool = False) -> Dict[str, Any]:
+        event = {
+            "type": "progress",
+            "progress": self.progress,
+            "eta": self.eta_relative,
+            "step": self.step,
+            "steps": self.steps,
+        }
+        if preview and self.current_image:
+            event["preview"] = self.current_image
+        return event
+
+
+class ProgressMonitor:
+    """
+    Polls each backend every `interval` seconds while it runs jobs.
+
+    A WebUI instance works through its requests one at a time in arrival
+    order, so a reading is attributed to the jobs of the oldest call in
+    flight on that backend. Readings are cached per backend and published to the job's
+    event subscribers. Live previews are only fetched when `previews` is on,
+    since they make every poll much larger.
+    """
+
+    def __init__(
+        self,
+        pool: BackendPool,
+        events: Optional[JobEventBus] = None,
+        interval: Optional[float] = None,
+        previews: Optional[bool] = None
+    ):
+        self.pool = pool
+        self.events = events
+        self.interval = interval or float(os.getenv('SD_PROGRESS_INTERVAL', 1))
+        self.previews = previews if previews is not None else os.getenv('SD_PROGRESS_PREVIEWS', 'false').lower() == 'true'
+        self.snapshots: Dict[str, ProgressSnapshot] = {}
+        self._tasks = []
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._poll(backend), name=f"sd-progress-{backend.url}")
+            for backend in self.pool.backends
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def max_age(self) -> float:
+        """Snapshots older than this are treated as unknown"""
+        return max(3 * self.interval, 5.0)
+
+    def snapshot_for(self, job_id: str) -> Optional[ProgressSnapshot]:
+        """Fresh snapshot for a job that is currently executing on a backend in this process"""
+        now = time.monotonic()
+        for snapshot in self.snapshots.values():
+            if job_id in snapshot.job_ids and now - snapshot.updated_at <= self.max_age:
+                return snapshot
+        return None
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "backend": snapshot.backend,
+                "job_ids": list(snapshot.job_ids),
+                "progress": snapshot.progress,
+                "eta": snapshot.eta_relative,
+                "age_seconds": round(time.monotonic() - snapshot.updated_at, 2),
+            }
+            for snapshot in self.snapshots.values()
+        ]
+
+    async def _poll(self, backend: SDBackend):
+        while True:
+            calls = self.pool.jobs_on(backend)
+            if not calls:
+                self.snapshots.pop(backend.url, None)
+            else:
+                try:
+                    data = await backend.client.get_progress(skip_current_image=not self.previews)
+                except Exception as e:
+                    logger.debug(f"Progress poll of {backend.url} failed: {e}")
+                else:
+                    snapshot = ProgressSnapshot.from_response(backend, calls[0], data)
+                    self.snapshots[backend.url] = snapshot
+                    if self.events is not None:
+                        event = snapshot.to_event(preview=True)
+                        for job_id in snapshot.job_ids:
+                            self.events.publish(job_id, event)
+            await asyncio.sleep(self.interval)
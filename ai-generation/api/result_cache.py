@@ -0,0 +1,95 @@
+"""
+Content-addressed cache of generation results
+Keyed by a hash of the fully resolved txt2img payload, so a fixed-seed
+request that was already generated returns the stored S3 objects instead of
+running the GPU again
+"""
+
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import delete, func, select, update
+
+from api.database import GenerationCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# Payload fields that determine the generated pixels; the LoRA is part of the prompt
+KEY_FIELDS = (
+    'prompt', 'negative_prompt', 'seed', 'steps', 'sampler_name',
+    'cfg_scale', 'width', 'height', 'batch_size'
+)
+
+
+class ResultCache:
+    """
+    LRU cache of results in the generation_cache table.
+
+    Only payloads with a fixed seed are cacheable; a random seed (-1)
+    never repeats. Once the table holds more than `max_entries` rows the
+    least recently used ones are evicted; evicting an entry does not
+    delete its S3 objects, which still belong to the jobs that made them.
+    `max_entries=0` disables the cache.
+    """
+
+    def __init__(self, session_factory, max_entries: Optional[int] = None):
+        self.session_factory = session_factory
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('GENERATION_CACHE_MAX_ENTRIES', 10000))
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def key_for(self, payload: Dict[str, Any], variant: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """
+        Cache key of a resolved payload, or None if it cannot be cached.
+        `variant` holds settings applied after txt2img that also change the
+        result, such as the hires pass.
+        """
+        if not self.enabled or payload.get('seed', -1) in (-1, None):
+            return None
+        resolved = {field: payload.get(field) for field in KEY_FIELDS}
+        if variant:
+            resolved['variant'] = variant
+        return hashlib.sha256(json.dumps(resolved, sort_keys=True).encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        async with self.session_factory() as db:
+            result = (await db.execute(
+                select(GenerationCacheEntry.result).where(GenerationCacheEntry.key == key)
+            )).scalar_one_or_none()
+            if result is None:
+                return None
+            await db.execute(
+                update(GenerationCacheEntry)
+                .where(GenerationCacheEntry.key == key)
+                .values(hits=GenerationCacheEntry.hits + 1, last_used_at=datetime.utcnow())
+            )
+            await db.commit()
+        return result
+
+    async def put(self, key: str, result: Dict[str, Any]):
+        async with self.session_factory() as db:
+            await db.merge(GenerationCacheEntry(
+                key=key, result=result, hits=0, last_used_at=datetime.utcnow()
+            ))
+            await db.commit()
+            await self._evict(db)
+
+    async def _evict(self, db):
+        count = (await db.execute(select(func.count()).select_from(GenerationCacheEntry))).scalar_one()
+        excess = count - self.max_entries
+        if excess <= 0:
+            return
+        oldest = (
+            select(GenerationCacheEntry.key)
+            .order_by(GenerationCacheEntry.last_used_at, GenerationCacheEntry.key)
+            .limit(excess)
+        )
+        await db.execute(delete(GenerationCacheEntry).where(GenerationCacheEntry.key.in_(oldest)))
+        await db.commit()
+        logger.info(f"Evicted {excess} generation cache entr{'y' if excess == 1 else 'ies'}")
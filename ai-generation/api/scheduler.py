@@ -0,0 +1,351 @@
+"""
+Job scheduler for generation jobs
+A bounded worker pool claims jobs from the durable queue, with per-job
+timeouts, retries and lease renewal, optionally coalescing compatible jobs
+into batches
+"""
+
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Collection, Dict, List, Optional, Set, Tuple
+
+from api.job_queue import ClaimedJob, JobQueue
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[ClaimedJob], Awaitable[None]]
+BatchHandler = Callable[[List[ClaimedJob]], Awaitable[None]]
+FailureHandler = Callable[[ClaimedJob, Exception], Awaitable[None]]
+CancelHandler = Callable[[List[ClaimedJob]], Awaitable[bool]]
+Preference = Callable[[], Collection[str]]
+
+
+class LeaseLost(RuntimeError):
+    """The job's lease expired and another worker may now own it"""
+
+
+class JobCancelled(RuntimeError):
+    """The job was cancelled while it ran"""
+
+
+class JobScheduler:
+    """
+    Runs queued jobs with at most `max_concurrent` in flight per process.
+
+    Workers claim jobs from the shared JobQueue, highest priority first.
+    While a job runs its lease is renewed in the background; a job that
+    raises or exceeds `timeout` is retried up to `retry_attempts` times in
+    total before it is marked failed. Errors listed in `non_retryable`
+    fail the job immediately. Expired leases left behind by crashed
+    workers are requeued on start and periodically after that.
+
+    With a `batch_handler` and a positive `coalesce_window`, a worker that
+    claims a job carrying a coalesce key keeps claiming pending jobs with
+    the same key for up to `coalesce_window` seconds, or until it holds
+    `max_batch` jobs, and runs them as one batch. Jobs with that key
+    claimed by other workers in the meantime join the batch. A batch is
+    retried, timed out and failed as a unit.
+
+    With a `preference` callback returning the character ids whose LoRAs
+    are warm on a free backend, and an `affinity_window` above 1, a worker
+    claims the oldest of those characters' jobs among the next
+    `affinity_window` jobs of the top priority, so same-character jobs run
+    back to back. A job is never passed over once it has waited
+    `affinity_max_delay` seconds.
+
+    When a running job is cancelled, or its lease disappears because it
+    was cancelled from another process, `on_cancel` is awaited before the
+    attempt is stopped, to stop its work outside the process, such as the
+    backend call generating its images.
+    """
+
+    non_retryable: Tuple[type, ...] = (ValueError,)
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handler: JobHandler,
+        on_failure: Optional[FailureHandler] = None,
+        on_start: Optional[JobHandler] = None,
+        on_cancel: Optional[CancelHandler] = None,
+        max_concurrent: Optional[int] = None,
+        timeout: Optional[float] = None,
+        retry_attempts: Optional[int] = None,
+        retry_backoff: Optional[float] = None,
+        poll_interval: Optional[float] = None,
+        batch_handler: Optional[BatchHandler] = None,
+        coalesce_window: Optional[float] = None,
+        max_batch: Optional[int] = None,
+        preference: Optional[Preference] = None,
+        affinity_window: Optional[int] = None,
+        affinity_max_delay: Optional[float] = None
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.on_failure = on_failure
+        self.on_start = on_start
+        self.on_cancel = on_cancel
+        self.max_concurrent = max_concurrent or int(os.getenv('MAX_CONCURRENT_GENERATIONS', 2))
+        self.timeout = timeout or float(os.getenv('GENERATION_TIMEOUT', 300))
+        self.retry_attempts = max(1, retry_attempts or int(os.getenv('RETRY_ATTEMPTS', 3)))
+        self.retry_backoff = retry_backoff if retry_backoff is not None else float(os.getenv('RETRY_BACKOFF_SECONDS', 2))
+        self.poll_interval = poll_interval or float(os.getenv('QUEUE_POLL_INTERVAL', 2))
+        self.batch_handler = batch_handler
+        self.coalesce_window = coalesce_window if coalesce_window is not None else float(os.getenv('COALESCE_WINDOW_SECONDS', 0))
+        self.max_batch = max_batch or int(os.getenv('COALESCE_MAX_BATCH', 4))
+        self.preference = preference
+        self.affinity_window = affinity_window if affinity_window is not None else int(os.getenv('AFFINITY_WINDOW', 8))
+        self.affinity_max_delay = affinity_max_delay if affinity_max_delay is not None else float(os.getenv('AFFINITY_MAX_DELAY_SECONDS', 120))
+
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running: Dict[str, asyncio.Task] = {}
+        self._gathering: Dict[str, List[ClaimedJob]] = {}
+        self._attempts: Dict[str, Tuple[List[ClaimedJob], asyncio.Task]] = {}
+        self._cancelled: Set[str] = set()
+        self._stopping = False
+        self._tasks = []
+
+    async def start(self):
+        """Recover unfinished jobs and start the worker pool"""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        await self.queue.reclaim_expired(self.retry_attempts)
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"generation-worker-{i}")
+            for i in range(self.max_concurrent)
+        ]
+        self._tasks.append(asyncio.create_task(self._reaper(), name="lease-reaper"))
+        logger.info(f"Job scheduler started with {self.max_concurrent} workers")
+
+    async def stop(self):
+        """Cancel the workers; their jobs are handed back to the queue"""
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        """Wake idle workers after new jobs were queued"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def depth(self) -> int:
+        """Number of jobs waiting for a worker"""
+        return await self.queue.depth()
+
+    @property
+    def in_flight(self) -> int:
+        """Number of jobs running in this process"""
+        return len(self._running)
+
+    async def cancel(self, job_id: str) -> bool:
+        """
+        Stop a job running in this process after it was cancelled in the
+        queue; returns whether `on_cancel` interrupted its work. A job
+        coalesced with others is left to run so the rest of its batch still
+        gets images; the lease guard discards its result.
+        """
+        attempt = self._attempts.get(job_id)
+        if attempt is None:
+            return False
+        claims, task = attempt
+        if len(claims) > 1:
+            return False
+        self._cancelled.add(job_id)
+        return await self._stop(claims, task)
+
+    async def _stop(self, claims: List[ClaimedJob], job_task: asyncio.Task) -> bool:
+        """Interrupt an attempt's outside work while it is still registered, then cancel its task"""
+        interrupted = False
+        if self.on_cancel and not job_task.done():
+            try:
+                interrupted = await self.on_cancel(claims)
+            except Exception as e:
+                logger.warning(f"Failed to interrupt {self._describe(claims)}: {e}")
+        job_task.cancel()
+        return interrupted
+
+    async def position(self, job_id: str) -> Optional[int]:
+        """1-based position of a queued job, or None if it is not queued"""
+        return await self.queue.position(job_id)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            claim = await self._claim()
+            if claim is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            # Hand the job to a batch another worker is still gathering
+            batch = self._gathering.get(claim.coalesce_key) if claim.coalesce_key else None
+            if batch is not None and len(batch) < self.max_batch:
+                batch.append(claim)
+                continue
+
+            claims = [claim]
+            try:
+                if self._coalesces(claim):
+                    await self._gather(claims)
+                for job in claims:
+                    self._running[job.id] = asyncio.current_task()
+                await self._notify_started(claims)
+                await self._run_with_retries(claims)
+            except asyncio.CancelledError:
+                for job in claims:
+                    await self.queue.release(job)
+                raise
+            except Exception as e:
+                logger.error(f"Worker {worker_id} failed to finalise {self._describe(claims)}: {e}")
+            finally:
+                for job in claims:
+                    self._running.pop(job.id, None)
+
+    async def _claim(self) -> Optional[ClaimedJob]:
+        if self.preference is None or self.affinity_window <= 1:
+            return await self.queue.claim()
+        try:
+            prefer = self.preference()
+        except Exception as e:
+            logger.error(f"Affinity preference failed: {e}")
+            prefer = ()
+        return await self.queue.claim(prefer=prefer, window=self.affinity_window, max_delay=self.affinity_max_delay)
+
+    def _coalesces(self, claim: ClaimedJob) -> bool:
+        return bool(claim.coalesce_key and self.batch_handler and self.coalesce_window > 0 and self.max_batch > 1)
+
+    async def _gather(self, claims: List[ClaimedJob]):
+        """Claim compatible jobs into `claims` until the window closes or the batch is full"""
+        key = claims[0].coalesce_key
+        self._gathering[key] = claims
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.coalesce_window
+        try:
+            while len(claims) < self.max_batch:
+                claim = await self.queue.claim(coalesce_key=key)
+                if claim is not None:
+                    if len(claims) >= self.max_batch:
+                        # Other workers filled the batch while this claim was in flight
+                        await self.queue.release(claim)
+                        self.notify()
+                        break
+                    claims.append(claim)
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(min(remaining, self.coalesce_window / 5))
+        finally:
+            self._gathering.pop(key, None)
+        if len(claims) > 1:
+            logger.info(f"Coalesced {len(claims)} jobs: {', '.join(job.id for job in claims)}")
+
+    async def _notify_started(self, claims: List[ClaimedJob]):
+        if not self.on_start:
+            return
+        for claim in claims:
+            try:
+                await self.on_start(claim)
+            except Exception as e:
+                logger.error(f"Start hook failed for job {claim.id}: {e}")
+
+    @staticmethod
+    def _describe(claims: List[ClaimedJob]) -> str:
+        if len(claims) == 1:
+            return f"job {claims[0].id}"
+        return f"batch of {len(claims)} jobs ({', '.join(job.id for job in claims)})"
+
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 2)
+            try:
+                if await self.queue.reclaim_expired(self.retry_attempts):
+                    self.notify()
+            except Exception as e:
+                logger.error(f"Lease reaper failed: {e}")
+
+    async def _heartbeat(self, claims: List[ClaimedJob], job_task: asyncio.Task) -> bool:
+        """Renew the leases until cancelled; returns True once every lease was lost"""
+        held = list(claims)
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            for claim in list(held):
+                if not await self.queue.renew(claim):
+                    # Its result will be discarded by the lease guard on completion
+                    logger.error(f"Lost lease on job {claim.id}")
+                    held.remove(claim)
+            if not held:
+                await self._stop(claims, job_task)
+                return True
+
+    async def _run_attempt(self, claims: List[ClaimedJob]):
+        if len(claims) == 1:
+            job_task = asyncio.create_task(self.handler(claims[0]))
+        else:
+            job_task = asyncio.create_task(self.batch_handler(claims))
+        heartbeat = asyncio.create_task(self._heartbeat(claims, job_task))
+        for claim in claims:
+            self._attempts[claim.id] = (claims, job_task)
+        try:
+            await asyncio.wait_for(job_task, timeout=self.timeout)
+        except asyncio.CancelledError:
+            if self._stopping:
+                # The worker itself is being stopped, whatever happened to the job
+                raise
+            if heartbeat.done() and not heartbeat.cancelled() and heartbeat.result():
+                raise LeaseLost(f"Lost lease on {self._describe(claims)}")
+            if any(claim.id in self._cancelled for claim in claims):
+                raise JobCancelled(f"Cancelled {self._describe(claims)}")
+            raise
+        finally:
+            heartbeat.cancel()
+            for claim in claims:
+                self._attempts.pop(claim.id, None)
+                self._cancelled.discard(claim.id)
+
+    async def _run_with_retries(self, claims: List[ClaimedJob]):
+        label = self._describe(claims)
+        for attempt in range(1, self.retry_attempts + 1):
+            try:
+                await self._run_attempt(claims)
+                return
+            except LeaseLost as e:
+                logger.error(f"{e}; abandoning it to its new owner")
+                return
+            except JobCancelled as e:
+                logger.info(str(e))
+                return
+            except asyncio.TimeoutError:
+                error = TimeoutError(f"Job timed out after {self.timeout:.0f}s")
+            except self.non_retryable as e:
+                error = e
+                break
+            except Exception as e:
+                error = e
+
+            if attempt < self.retry_attempts:
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                logger.warning(
+                    f"Attempt {attempt}/{self.retry_attempts} of {label} failed: {error}; "
+                    f"retrying in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+                # Jobs cancelled or reclaimed since the failure are not retried
+                claims = [claim for claim in claims if await self.queue.renew(claim)]
+                if not claims:
+                    logger.info(f"{label} is no longer leased; not retrying it")
+                    return
+                label = self._describe(claims)
+
+        logger.error(f"Giving up on {label} after {attempt} attempt(s): {error}")
+        for claim in claims:
+            # A job cancelled or reclaimed in the meantime has already moved on
+            if await self.queue.fail(claim, error) and self.on_failure:
+                await self.on_failure(claim, error)
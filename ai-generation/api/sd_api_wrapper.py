@@ -3,44 +3,62 @@ FastAPI wrapper for Stable Diffusion WebUI API
 Provides authentication, queuing, and monitoring
 """
 
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
-import httpx
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, model_validator
+from typing import Optional, List, Dict, Any, Literal, Set
 import asyncio
 import json
 import base64
+import hashlib
+import hmac
+import io
+import itertools
 import os
+import secrets
+import sys
+import time
 from datetime import datetime
 from dotenv import load_dotenv
 import logging
-from sqlalchemy import create_engine, Column, String, DateTime, JSON, Integer
-from sqlalchemy.orm import declarative_base, sessionmaker, Session
-import boto3
-from botocore.exceptions import NoCredentialsError
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 # Load environment variables
-load_dotenv('../config/settings.env')
+load_dotenv(os.path.join(ROOT, 'config', 'settings.env'))
+
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+from api.admission import AdmissionController, RateLimiter, Rejected
+from api.archive import JobArchive
+from api.backend_pool import BackendPool
+from api.sd_client import SDAPIClient, load_sd_auth
+from api.events import JobEventBus, TERMINAL_STATUSES
+from api.derivatives import ImageProcessor
+from api.drafts import DraftMode
+from api.database import engine, SessionLocal, GenerationJob, ensure_schema, get_db
+from api.job_queue import ClaimedJob, JobQueue, new_job_id
+from api import metrics
+from api.pipeline import HiresPass, StagingArea
+from api.progress import ProgressMonitor
+from api.result_cache import ResultCache
+from api.scheduler import JobScheduler
+from api.storage import ImageStorage, UploadError
+from api.webhooks import WebhookDispatcher, callback_refusal
+from scripts.character_registry import get_registry
+from scripts.prompt_generator import PromptGenerator
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Database setup
-Base = declarative_base()
-engine = create_engine(os.getenv('DATABASE_URL', 'sqlite:///./ai_generation.db'))
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# S3 client
-s3_client = boto3.client(
-    's3',
-    region_name=os.getenv('AWS_REGION'),
-    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-)
-
 # FastAPI app
 app = FastAPI(title="AI Generation API", version="1.0.0")
 
@@ -51,39 +69,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+# Compress larger JSON responses (job listings, results)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Security
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
-# Database Models
-class GenerationJob(Base):
-    __tablename__ = "generation_jobs"
-    
-    id = Column(String, primary_key=True)
-    character_id = Column(String)
-    status = Column(String)  # pending, processing, completed, failed
-    prompt = Column(String)
-    tags = Column(JSON)
-    result = Column(JSON)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    completed_at = Column(DateTime)
-    error_message = Column(String)
+# Pydantic models
+class CallbackOptions(BaseModel):
+    """Completion webhook: the final job status is POSTed to `callback_url`, signed with `callback_secret`"""
+    callback_url: Optional[str] = Field(None, max_length=2048, pattern="^https?://")
+    callback_secret: Optional[str] = Field(None, min_length=16, max_length=256)
 
-class Character(Base):
-    __tablename__ = "characters"
-    
-    id = Column(String, primary_key=True)
-    name = Column(String)
-    character_metadata = Column(JSON)
-    lora_path = Column(String)
-    training_status = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    @model_validator(mode='after')
+    def check_callback(self):
+        if self.callback_url and not self.callback_secret:
+            raise ValueError("callback_secret is required with callback_url")
+        return self
 
-Base.metadata.create_all(bind=engine)
+# Stored on the job's own columns, not in its request
+CALLBACK_FIELDS = set(CallbackOptions.model_fields)
 
-# Pydantic models
-class GenerateImageRequest(BaseModel):
+class GenerateImageRequest(CallbackOptions):
     character_id: str
     focus: str = Field(..., pattern="^(ass|tits)$")
     is_nude: bool = False
@@ -92,195 +103,699 @@ class GenerateImageRequest(BaseModel):
     lighting: Optional[str] = None
     accessory: Optional[str] = None
     batch_size: int = Field(1, ge=1, le=4)
+    priority: int = Field(0, ge=0, le=10)
+    seed: Optional[int] = Field(None, ge=0)  # fixes the prompt choices and the SD seed
+    hires: Optional[bool] = None  # run the upscale stage; defaults to HIRES_ENABLED
+    mode: Literal["full", "draft"] = "full"  # drafts are cheap previews to refine later
+
+class GenerateBatchRequest(CallbackOptions):
+    """
+    Matrix of jobs: one job per combination of the listed options, `count`
+    times over. "*" expands to every character, or to every option the
+    prompt generator knows; unset options are chosen at random per job.
+    """
+    character_ids: List[str] = Field(..., min_length=1)
+    focus: List[Literal["ass", "tits"]] = Field(["ass"], min_length=1)
+    is_nude: List[bool] = Field([False], min_length=1)
+    scenes: List[Optional[str]] = Field([None], min_length=1)
+    poses: List[Optional[str]] = Field([None], min_length=1)
+    lightings: List[Optional[str]] = Field([None], min_length=1)
+    accessories: List[Optional[str]] = Field([None], min_length=1)
+    count: int = Field(1, ge=1, le=100)
+    batch_size: int = Field(1, ge=1, le=4)
+    priority: int = Field(0, ge=0, le=10)
+    hires: Optional[bool] = None
+    mode: Literal["full", "draft"] = "full"
+
+class RefineRequest(CallbackOptions):
+    """Re-run a completed draft's seeds at full quality, one job per seed"""
+    seeds: Optional[List[int]] = Field(None, min_length=1, max_length=4)  # defaults to every draft image
+    priority: int = Field(0, ge=0, le=10)
+    hires: Optional[bool] = None
 
 class GenerationResponse(BaseModel):
     job_id: str
     status: str
     message: str
 
+class BatchGenerationResponse(BaseModel):
+    job_ids: List[str]
+    status: str
+    message: str
+
 class JobStatus(BaseModel):
     job_id: str
     status: str
+    stage: Optional[str] = None
     progress: float
+    eta: Optional[float] = None
     result: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
+    queue_position: Optional[int] = None
+    queue_depth: int = 0
+    timings: Optional[Dict[str, float]] = None
+    mode: Optional[str] = None
+    refined_from: Optional[str] = None
+    gpu_seconds: Optional[float] = None
+    gpu_seconds_saved: Optional[float] = None
+    callback: Optional[Dict[str, Any]] = None
 
 # Authentication
+def api_keys() -> List[str]:
+    """API_KEY_SECRET plus any extra client keys in API_KEYS (comma separated)"""
+    keys = [os.getenv('API_KEY_SECRET')] + os.getenv('API_KEYS', '').split(',')
+    return [key.strip() for key in keys if key and key.strip()]
+
+def key_fingerprint(api_key: str) -> str:
+    """Stable id for a client key, safe to store and log"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+def is_valid_key(api_key: Optional[str]) -> bool:
+    return bool(api_key) and any(secrets.compare_digest(api_key, key) for key in api_keys())
+
 async def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
     api_key = credentials.credentials
-    expected_key = os.getenv('API_KEY_SECRET')
-    if api_key != expected_key:
+    if not is_valid_key(api_key):
         raise HTTPException(status_code=403, detail="Invalid API key")
     return api_key
 
-# Database dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-# SD API client
-class SDAPIClient:
-    def __init__(self):
-        self.base_url = os.getenv('SD_API_URL')
-        self.timeout = int(os.getenv('SD_API_TIMEOUT', 600))
-        
-    async def generate_image(self, prompt: str, negative_prompt: str, **kwargs):
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            payload = {
-                "prompt": prompt,
-                "negative_prompt": negative_prompt,
-                "steps": int(os.getenv('DEFAULT_STEPS', 50)),
-                "sampler_name": os.getenv('DEFAULT_SAMPLER', 'DPM++ 2M Karras'),
-                "cfg_scale": float(os.getenv('DEFAULT_CFG_SCALE', 7.5)),
-                "width": kwargs.get('width', int(os.getenv('DEFAULT_WIDTH', 1024))),
-                "height": kwargs.get('height', int(os.getenv('DEFAULT_HEIGHT', 1024))),
-                "batch_size": kwargs.get('batch_size', 1),
-                "seed": kwargs.get('seed', -1),
-            }
-            
-            response = await client.post(f"{self.base_url}/sdapi/v1/txt2img", json=payload)
-            response.raise_for_status()
-            return response.json()
-    
-    async def get_progress(self):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{self.base_url}/sdapi/v1/progress")
-            return response.json()
+# Stream tokens let EventSource clients, which cannot set headers, authenticate
+# without putting an API key in the URL, where access logs would keep it
+STREAM_TOKEN_TTL_SECONDS = int(os.getenv('STREAM_TOKEN_TTL_SECONDS', 300))
 
-sd_client = SDAPIClient()
+def stream_token_signature(job_id: str, expires: int) -> str:
+    secret = os.getenv('STREAM_TOKEN_SECRET') or os.getenv('API_KEY_SECRET') or ''
+    return hmac.new(secret.encode(), f"stream:{job_id}:{expires}".encode(), hashlib.sha256).hexdigest()
 
-# S3 upload function
-async def upload_to_s3(file_data: bytes, bucket: str, key: str, metadata: dict = None):
-    try:
-        s3_client.put_object(
-            Bucket=bucket,
-            Key=key,
-            Body=file_data,
-            ContentType='image/png',
-            Metadata=metadata or {}
-        )
-        return f"s3://{bucket}/{key}"
-    except NoCredentialsError:
-        logger.error("S3 credentials not found")
-        raise
-    except Exception as e:
-        logger.error(f"S3 upload failed: {e}")
-        raise
-
-# Background task for image generation
-async def process_generation_job(job_id: str, request: GenerateImageRequest):
-    db = SessionLocal()
-    job = db.query(GenerationJob).filter(GenerationJob.id == job_id).first()
+def issue_stream_token(job_id: str) -> Dict[str, Any]:
+    """`<expiry>.<hmac>` token valid for streaming one job's events until it expires"""
+    expires = int(time.time()) + STREAM_TOKEN_TTL_SECONDS
+    return {'token': f"{expires}.{stream_token_signature(job_id, expires)}", 'expires_at': expires}
+
+def is_valid_stream_token(job_id: str, token: Optional[str]) -> bool:
+    expires, _, signature = (token or '').partition('.')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return secrets.compare_digest(signature, stream_token_signature(job_id, int(expires)))
+
+async def verify_stream_key(
+    job_id: str,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    token: Optional[str] = Query(None)
+):
+    """Bearer auth, or a ?token= from /api/jobs/{job_id}/stream-token for this job"""
+    if credentials is not None:
+        if not is_valid_key(credentials.credentials):
+            raise HTTPException(status_code=403, detail="Invalid API key")
+        return credentials.credentials
+    if not is_valid_stream_token(job_id, token):
+        raise HTTPException(status_code=403, detail="Invalid or expired stream token")
+    return None
+
+# SD backends
+backend_pool = BackendPool.from_env()
+character_registry = get_registry()
+prompt_generator = PromptGenerator()
+
+# Job events for streaming clients, fed by one progress poller per backend
+job_events = JobEventBus()
+progress_monitor = ProgressMonitor(backend_pool, job_events)
+
+# S3 uploads run on a thread pool so they never block the event loop
+storage = ImageStorage()
+
+async def upload_to_s3(file_data: bytes, bucket: str, key: str, metadata: dict = None, content_type: str = 'image/png'):
+    return await storage.upload(file_data, key, metadata=metadata, content_type=content_type, bucket=bucket)
+
+# WebP/AVIF masters and thumbnails are encoded in a process pool
+image_processor = ImageProcessor()
+
+# Encoding needs an image's bytes in memory, so only this many images per
+# process are read out of their spooled files at once, across all jobs
+IMAGE_ENCODE_CONCURRENCY = int(os.getenv('IMAGE_ENCODE_CONCURRENCY', 2))
+encode_slots = asyncio.Semaphore(max(1, IMAGE_ENCODE_CONCURRENCY))
+
+# Results of fixed-seed payloads, reused instead of regenerating
+result_cache = ResultCache(SessionLocal)
+
+# Hires jobs leave their base images here for the upscale stage
+hires = HiresPass()
+staging = StagingArea()
+
+# Low-step previews whose seeds are refined at full quality
+drafts = DraftMode()
+
+# Backends for the upscale stage when it should not share the base pass GPUs
+UPSCALE_SD_API_URLS = [url.strip() for url in os.getenv('UPSCALE_SD_API_URLS', '').split(',') if url.strip()]
+upscale_pool = BackendPool(UPSCALE_SD_API_URLS, auth=load_sd_auth()) if UPSCALE_SD_API_URLS else None
+
+def upscale_backends() -> BackendPool:
+    return upscale_pool or backend_pool
+
+# Per-key rate limits and queue admission, both counted in jobs
+rate_limiter = RateLimiter()
+admission = AdmissionController()
+
+# Upper bound on the jobs a single batch submission may expand to
+BATCH_MAX_JOBS = int(os.getenv('BATCH_MAX_JOBS', 1000))
+
+async def check_callback(options: CallbackOptions):
+    """Refuse callbacks to hosts the API must not call, such as its own network (422)"""
+    if options.callback_url:
+        refusal = await callback_refusal(options.callback_url)
+        if refusal:
+            raise HTTPException(status_code=422, detail=refusal)
+
+def callback_columns(options: CallbackOptions) -> Dict[str, Any]:
+    """Job columns for a request's completion webhook"""
+    if not options.callback_url:
+        return {}
+    return {
+        'callback_url': options.callback_url,
+        'callback_secret': options.callback_secret,
+        'callback_status': "pending"
+    }
+
+# Request fields that must match for jobs to share one txt2img call
+COALESCE_FIELDS = {'character_id', 'focus', 'is_nude', 'scene', 'pose', 'lighting', 'accessory', 'hires', 'mode'}
+
+def resolve_hires(hires_requested: Optional[bool], mode: str = "full") -> bool:
+    """A request's hires choice, pinned at submission so queued jobs keep it if HIRES_ENABLED changes"""
+    if mode == "draft":
+        return False
+    return hires.enabled if hires_requested is None else hires_requested
+
+def gpu_usage(
+    gpu_seconds: float,
+    mode: str,
+    refined_from: Optional[str],
+    payload: Dict[str, Any],
+    full_payload: Dict[str, Any]
+) -> Dict[str, float]:
+    """Job columns for the GPU seconds a job used, and saved against generating it at full quality"""
+    if mode == "draft":
+        full = drafts.full_quality_seconds(gpu_seconds, payload, full_payload, hires if hires.enabled else None)
+        saved = full - gpu_seconds
+    elif refined_from:
+        # Refining is what drafting first costs on top, so the savings of all jobs add up to the net
+        saved = -gpu_seconds
+    else:
+        saved = 0.0
+    return {'gpu_seconds': round(gpu_seconds, 3), 'gpu_seconds_saved': round(saved, 3)}
+
+def coalesce_key(request: GenerateImageRequest) -> Optional[str]:
+    """Key of the batch a request may join; only single-image, random-seed requests are merged"""
+    if request.batch_size != 1 or request.seed is not None:
+        return None
+    fields = request.model_dump(include=COALESCE_FIELDS)
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:16]
+
+def character_lora(character_id: str) -> str:
+    return f"{character_id}_lora"
+
+def warm_characters() -> Set[str]:
+    """Characters whose LoRA is loaded on a backend with a free slot"""
+    suffix = character_lora('')
+    return {lora[:-len(suffix)] for lora in backend_pool.warm_loras() if lora.endswith(suffix)}
+
+# Scheduled task for image generation; raises so the scheduler can retry
+async def process_generation_job(claim: ClaimedJob):
+    await process_generation_batch([claim])
+
+async def process_generation_batch(claims: List[ClaimedJob]):
+    """
+    Generate images for one job, or for a coalesced batch of compatible
+    jobs in a single txt2img call. A batch shares one prompt; images are
+    split back out to their jobs in order, each with its own seed. Hires
+    jobs stop after the base pass and wait for the upscale stage. A job
+    with a pinned prompt, such as a refine of a draft, reuses it.
+    """
+    for claim in claims:
+        if not claim.request:
+            raise ValueError(f"Job {claim.id} has no stored request and cannot be resumed")
+    requests = [GenerateImageRequest(**claim.request) for claim in claims]
+    request = requests[0]
+    job_ids = [claim.id for claim in claims]
+    upscale = resolve_hires(request.hires, request.mode)
+    pinned = claims[0].stage_data or {}
     
-    try:
-        job.status = "processing"
-        db.commit()
-        
-        # Load character data
-        with open('../config/characters.json', 'r') as f:
-            characters_data = json.load(f)
-        
-        character = next((c for c in characters_data['characters'] if c['id'] == request.character_id), None)
-        if not character:
-            raise ValueError(f"Character {request.character_id} not found")
-        
-        # Build prompt from template
-        import sys
-        sys.path.append('..')
-        from scripts.prompt_generator import PromptGenerator
-        generator = PromptGenerator()
-        prompt, tags = generator.generate_prompt(
-            character_id=request.character_id,
-            character_lora=f"{request.character_id}_lora",
-            focus=request.focus,
-            is_nude=request.is_nude,
-            scene=request.scene,
-            pose=request.pose,
-            lighting=request.lighting,
-            accessory=request.accessory
+    # Unknown characters fail the job without retries
+    character_registry.require(request.character_id)
+    
+    # Seconds per stage, stored with each job and exported as histograms
+    timings: Dict[str, float] = {}
+    
+    # Build prompt from template
+    if pinned.get('prompt'):
+        prompt, tags = pinned['prompt'], pinned['tags']
+    else:
+        with metrics.timed(timings, 'prompt_build'):
+            prompt, tags = prompt_generator.generate_prompt(
+                character_id=request.character_id,
+                character_lora=character_lora(request.character_id),
+                focus=request.focus,
+                is_nude=request.is_nude,
+                scene=request.scene,
+                pose=request.pose,
+                lighting=request.lighting,
+                accessory=request.accessory,
+                seed=request.seed
+            )
+    
+    total = sum(r.batch_size for r in requests)
+    full_payload = SDAPIClient.default_payload(
+        prompt,
+        "blurry, deformed, ugly, extra limbs, artifacts, low quality",
+        batch_size=total,
+        seed=request.seed if request.seed is not None else -1
+    )
+    payload = drafts.payload(full_payload) if request.mode == "draft" else full_payload
+    
+    # A fixed-seed payload that was generated before reuses the stored images
+    cache_key = result_cache.key_for(payload, hires.settings() if upscale else None)
+    if cache_key:
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            await complete_job(claims[0], {**cached, 'cached': True}, tags, timings)
+            return
+    
+    # Generate images; the response is decoded straight into temporary files as it streams in
+    with metrics.timed(timings, 'sd_call'):
+        result = await backend_pool.txt2img(
+            payload,
+            job_id=job_ids if len(claims) > 1 else job_ids[0],
+            stream=True
         )
-        
-        # Generate images
-        result = await sd_client.generate_image(
-            prompt=prompt,
-            negative_prompt="blurry, deformed, ugly, extra limbs, artifacts, low quality",
-            batch_size=request.batch_size
+    timings['decode'] = round(result.decode_seconds, 4)
+    metrics.observe('decode', result.decode_seconds)
+    
+    # The WebUI may prepend a grid image to multi-image batches
+    images = result.images[len(result.images) - total:] if len(result.images) > total else result.images
+    info = json.loads(result.info) if isinstance(result.info, str) and result.info else {}
+    seeds = info.get('all_seeds') or []
+    
+    if upscale:
+        with result:
+            await stage_for_upscale(claims, requests, images, seeds, {
+                'prompt': prompt,
+                'tags': tags,
+                'payload': payload,
+                'parameters': result.parameters,
+                'hires': hires.settings(),
+                'cache_key': cache_key,
+                'refined_from': pinned.get('refined_from'),
+            }, timings)
+        return
+    
+    # Process and upload images and their derivatives; the whole batch runs concurrently
+    with result:
+        if not await still_leased(claims):
+            return
+        uploads = await store_images(request, images, seeds, prompt, tags, timings)
+    
+    offset = 0
+    for claim, job_request in zip(claims, requests):
+        job_uploads = uploads[offset:offset + job_request.batch_size]
+        first_index = offset
+        offset += job_request.batch_size
+        await finish_job(
+            claim,
+            job_uploads,
+            first_index,
+            {'prompt': prompt, 'parameters': result.parameters},
+            tags,
+            timings,
+            cache_key=cache_key,
+            coalesced_with=[job_id for job_id in job_ids if job_id != claim.id] if len(claims) > 1 else None,
+            columns=gpu_usage(
+                timings['sd_call'] * job_request.batch_size / total,
+                request.mode,
+                pinned.get('refined_from'),
+                payload,
+                full_payload
+            )
         )
+
+async def stage_for_upscale(
+    claims: List[ClaimedJob],
+    requests: List[GenerateImageRequest],
+    images: List[Any],
+    seeds: List[int],
+    stage_data: Dict[str, Any],
+    timings: Dict[str, float]
+):
+    """Stage each job's base images and hand the jobs to the upscale queue"""
+    job_ids = [claim.id for claim in claims]
+    total = sum(job_request.batch_size for job_request in requests)
+    offset = 0
+    for claim, job_request in zip(claims, requests):
+        job_images = images[offset:offset + job_request.batch_size]
+        job_seeds = seeds[offset:offset + job_request.batch_size]
+        offset += job_request.batch_size
+        if not job_images:
+            error = UploadError("No image returned for job")
+            if await job_queue.fail(claim, error):
+                await on_job_failed(claim, error)
+            continue
         
-        # Process and upload images
-        images = result.get('images', [])
-        uploaded_images = []
-        
-        for idx, img_base64 in enumerate(images):
-            img_data = base64.b64decode(img_base64)
-            
-            # Generate filename
-            timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-            filename = f"{request.character_id}_{request.focus}_{timestamp}_{idx}.png"
+        paths = await staging.write(claim.id, job_images)
+        job_timings = {'queue_wait': round(claim.queue_wait, 4), **timings} if claim.queue_wait is not None else timings
+        advanced = await job_queue.advance(claim, "upscale", stage_data={
+            **stage_data,
+            'images': paths,
+            'seeds': job_seeds,
+            'timings': job_timings,
+            'gpu_seconds': timings['sd_call'] * job_request.batch_size / total,
+            'coalesced_with': [job_id for job_id in job_ids if job_id != claim.id] if len(claims) > 1 else None,
+            'base_reruns': (claim.stage_data or {}).get('base_reruns', 0),
+        })
+        if not advanced:
+            logger.warning(f"Job {claim.id} lost its lease before the upscale stage; staged images discarded")
+            await staging.remove(claim.id)
+            continue
+        job_events.publish_status(claim.id, "pending", stage="upscale")
+        admission.observe((datetime.utcnow() - claim.claimed_at).total_seconds(), job_request.batch_size)
+    upscale_scheduler.notify()
+
+async def process_upscale_job(claim: ClaimedJob):
+    """Upscale a hires job's staged base images, then store them and complete the job"""
+    data = claim.stage_data or {}
+    paths = data.get('images') or []
+    if not paths or not staging.exists(paths):
+        # Staged on a host without shared storage, or lost in a restart; the rerun keeps the prompt.
+        # Advancing resets attempts, so reruns are counted separately to stop hosts bouncing the job.
+        reruns = data.get('base_reruns', 0)
+        if reruns >= upscale_scheduler.retry_attempts:
+            raise ValueError(
+                f"Staged images lost after {reruns} base reruns; PIPELINE_STAGING_DIR must be shared by every API host"
+            )
+        logger.warning(f"Staged images for job {claim.id} are gone; rerunning its base pass")
+        if await upscale_queue.advance(claim, "base", stage_data={**data, 'base_reruns': reruns + 1}):
+            scheduler.notify()
+        return
+    
+    request = GenerateImageRequest(**claim.request)
+    hires_pass = HiresPass(enabled=True, **data['hires'])
+    pool = upscale_backends()
+    seeds = data.get('seeds') or []
+    timings: Dict[str, float] = dict(data.get('timings') or {})
+    
+    # One call per image, so the job's call on its backend can be interrupted
+    images = []
+    with metrics.timed(timings, 'upscale'):
+        for idx, path in enumerate(paths):
+            upscale_payload = hires_pass.payload(
+                await staging.read(path), data['payload'], seeds[idx] if idx < len(seeds) else None
+            )
+            if hires_pass.mode == 'extras':
+                response = await pool.extra_single_image(upscale_payload, job_id=claim.id)
+            else:
+                response = await pool.img2img(upscale_payload, job_id=claim.id)
+            images.append(io.BytesIO(hires_pass.image_from(response)))
+    
+    if not await still_leased([claim]):
+        return
+    uploads = await store_images(request, images, seeds, data['prompt'], data['tags'], timings)
+    await finish_job(
+        claim,
+        uploads,
+        0,
+        {'prompt': data['prompt'], 'parameters': data['parameters'], 'hires': data['hires']},
+        data['tags'],
+        timings,
+        cache_key=data.get('cache_key'),
+        coalesced_with=data.get('coalesced_with'),
+        columns=gpu_usage(data.get('gpu_seconds', 0) + timings['upscale'], "full", data.get('refined_from'), {}, {})
+    )
+    await staging.remove(claim.id)
+
+async def still_leased(claims: List[ClaimedJob]) -> bool:
+    """
+    Whether any of the jobs is still ours to finish. A job cancelled while its
+    images were generated, possibly from another process, has lost its lease,
+    and its images are dropped rather than uploaded to S3 for nothing.
+    """
+    leased = [await job_queue.renew(claim) for claim in claims]
+    if not any(leased):
+        logger.info(f"Discarding images of {', '.join(claim.id for claim in claims)}: no longer leased")
+    return any(leased)
+
+async def store_images(
+    request: GenerateImageRequest,
+    images: List[Any],
+    seeds: List[int],
+    prompt: str,
+    tags: Dict[str, Any],
+    timings: Dict[str, float]
+) -> List[Any]:
+    """
+    Upload a call's images and their derivatives concurrently, with at most
+    IMAGE_ENCODE_CONCURRENCY images held in memory for encoding; returns an
+    upload record or the exception per image. Raises only when nothing was
+    stored, so a partial batch still completes.
+    """
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    bucket = os.getenv('S3_BUCKET_IMAGES')
+    metadata = {
+        'character_id': request.character_id,
+        'focus': request.focus,
+        'tags': json.dumps(tags),
+        'prompt': prompt
+    }
+    
+    async def upload_derivatives(stem: str, data: bytes) -> Dict[str, Any]:
+        """Encode and upload the master and thumbnails; failures leave the original usable"""
+        try:
+            started = time.perf_counter()
+            rendered = await image_processor.process(data)
+            metrics.observe('derivatives', time.perf_counter() - started)
+            timings['derivatives_cpu'] = round(timings.get('derivatives_cpu', 0) + rendered.cpu_seconds, 4)
             
-            # Upload to S3
-            s3_url = await upload_to_s3(
-                img_data,
-                os.getenv('S3_BUCKET_IMAGES'),
-                f"generated/{request.character_id}/{filename}",
-                metadata={
-                    'character_id': request.character_id,
-                    'focus': request.focus,
-                    'tags': json.dumps(tags),
-                    'prompt': prompt
+            async def upload(derivative):
+                if derivative.size is None:
+                    key = f"generated/{request.character_id}/{stem}.{derivative.format}"
+                else:
+                    key = f"generated/{request.character_id}/thumbs/{stem}_{derivative.size}.{derivative.format}"
+                url = await upload_to_s3(derivative.data, bucket, key, metadata, content_type=derivative.content_type)
+                return derivative.name, {
+                    'url': url,
+                    'key': key,
+                    'format': derivative.format,
+                    'width': derivative.width,
+                    'height': derivative.height,
+                    'bytes': len(derivative.data)
                 }
-            )
             
-            uploaded_images.append({
-                'url': s3_url,
-                'filename': filename,
-                'tags': tags
-            })
-        
-        # Update job
-        job.status = "completed"
-        job.result = {
-            'images': uploaded_images,
-            'prompt': prompt,
-            'parameters': result.get('parameters', {})
+            return dict(await asyncio.gather(*(upload(derivative) for derivative in rendered.derivatives)))
+        except Exception as e:
+            logger.error(f"Derivatives for {stem} failed: {e}")
+            return {'error': str(e)}
+    
+    async def upload_image(idx: int, image_file):
+        stem = f"{request.character_id}_{request.focus}_{timestamp}_{idx}"
+        filename = f"{stem}.png"
+        key = f"generated/{request.character_id}/{filename}"
+        uploaded = {
+            'filename': filename,
+            'tags': tags,
+            'seed': seeds[idx] if idx < len(seeds) else None
         }
-        job.tags = tags
-        job.completed_at = datetime.utcnow()
-        db.commit()
+        if not image_processor.enabled:
+            uploaded['url'] = await upload_to_s3(image_file, bucket, key, metadata)
+            return uploaded
         
-    except Exception as e:
-        logger.error(f"Generation job {job_id} failed: {e}")
-        job.status = "failed"
-        job.error_message = str(e)
-        db.commit()
-    finally:
-        db.close()
+        # The worker processes need the bytes, so the original is uploaded from the same copy
+        async with encode_slots:
+            image_file.seek(0)
+            data = image_file.read()
+            uploaded['url'], uploaded['derivatives'] = await asyncio.gather(
+                upload_to_s3(data, bucket, key, metadata),
+                upload_derivatives(stem, data)
+            )
+        uploaded['bytes'] = len(data)
+        return uploaded
+    
+    with metrics.timed(timings, 'upload'):
+        uploads = await asyncio.gather(
+            *(upload_image(idx, image_file) for idx, image_file in enumerate(images)),
+            return_exceptions=True
+        )
+    
+    # Only a call with nothing stored is retried
+    if uploads and all(isinstance(upload, Exception) for upload in uploads):
+        raise UploadError(f"All {len(uploads)} image uploads failed: {uploads[0]}")
+    return uploads
+
+async def finish_job(
+    claim: ClaimedJob,
+    uploads: List[Any],
+    first_index: int,
+    result: Dict[str, Any],
+    tags: Dict[str, Any],
+    timings: Dict[str, float],
+    cache_key: Optional[str] = None,
+    coalesced_with: Optional[List[str]] = None,
+    columns: Optional[Dict[str, Any]] = None
+):
+    """Complete a job with the images of its that were stored, or fail it if none were"""
+    uploaded_images = [upload for upload in uploads if not isinstance(upload, Exception)]
+    upload_errors = [
+        {'index': first_index + idx, 'error': str(upload)}
+        for idx, upload in enumerate(uploads) if isinstance(upload, Exception)
+    ]
+    if not uploaded_images:
+        error = UploadError(upload_errors[0]['error'] if upload_errors else "No image returned for job")
+        if await job_queue.fail(claim, error):
+            await on_job_failed(claim, error)
+        return
+    
+    # Update job
+    completed_result = {
+        'images': uploaded_images,
+        **result,
+        'upload_seconds': timings['upload'],
+        'upload_errors': upload_errors
+    }
+    if coalesced_with:
+        completed_result['coalesced_with'] = coalesced_with
+    if await complete_job(claim, completed_result, tags, timings, columns) and cache_key and not upload_errors:
+        await result_cache.put(cache_key, {'images': uploaded_images, **result})
+
+async def complete_job(
+    claim: ClaimedJob,
+    result: Dict[str, Any],
+    tags: Dict[str, Any],
+    timings: Dict[str, float],
+    columns: Optional[Dict[str, Any]] = None
+) -> bool:
+    """Store a job's result, plus any extra job `columns`, and notify watchers; False if the lease was lost"""
+    timings = {'queue_wait': round(claim.queue_wait, 4), **timings} if claim.queue_wait is not None else timings
+    commit_started = time.perf_counter()
+    completed = await job_queue.complete(claim, result=result, tags=tags, timings=timings, **(columns or {}))
+    metrics.observe('db_commit', time.perf_counter() - commit_started)
+    if not completed:
+        logger.warning(f"Job {claim.id} finished after its lease was lost; result discarded")
+        return False
+    job_events.publish_status(claim.id, "completed", progress=1.0, result=result)
+    if claim.callback_url:
+        webhooks.notify(claim.id)
+    # Admission models base pass durations; hires jobs report theirs on entering the upscale stage
+    if not result.get('cached') and claim.stage == "base":
+        admission.observe(
+            (datetime.utcnow() - claim.claimed_at).total_seconds(),
+            (claim.request or {}).get('batch_size', 1)
+        )
+    return True
+
+async def on_job_started(claim: ClaimedJob):
+    if claim.queue_wait is not None:
+        metrics.observe('queue_wait', claim.queue_wait)
+    job_events.publish_status(claim.id, "processing", attempt=claim.attempts)
+
+async def on_job_failed(claim: ClaimedJob, error: Exception):
+    metrics.record_failure(error)
+    job_events.publish_status(claim.id, "failed", error=str(error))
+    if claim.callback_url:
+        webhooks.notify(claim.id)
+
+async def on_job_cancelled(claims: List[ClaimedJob]) -> bool:
+    return await backend_pool.interrupt([claim.id for claim in claims])
+
+async def on_upscale_started(claim: ClaimedJob):
+    job_events.publish_status(claim.id, "processing", stage="upscale", attempt=claim.attempts)
+
+async def on_upscale_failed(claim: ClaimedJob, error: Exception):
+    await staging.remove(claim.id)
+    await on_job_failed(claim, error)
+
+async def on_upscale_cancelled(claims: List[ClaimedJob]) -> bool:
+    return await upscale_backends().interrupt([claim.id for claim in claims])
+
+# Completion webhooks, delivered in the background with retries
+webhooks = WebhookDispatcher(SessionLocal)
+
+# Finished jobs past retention move to compressed files; lookups fall back to them
+job_archive = JobArchive(SessionLocal)
+
+async def find_job(db: AsyncSession, job_id: str) -> Optional[GenerationJob]:
+    """A job from the jobs table, or from the archive once retention has moved it"""
+    return await db.get(GenerationJob, job_id) or await job_archive.get(job_id)
+
+# Durable queue shared by every worker process
+job_queue = JobQueue(SessionLocal)
+scheduler = JobScheduler(
+    job_queue,
+    process_generation_job,
+    on_failure=on_job_failed,
+    on_start=on_job_started,
+    on_cancel=on_job_cancelled,
+    max_concurrent=backend_pool.capacity,
+    batch_handler=process_generation_batch,
+    preference=warm_characters
+)
+
+# Upscale stage of hires jobs, on its own queue and workers
+upscale_queue = JobQueue(SessionLocal, stage="upscale")
+upscale_scheduler = JobScheduler(
+    upscale_queue,
+    process_upscale_job,
+    on_failure=on_upscale_failed,
+    on_start=on_upscale_started,
+    on_cancel=on_upscale_cancelled,
+    max_concurrent=int(os.getenv('UPSCALE_WORKERS', 0)) or upscale_backends().capacity
+)
+
+def stage_scheduler(stage: Optional[str]) -> JobScheduler:
+    return upscale_scheduler if stage == "upscale" else scheduler
 
 # API Endpoints
 @app.post("/api/generate", response_model=GenerationResponse)
 async def generate_image(
     request: GenerateImageRequest,
-    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255),
     api_key: str = Depends(verify_api_key),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Generate images for a character"""
+    """Generate images for a character; retries with the same Idempotency-Key return the original job"""
+    request.hires = resolve_hires(request.hires, request.mode)
+    if idempotency_key:
+        # Keys are per client: another key's job is never returned
+        idempotency_key = f"{key_fingerprint(api_key)}:{idempotency_key}"
+        existing = await find_idempotent_job(db, idempotency_key, request)
+        if existing is not None:
+            return existing
+    
+    await check_callback(request)
+    await admit(api_key, 1, request.priority, images=request.batch_size)
+    
     # Create job
-    job_id = f"job_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}_{request.character_id}"
+    job_id = new_job_id(request.character_id)
     job = GenerationJob(
         id=job_id,
         character_id=request.character_id,
         status="pending",
-        prompt=f"Generating {request.focus} focused image for {request.character_id}"
+        prompt=f"Generating {request.focus} focused image for {request.character_id}",
+        request=request.model_dump(exclude=CALLBACK_FIELDS),
+        priority=request.priority,
+        coalesce_key=coalesce_key(request),
+        idempotency_key=idempotency_key,
+        mode=request.mode,
+        **callback_columns(request)
     )
     db.add(job)
-    db.commit()
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        # A concurrent retry with the same key got there first
+        existing = await find_idempotent_job(db, idempotency_key, request) if idempotency_key else None
+        if existing is None:
+            raise HTTPException(status_code=409, detail=f"Job {job_id} already exists")
+        return existing
     
-    # Queue background task
-    background_tasks.add_task(process_generation_job, job_id, request)
+    # Wake an idle worker
+    scheduler.notify()
+    job_events.publish_status(job_id, "pending")
     
     return GenerationResponse(
         job_id=job_id,
@@ -288,76 +803,498 @@ async def generate_image(
         message="Generation job queued successfully"
     )
 
+async def admit(api_key: str, jobs: int, priority: int, batch: bool = False, images: Optional[int] = None):
+    """
+    Refuse work with 429 and Retry-After when the key is over its rate
+    limit in jobs, or when the `images` the jobs generate (one per job by
+    default) could not finish within GENERATION_TIMEOUT, or for batches
+    start within ADMISSION_BATCH_MAX_WAIT_SECONDS; queued jobs of lower
+    priority do not count
+    """
+    try:
+        if admission.enabled(batch):
+            ahead, running = await job_queue.backlog(min_priority=priority)
+            admission.check(ahead, running, images or jobs, backend_pool.healthy_capacity, batch=batch)
+        rate_limiter.check(key_fingerprint(api_key), jobs)
+    except Rejected as e:
+        metrics.REJECTED.labels(reason=e.reason).inc()
+        raise HTTPException(status_code=429, detail=e.detail, headers={'Retry-After': str(e.retry_after)})
+
+def expand_batch(batch: GenerateBatchRequest) -> List[GenerateImageRequest]:
+    """Expand a job matrix into validated single-job requests"""
+    def options(values: List[Optional[str]], choices: List[str]) -> List[Optional[str]]:
+        return list(choices) if "*" in values else list(dict.fromkeys(values))
+    
+    character_ids = options(batch.character_ids, [c['id'] for c in character_registry.all()])
+    unknown = [character_id for character_id in character_ids if character_registry.get(character_id) is None]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown characters: {', '.join(unknown)}")
+    
+    requests = []
+    for character_id, focus, is_nude in itertools.product(
+        character_ids, dict.fromkeys(batch.focus), dict.fromkeys(batch.is_nude)
+    ):
+        poses = options(batch.poses, prompt_generator.poses_ass_focus if focus == 'ass' else prompt_generator.poses_tits_focus)
+        for scene, pose, lighting, accessory in itertools.product(
+            options(batch.scenes, prompt_generator.scenes),
+            poses,
+            options(batch.lightings, prompt_generator.lightings),
+            options(batch.accessories, prompt_generator.accessories)
+        ):
+            request = GenerateImageRequest(
+                character_id=character_id,
+                focus=focus,
+                is_nude=is_nude,
+                scene=scene,
+                pose=pose,
+                lighting=lighting,
+                accessory=accessory,
+                batch_size=batch.batch_size,
+                priority=batch.priority,
+                hires=resolve_hires(batch.hires, batch.mode),
+                mode=batch.mode
+            )
+            requests.extend([request] * batch.count)
+            if len(requests) > BATCH_MAX_JOBS:
+                raise HTTPException(status_code=422, detail=f"Batch expands to more than {BATCH_MAX_JOBS} jobs")
+    return requests
+
+@app.post("/api/generate/batch", response_model=BatchGenerationResponse)
+async def generate_batch(
+    batch: GenerateBatchRequest,
+    api_key: str = Depends(verify_api_key),
+    db: AsyncSession = Depends(get_db)
+):
+    """Queue every combination of a job matrix in one transaction"""
+    await check_callback(batch)
+    requests = expand_batch(batch)
+    await admit(api_key, len(requests), batch.priority, batch=True, images=sum(r.batch_size for r in requests))
+    jobs = [
+        GenerationJob(
+            id=new_job_id(request.character_id),
+            character_id=request.character_id,
+            status="pending",
+            prompt=f"Generating {request.focus} focused image for {request.character_id}",
+            request=request.model_dump(),
+            priority=request.priority,
+            coalesce_key=coalesce_key(request),
+            mode=request.mode,
+            **callback_columns(batch)
+        )
+        for request in requests
+    ]
+    db.add_all(jobs)
+    await db.commit()
+    
+    scheduler.notify()
+    for job in jobs:
+        job_events.publish_status(job.id, "pending")
+    
+    return BatchGenerationResponse(
+        job_ids=[job.id for job in jobs],
+        status="pending",
+        message=f"{len(jobs)} generation jobs queued successfully"
+    )
+
+async def find_idempotent_job(
+    db: AsyncSession,
+    idempotency_key: str,
+    request: GenerateImageRequest
+) -> Optional[GenerationResponse]:
+    job = (await db.execute(
+        select(GenerationJob.id, GenerationJob.status, GenerationJob.request)
+        .where(GenerationJob.idempotency_key == idempotency_key)
+    )).one_or_none()
+    if job is None:
+        return None
+    if job.request != request.model_dump(exclude=CALLBACK_FIELDS):
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    return GenerationResponse(
+        job_id=job.id,
+        status=job.status,
+        message="Existing job for this Idempotency-Key"
+    )
+
+@app.post("/api/jobs/{job_id}/refine", response_model=BatchGenerationResponse)
+async def refine_draft(
+    job_id: str,
+    refine: RefineRequest,
+    api_key: str = Depends(verify_api_key),
+    db: AsyncSession = Depends(get_db)
+):
+    """Queue a full-quality job for each selected seed of a completed draft, with the draft's prompt"""
+    draft = await find_job(db, job_id)
+    if draft is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if draft.mode != "draft":
+        raise HTTPException(status_code=422, detail="Only draft jobs can be refined")
+    if draft.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Draft is {draft.status}, not completed")
+    
+    draft_seeds = [image.get('seed') for image in draft.result.get('images', []) if image.get('seed') is not None]
+    seeds = list(dict.fromkeys(refine.seeds or draft_seeds))
+    unknown = [seed for seed in seeds if seed not in draft_seeds]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Seeds not in draft {job_id}: {', '.join(map(str, unknown))}")
+    if not seeds:
+        raise HTTPException(status_code=422, detail="Draft has no recorded seeds")
+    
+    await check_callback(refine)
+    await admit(api_key, len(seeds), refine.priority, batch=True)
+    base = GenerateImageRequest(**draft.request)
+    jobs = []
+    for seed in seeds:
+        request = base.model_copy(update={
+            'seed': seed,
+            'batch_size': 1,
+            'priority': refine.priority,
+            'mode': "full",
+            'hires': resolve_hires(refine.hires)
+        })
+        jobs.append(GenerationJob(
+            id=new_job_id(request.character_id),
+            character_id=request.character_id,
+            status="pending",
+            prompt=f"Refining draft {job_id} seed {seed}",
+            request=request.model_dump(),
+            priority=request.priority,
+            mode=request.mode,
+            refined_from=job_id,
+            # The seed only reproduces the draft together with the draft's prompt
+            stage_data={'prompt': draft.result.get('prompt'), 'tags': draft.tags, 'refined_from': job_id},
+            **callback_columns(refine)
+        ))
+    db.add_all(jobs)
+    await db.commit()
+    
+    scheduler.notify()
+    for job in jobs:
+        job_events.publish_status(job.id, "pending")
+    
+    return BatchGenerationResponse(
+        job_ids=[job.id for job in jobs],
+        status="pending",
+        message=f"{len(jobs)} refine jobs queued for draft {job_id}"
+    )
+
 @app.get("/api/status/{job_id}", response_model=JobStatus)
 async def get_job_status(
     job_id: str,
     api_key: str = Depends(verify_api_key),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get status of a generation job"""
-    job = db.query(GenerationJob).filter(GenerationJob.id == job_id).first()
+    job = await find_job(db, job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
+    job_scheduler = stage_scheduler(job.stage)
     
-    # Get progress from SD API if processing
-    progress = 0.0
+    # Progress comes from the shared poller's snapshot of the job's backend;
+    # jobs waiting behind another on the same backend report 0
+    progress, eta = 0.0, None
     if job.status == "processing":
-        try:
-            sd_progress = await sd_client.get_progress()
-            progress = sd_progress.get('progress', 0.0)
-        except:
-            progress = 0.5
+        snapshot = progress_monitor.snapshot_for(job.id)
+        if snapshot is not None:
+            progress, eta = snapshot.progress, snapshot.eta_relative
     elif job.status == "completed":
         progress = 1.0
     
     return JobStatus(
         job_id=job.id,
         status=job.status,
+        stage=job.stage,
         progress=progress,
+        eta=eta,
         result=job.result,
-        error=job.error_message
+        error=job.error_message,
+        queue_position=await job_scheduler.position(job.id) if job.status == "pending" else None,
+        queue_depth=await job_scheduler.depth(),
+        timings=job.timings,
+        mode=job.mode,
+        refined_from=job.refined_from,
+        gpu_seconds=job.gpu_seconds,
+        gpu_seconds_saved=job.gpu_seconds_saved,
+        callback={
+            'url': job.callback_url,
+            'status': job.callback_status,
+            'attempts': job.callback_attempts or 0,
+            'error': job.callback_error,
+            'delivered_at': job.callback_delivered_at.isoformat() if job.callback_delivered_at else None
+        } if job.callback_url else None
+    )
+
+def sse_message(event: Dict[str, Any]) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+async def load_job_event(job_id: str) -> Optional[Dict[str, Any]]:
+    """Current job status as a status event, read from the database or, once archived, the archive"""
+    async with SessionLocal() as db:
+        job = (await db.execute(
+            select(GenerationJob.status, GenerationJob.result, GenerationJob.error_message)
+            .where(GenerationJob.id == job_id)
+        )).first()
+    if job is None:
+        job = await job_archive.get(job_id)
+    if job is None:
+        return None
+    event = {"type": "status", "job_id": job_id, "status": job.status}
+    if job.status == "completed":
+        event.update(progress=1.0, result=job.result)
+    elif job.status == "failed":
+        event["error"] = job.error_message
+    return event
+
+@app.post("/api/jobs/{job_id}/stream-token")
+async def create_stream_token(
+    job_id: str,
+    api_key: str = Depends(verify_api_key)
+):
+    """Short-lived token for /api/jobs/{job_id}/events, for clients that cannot send headers"""
+    if await load_job_event(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return issue_stream_token(job_id)
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(
+    job_id: str,
+    preview: bool = False,
+    api_key: Optional[str] = Depends(verify_stream_key)
+):
+    """
+    Server-sent events for one job: status transitions and progress
+    (with live previews when `preview` is set and enabled on the server),
+    ending once the job finishes or disappears. Archived jobs send their
+    final status.
+    """
+    if await load_job_event(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    keepalive = float(os.getenv('SSE_KEEPALIVE_SECONDS', 15))
+    
+    async def stream():
+        with job_events.subscribe(job_id) as queue:
+            # Read after subscribing so no transition in between is lost
+            event = await load_job_event(job_id)
+            if event is None:
+                return
+            status = event["status"]
+            yield sse_message(event)
+            while status not in TERMINAL_STATUSES:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    # The job may run in another worker process; fall back to the database
+                    event = await load_job_event(job_id)
+                    if event is None:
+                        # Deleted, or archived with its file missing
+                        return
+                    if event["status"] == status:
+                        yield ": keepalive\n\n"
+                        continue
+                if event["type"] == "status":
+                    if event["status"] == status:
+                        continue
+                    status = event["status"]
+                elif not preview and "preview" in event:
+                    event = {key: value for key, value in event.items() if key != "preview"}
+                yield sse_message(event)
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        # Content-Encoding keeps GZipMiddleware from buffering the stream
+        headers={"Cache-Control": "no-cache", "Content-Encoding": "identity", "X-Accel-Buffering": "no"}
     )
 
 @app.get("/api/characters")
 async def list_characters(
-    api_key: str = Depends(verify_api_key),
-    db: Session = Depends(get_db)
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    api_key: str = Depends(verify_api_key)
 ):
-    """List all available characters"""
-    with open('../config/characters.json', 'r') as f:
-        characters = json.load(f)
-    return characters
+    """List all available characters; honours If-None-Match"""
+    etag = character_registry.etag
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return character_registry.data
+
+# Fields /api/jobs can return; `result` is large, so it is opt-in via fields=
+JOB_FIELDS = {
+    "id": GenerationJob.id,
+    "character_id": GenerationJob.character_id,
+    "status": GenerationJob.status,
+    "stage": GenerationJob.stage,
+    "created_at": GenerationJob.created_at,
+    "completed_at": GenerationJob.completed_at,
+    "tags": GenerationJob.tags,
+    "error": GenerationJob.error_message,
+    "prompt": GenerationJob.prompt,
+    "priority": GenerationJob.priority,
+    "attempts": GenerationJob.attempts,
+    "result": GenerationJob.result,
+    "timings": GenerationJob.timings,
+    "mode": GenerationJob.mode,
+    "refined_from": GenerationJob.refined_from,
+    "gpu_seconds": GenerationJob.gpu_seconds,
+    "gpu_seconds_saved": GenerationJob.gpu_seconds_saved,
+}
+DEFAULT_JOB_FIELDS = ["id", "character_id", "status", "created_at", "completed_at", "tags", "error"]
+
+def encode_cursor(created_at: datetime, job_id: str) -> str:
+    raw = json.dumps([created_at.isoformat(), job_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, job_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), job_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 @app.get("/api/jobs")
 async def list_jobs(
+    response: Response,
     character_id: Optional[str] = None,
     status: Optional[str] = None,
-    limit: int = 50,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
     api_key: str = Depends(verify_api_key),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """List generation jobs with optional filters"""
-    query = db.query(GenerationJob)
+    """
+    List generation jobs with optional filters, newest first.
+    Pass the X-Next-Cursor response header back as `cursor` for the next page;
+    `fields` is a comma-separated projection (defaults exclude `result`).
+    """
+    selected = [f.strip() for f in fields.split(',') if f.strip()] if fields else DEFAULT_JOB_FIELDS
+    unknown = [f for f in selected if f not in JOB_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    
+    columns = {name: JOB_FIELDS[name] for name in selected}
+    # Keyset columns are always needed to build the next cursor
+    query = select(*columns.values(), GenerationJob.created_at.label('_created_at'), GenerationJob.id.label('_id'))
     
     if character_id:
-        query = query.filter(GenerationJob.character_id == character_id)
+        query = query.where(GenerationJob.character_id == character_id)
     if status:
-        query = query.filter(GenerationJob.status == status)
-    
-    jobs = query.order_by(GenerationJob.created_at.desc()).limit(limit).all()
-    
-    return [
-        {
-            "id": job.id,
-            "character_id": job.character_id,
-            "status": job.status,
-            "created_at": job.created_at.isoformat(),
-            "completed_at": job.completed_at.isoformat() if job.completed_at else None,
-            "tags": job.tags,
-            "error": job.error_message
+        query = query.where(GenerationJob.status == status)
+    if cursor:
+        cursor_created_at, cursor_id = decode_cursor(cursor)
+        query = query.where(or_(
+            GenerationJob.created_at < cursor_created_at,
+            and_(GenerationJob.created_at == cursor_created_at, GenerationJob.id < cursor_id)
+        ))
+    
+    query = query.order_by(GenerationJob.created_at.desc(), GenerationJob.id.desc()).limit(limit + 1)
+    rows = (await db.execute(query)).all()
+    
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1]._created_at, rows[-1]._id)
+    
+    jobs = []
+    for row in rows:
+        job = {}
+        for name, value in zip(columns, row):
+            job[name] = value.isoformat() if isinstance(value, datetime) else value
+        jobs.append(job)
+    return jobs
+
+@app.on_event("startup")
+async def startup():
+    await ensure_schema()
+    await backend_pool.start()
+    if upscale_pool is not None:
+        await upscale_pool.start()
+    await progress_monitor.start()
+    await webhooks.start()
+    await job_archive.start()
+    await scheduler.start()
+    await upscale_scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await scheduler.stop()
+    await upscale_scheduler.stop()
+    await webhooks.stop()
+    await job_archive.stop()
+    await image_processor.close()
+    await progress_monitor.stop()
+    await storage.close()
+    await backend_pool.close()
+    if upscale_pool is not None:
+        await upscale_pool.close()
+    await engine.dispose()
+
+@app.delete("/api/jobs/{job_id}", response_model=GenerationResponse)
+async def cancel_job(
+    job_id: str,
+    api_key: str = Depends(verify_api_key)
+):
+    """Cancel a job; a running job's generation is interrupted on its backend"""
+    previous = await job_queue.cancel(job_id)
+    if previous is None:
+        async with SessionLocal() as db:
+            job = await find_job(db, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        raise HTTPException(status_code=409, detail=f"Job already {job.status}")
+    
+    # The worker running the job interrupts its backend call, if the WebUI is
+    # executing it. Workers in other processes see their lease disappear and
+    # do the same; either way the lease guard discards any partial images.
+    interrupted = False
+    if previous == "processing":
+        interrupted = await scheduler.cancel(job_id) or await upscale_scheduler.cancel(job_id)
+    await staging.remove(job_id)
+    
+    job_events.publish_status(job_id, "cancelled")
+    webhooks.notify(job_id)
+    return GenerationResponse(
+        job_id=job_id,
+        status="cancelled",
+        message="Generation interrupted" if interrupted else "Job cancelled"
+    )
+
+@app.get("/api/queue")
+async def queue_stats(api_key: str = Depends(verify_api_key)):
+    """Current scheduler load; `upscale` is the hires stage"""
+    return {
+        "queue_depth": await scheduler.depth(),
+        "in_flight": scheduler.in_flight,
+        "max_concurrent": scheduler.max_concurrent,
+        "upscale": {
+            "queue_depth": await upscale_scheduler.depth(),
+            "in_flight": upscale_scheduler.in_flight,
+            "max_concurrent": upscale_scheduler.max_concurrent
         }
-        for job in jobs
+    }
+
+@app.get("/api/backends")
+async def list_backends(api_key: str = Depends(verify_api_key)):
+    """Load, health and current progress of each SD backend"""
+    snapshots = {snapshot["backend"]: snapshot for snapshot in progress_monitor.status()}
+    backends = [
+        {**backend, "current": snapshots.get(backend["url"])}
+        for backend in backend_pool.status()
     ]
+    if upscale_pool is not None:
+        backends += [{**backend, "stage": "upscale"} for backend in upscale_pool.status()]
+    return backends
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: stage latencies, queue depth, backend load and failures"""
+    body = metrics.render(
+        queue_depth=await scheduler.depth() + await upscale_scheduler.depth(),
+        in_flight=scheduler.in_flight + upscale_scheduler.in_flight,
+        backends=backend_pool.status() + (upscale_pool.status() if upscale_pool is not None else [])
+    )
+    # The content type already names its charset
+    return Response(content=body, headers={'Content-Type': metrics.CONTENT_TYPE_LATEST})
 
 @app.get("/health")
 async def health_check():
@@ -0,0 +1,182 @@
+"""
+HTTP client for a single Stable Diffusion WebUI backend
+"""
+
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+from api.sd_stream import Txt2ImgResult, Txt2ImgStreamParser
+
+
+def load_sd_auth(api_key: Optional[str] = None) -> Optional[Tuple[str, str]]:
+    """Parse a `user:password` WebUI API key (defaults to SD_API_KEY)"""
+    api_key = api_key if api_key is not None else os.getenv('SD_API_KEY')
+    if not api_key or ':' not in api_key:
+        return None
+    user, password = api_key.split(':', 1)
+    return user, password
+
+
+class SDAPIClient:
+    """
+    Long-lived client for a single SD WebUI backend.
+
+    Generation and progress calls use separate connection pools so a slow
+    txt2img request can never starve status polling.
+    """
+
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        auth: Optional[Tuple[str, str]] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.base_url = (base_url or os.getenv('SD_API_URL', 'http://localhost:7860')).rstrip('/')
+        self.auth = auth
+        self.transport = transport  # custom transport, e.g. a simulated backend in benchmarks
+        self.timeout = float(os.getenv('SD_API_TIMEOUT', 600))
+        self.progress_timeout = float(os.getenv('SD_PROGRESS_TIMEOUT', 5))
+        self.connect_timeout = float(os.getenv('SD_CONNECT_TIMEOUT', 10))
+        self.keepalive_expiry = float(os.getenv('SD_KEEPALIVE_EXPIRY', 60))
+        self.max_connections = int(os.getenv('SD_MAX_CONNECTIONS', 4))
+        self.progress_max_connections = int(os.getenv('SD_PROGRESS_MAX_CONNECTIONS', 2))
+        # Decoded images above this size spill from memory to disk
+        self.spool_max_size = int(os.getenv('SD_SPOOL_MAX_BYTES', 1024 * 1024))
+        self._generation_client: Optional[httpx.AsyncClient] = None
+        self._progress_client: Optional[httpx.AsyncClient] = None
+
+    def _build_client(self, max_connections: int, read_timeout: float) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            auth=self.auth,
+            transport=self.transport,
+            timeout=httpx.Timeout(read_timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=self.keepalive_expiry
+            )
+        )
+
+    async def start(self):
+        """Open the connection pools (called on app startup)"""
+        if self._generation_client is None:
+            self._generation_client = self._build_client(self.max_connections, self.timeout)
+        if self._progress_client is None:
+            self._progress_client = self._build_client(self.progress_max_connections, self.progress_timeout)
+
+    async def close(self):
+        """Close the connection pools (called on app shutdown)"""
+        for client in (self._generation_client, self._progress_client):
+            if client is not None:
+                await client.aclose()
+        self._generation_client = None
+        self._progress_client = None
+
+    @staticmethod
+    def default_payload(prompt: str, negative_prompt: str, **kwargs) -> Dict[str, Any]:
+        """txt2img payload using the DEFAULT_* generation settings"""
+        return {
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "steps": int(os.getenv('DEFAULT_STEPS', 50)),
+            "sampler_name": os.getenv('DEFAULT_SAMPLER', 'DPM++ 2M Karras'),
+            "cfg_scale": float(os.getenv('DEFAULT_CFG_SCALE', 7.5)),
+            "width": kwargs.get('width', int(os.getenv('DEFAULT_WIDTH', 1024))),
+            "height": kwargs.get('height', int(os.getenv('DEFAULT_HEIGHT', 1024))),
+            "batch_size": kwargs.get('batch_size', 1),
+            "seed": kwargs.get('seed', -1),
+        }
+
+    async def _generate(self, path: str, payload: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        if self._generation_client is None:
+            await self.start()
+
+        response = await self._generation_client.post(
+            path,
+            json=payload,
+            timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def txt2img(self, payload: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        return await self._generate("/sdapi/v1/txt2img", payload, timeout)
+
+    async def img2img(self, payload: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        return await self._generate("/sdapi/v1/img2img", payload, timeout)
+
+    async def extra_single_image(self, payload: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Upscale one image without sampling (the WebUI's Extras tab)"""
+        return await self._generate("/sdapi/v1/extra-single-image", payload, timeout)
+
+    async def txt2img_stream(self, payload: Dict[str, Any], timeout: Optional[float] = None) -> Txt2ImgResult:
+        """txt2img with the response decoded incrementally into temporary files"""
+        if self._generation_client is None:
+            await self.start()
+
+        parser = Txt2ImgStreamParser(self.spool_max_size)
+        decode_seconds = 0.0
+        try:
+            async with self._generation_client.stream(
+                "POST",
+                "/sdapi/v1/txt2img",
+                json=payload,
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+            ) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    started = time.perf_counter()
+                    parser.feed(chunk)
+                    decode_seconds += time.perf_counter() - started
+        except BaseException:
+            parser.abort()
+            raise
+        started = time.perf_counter()
+        result = parser.close()
+        result.decode_seconds = decode_seconds + time.perf_counter() - started
+        return result
+
+    async def generate_image(self, prompt: str, negative_prompt: str, timeout: Optional[float] = None, **kwargs):
+        payload = self.default_payload(prompt, negative_prompt, **kwargs)
+        return await self.txt2img(payload, timeout=timeout)
+
+    async def interrupt(self, timeout: Optional[float] = None):
+        """Stop the generation the WebUI is currently running"""
+        if self._progress_client is None:
+            await self.start()
+
+        # The progress pool is never held by a long-running request
+        response = await self._progress_client.post(
+            "/sdapi/v1/interrupt",
+            timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+        )
+        response.raise_for_status()
+
+    async def task_active(self, task_id: str, timeout: Optional[float] = None) -> bool:
+        """Whether the WebUI is executing the call submitted with `force_task_id=task_id`"""
+        if self._progress_client is None:
+            await self.start()
+
+        response = await self._progress_client.post(
+            "/internal/progress",
+            json={"id_task": task_id, "live_preview": False},
+            timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+        )
+        response.raise_for_status()
+        return bool(response.json().get('active'))
+
+    async def get_progress(self, timeout: Optional[float] = None, skip_current_image: bool = True):
+        if self._progress_client is None:
+            await self.start()
+
+        response = await self._progress_client.get(
+            "/sdapi/v1/progress",
+            params={"skip_current_image": str(skip_current_image).lower()},
+            timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+        )
+        response.raise_for_status()
+        return response.json()
@@ -0,0 +1,161 @@
+"""
+Streaming decoder for txt2img responses
+A batch of 1024x1024 images is a multi-megabyte JSON body; this parses it
+as it arrives and decodes each base64 image straight into a spooled
+temporary file, so a job never holds the whole body or every decoded image
+in memory at once
+"""
+
+import binascii
+import json
+import tempfile
+from dataclasses import dataclass, field
+from typing import Any, Dict, IO, List
+
+QUOTE = ord('"')
+BACKSLASH = ord('\\')
+COLON = ord(':')
+OPENERS = (ord('{'), ord('['))
+CLOSERS = (ord('}'), ord(']'))
+
+
+@dataclass
+class Txt2ImgResult:
+    """Decoded txt2img response; `images` are rewound binary files"""
+    images: List[IO[bytes]] = field(default_factory=list)
+    parameters: Dict[str, Any] = field(default_factory=dict)
+    info: Any = None
+    decode_seconds: float = 0.0  # time spent parsing and decoding, excluding network waits
+
+    def close(self):
+        for image in self.images:
+            image.close()
+
+    def __enter__(self) -> "Txt2ImgResult":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _Base64Sink:
+    """Incremental base64 decoder writing into a spooled temporary file"""
+
+    def __init__(self, spool_max_size: int):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+        self._carry = b''
+
+    def write(self, data: memoryview):
+        if self._carry:
+            need = 4 - len(self._carry)
+            head = self._carry + bytes(data[:need])
+            data = data[need:]
+            if len(head) < 4:
+                self._carry = head
+                return
+            self.file.write(binascii.a2b_base64(head))
+            self._carry = b''
+        aligned = len(data) - len(data) % 4
+        if aligned:
+            self.file.write(binascii.a2b_base64(data[:aligned]))
+        self._carry = bytes(data[aligned:])
+
+    def finish(self) -> IO[bytes]:
+        if self._carry:
+            raise ValueError("Truncated base64 image data in txt2img response")
+        self.file.seek(0)
+        return self.file
+
+
+class Txt2ImgStreamParser:
+    """
+    Incremental parser for `{"images": [...], "parameters": {...}, "info": ...}`.
+
+    Everything except the image strings is copied into a small skeleton
+    document that is parsed with json at the end. Image strings are found
+    with a single bytes.find per chunk and decoded through memoryviews
+    rather than walked byte by byte.
+    """
+
+    def __init__(self, spool_max_size: int = 1024 * 1024):
+        self.spool_max_size = spool_max_size
+        self.images: List[IO[bytes]] = []
+        self._skeleton = bytearray()
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string = bytearray()  # current top-level string, kept to recognise keys
+        self._last_string = b''
+        self._key = b''
+        self._image = None
+
+    def feed(self, chunk: bytes):
+        view = memoryview(chunk)
+        pos, end = 0, len(chunk)
+        while pos < end:
+            if self._image is not None:
+                close = chunk.find(b'"', pos)
+                stop = end if close == -1 else close
+                if chunk.find(b'\\', pos, stop) != -1:
+                    raise ValueError("Escaped characters in txt2img image data are not supported")
+                self._image.write(view[pos:stop])
+                if close == -1:
+                    return
+                self.images.append(self._image.finish())
+                self._image = None
+                pos = close + 1
+                continue
+
+            byte = chunk[pos]
+            pos += 1
+
+            if self._in_string:
+                self._skeleton.append(byte)
+                if self._escape:
+                    self._escape = False
+                elif byte == BACKSLASH:
+                    self._escape = True
+                elif byte == QUOTE:
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = bytes(self._string)
+                    continue
+                if self._depth == 1:
+                    self._string.append(byte)
+                continue
+
+            if byte == QUOTE:
+                if self._depth == 2 and self._key == b'images':
+                    self._image = _Base64Sink(self.spool_max_size)
+                    self._skeleton += b'null'
+                    continue
+                self._in_string = True
+                self._string.clear()
+            elif byte in OPENERS:
+                self._depth += 1
+            elif byte in CLOSERS:
+                self._depth -= 1
+            elif byte == COLON and self._depth == 1:
+                self._key = self._last_string
+            self._skeleton.append(byte)
+
+    def close(self) -> Txt2ImgResult:
+        """Finish parsing; the caller owns the returned image files"""
+        if self._image is not None or self._depth:
+            self.abort()
+            raise ValueError("Truncated txt2img response")
+        document = json.loads(self._skeleton)
+        return Txt2ImgResult(
+            images=self.images,
+            parameters=document.get('parameters') or {},
+            info=document.get('info')
+        )
+
+    def abort(self):
+        """Discard any images decoded so far"""
+        if self._image is not None:
+            self._image.file.close()
+            self._image = None
+        for image in self.images:
+            image.close()
+        self.images = []
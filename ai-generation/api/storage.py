@@ -0,0 +1,111 @@
+"""
+S3 storage for generated images
+boto3 is blocking, so uploads run on a bounded thread pool and are retried
+with exponential backoff
+"""
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Optional, Union
+
+from botocore.exceptions import NoCredentialsError
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(RuntimeError):
+    """None of a job's images could be stored"""
+
+
+class ImageStorage:
+    """
+    Uploads to S3 without blocking the event loop.
+
+    At most `max_workers` uploads run at once; callers can gather as many
+    as they like. A failed put is retried `retry_attempts` times in total
+    with exponential backoff; missing credentials are not retried.
+    """
+
+    def __init__(
+        self,
+        bucket: Optional[str] = None,
+        max_workers: Optional[int] = None,
+        retry_attempts: Optional[int] = None,
+        retry_backoff: Optional[float] = None,
+        client=None
+    ):
+        self.bucket = bucket or os.getenv('S3_BUCKET_IMAGES')
+        self.max_workers = max_workers or int(os.getenv('S3_UPLOAD_WORKERS', 8))
+        self.retry_attempts = max(1, retry_attempts or int(os.getenv('S3_UPLOAD_RETRIES', 3)))
+        self.retry_backoff = retry_backoff if retry_backoff is not None else float(os.getenv('S3_UPLOAD_BACKOFF', 0.5))
+        self._client = client
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def client(self):
+        """boto3 S3 client, created on first use so importing the API stays cheap"""
+        if self._client is None:
+            import boto3
+            from botocore.config import Config
+            self._client = boto3.client(
+                's3',
+                region_name=os.getenv('AWS_REGION'),
+                endpoint_url=os.getenv('S3_ENDPOINT_URL') or None,  # e.g. a local MinIO
+                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+                config=Config(max_pool_connections=self.max_workers)
+            )
+        return self._client
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="s3-upload")
+        return self._executor
+
+    async def close(self):
+        """Wait for in-flight uploads and stop the thread pool (called on app shutdown)"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _put(self, bucket: str, key: str, data: Union[bytes, BinaryIO], content_type: str, metadata: Dict[str, str]):
+        if hasattr(data, 'seek'):
+            data.seek(0)  # file bodies are re-read on retries
+        self.client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=data,
+            ContentType=content_type,
+            Metadata=metadata
+        )
+
+    async def upload(
+        self,
+        data: Union[bytes, BinaryIO],
+        key: str,
+        metadata: Optional[Dict[str, str]] = None,
+        content_type: str = 'image/png',
+        bucket: Optional[str] = None
+    ) -> str:
+        """Upload bytes or a binary file and return its s3:// URL"""
+        bucket = bucket or self.bucket
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, self.retry_attempts + 1):
+            try:
+                await loop.run_in_executor(
+                    self.executor, self._put, bucket, key, data, content_type, metadata or {}
+                )
+                return f"s3://{bucket}/{key}"
+            except NoCredentialsError:
+                logger.error("S3 credentials not found")
+                raise
+            except Exception as e:
+                if attempt == self.retry_attempts:
+                    logger.error(f"S3 upload of {key} failed after {attempt} attempt(s): {e}")
+                    raise
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                logger.warning(f"S3 upload of {key} failed ({e}); retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
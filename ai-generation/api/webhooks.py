@@ -0,0 +1,280 @@
+"""
+Completion webhooks for generation jobs
+When a job with a callback URL finishes, its final status is POSTed to that
+URL, signed with the job's HMAC secret. Deliveries go through a bounded
+queue, are retried with exponential backoff, and are recorded on the job
+"""
+
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Set
+from urllib.parse import urlsplit
+
+import httpx
+from sqlalchemy import or_, select, update
+
+from api.database import GenerationJob
+from api.events import TERMINAL_STATUSES
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "X-Webhook-Signature"
+TIMESTAMP_HEADER = "X-Webhook-Timestamp"
+
+
+def sign(secret: str, timestamp: str, body: bytes) -> str:
+    """`sha256=<hex>` HMAC of `<timestamp>.<body>`; receivers recompute it to verify"""
+    digest = hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def is_public_address(address: str) -> bool:
+    """False for loopback, private, link-local (cloud metadata), reserved and multicast addresses"""
+    ip = ipaddress.ip_address(address)
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+async def callback_refusal(url: str, allowed_hosts: Optional[str] = None) -> Optional[str]:
+    """
+    Why a callback URL must not be called, or None if it may be. Hosts in
+    WEBHOOK_ALLOWED_HOSTS (comma separated) are allowed as listed, internal
+    ones included. Without the list, only hosts that resolve exclusively to
+    public addresses are, so callbacks cannot reach the API's own network.
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    if parts.scheme not in ('http', 'https') or not host:
+        return "callback_url must be an http(s) URL with a host"
+    allowed_hosts = allowed_hosts if allowed_hosts is not None else os.getenv('WEBHOOK_ALLOWED_HOSTS', '')
+    hosts = {allowed.strip().lower() for allowed in allowed_hosts.split(',') if allowed.strip()}
+    if hosts:
+        return None if host in hosts else f"callback_url host {host} is not in WEBHOOK_ALLOWED_HOSTS"
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, ValueError):
+        return f"callback_url host {host} does not resolve"
+    if not addresses or not all(is_public_address(address[4][0]) for address in addresses):
+        return f"callback_url host {host} is not a public address"
+    return None
+
+
+class WebhookDispatcher:
+    """
+    Delivers completion webhooks from a queue of at most `max_queue` jobs,
+    `max_concurrent` at a time.
+
+    A delivery that fails with a network error, a 429 or a 5xx is retried
+    up to `retry_attempts` times in total, `retry_backoff * 2 ** n` seconds
+    apart; other 4xx responses fail it at once. Each attempt first takes a
+    short lease on the job's delivery with a conditional UPDATE, so several
+    worker processes never send the same webhook concurrently. Deliveries
+    that were due while the queue was full or the process was down are
+    picked up by a periodic sweep. Receivers should deduplicate on
+    X-Webhook-Id: delivery is at least once.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        max_queue: Optional[int] = None,
+        max_concurrent: Optional[int] = None,
+        retry_attempts: Optional[int] = None,
+        retry_backoff: Optional[float] = None,
+        timeout: Optional[float] = None,
+        sweep_interval: Optional[float] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.session_factory = session_factory
+        self.max_queue = max_queue or int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+        self.max_concurrent = max_concurrent or int(os.getenv('WEBHOOK_WORKERS', 4))
+        self.retry_attempts = max(1, retry_attempts or int(os.getenv('WEBHOOK_RETRY_ATTEMPTS', 5)))
+        self.retry_backoff = retry_backoff if retry_backoff is not None else float(os.getenv('WEBHOOK_BACKOFF_SECONDS', 2))
+        self.timeout = timeout or float(os.getenv('WEBHOOK_TIMEOUT_SECONDS', 10))
+        self.sweep_interval = sweep_interval or float(os.getenv('WEBHOOK_SWEEP_INTERVAL', 30))
+        self.transport = transport
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[str] = set()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._tasks = []
+        self._timers: Set[asyncio.TimerHandle] = set()
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._client = httpx.AsyncClient(timeout=self.timeout, transport=self.transport, follow_redirects=False)
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"webhook-worker-{i}")
+            for i in range(self.max_concurrent)
+        ]
+        self._tasks.append(asyncio.create_task(self._sweeper(), name="webhook-sweeper"))
+
+    async def stop(self):
+        """Stop delivering; undelivered webhooks stay pending for the next start"""
+        for timer in self._timers:
+            timer.cancel()
+        self._timers.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queued.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def notify(self, job_id: str) -> bool:
+        """Queue a finished job's webhook; False if the queue is full (the sweep retries it)"""
+        if self._queue is None or job_id in self._queued:
+            return False
+        try:
+            self._queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            logger.warning(f"Webhook queue full; delivery for job {job_id} deferred to the sweep")
+            return False
+        self._queued.add(job_id)
+        return True
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _retry_later(self, job_id: str, delay: float):
+        def fire():
+            self._timers.discard(timer)
+            self.notify(job_id)
+        # A little late, so the attempt is due by the database clock too
+        timer = asyncio.get_running_loop().call_later(delay + 0.1, fire)
+        self._timers.add(timer)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            try:
+                await self._deliver(job_id)
+            except Exception as e:
+                logger.error(f"Webhook delivery for job {job_id} crashed: {e}")
+
+    async def _sweeper(self):
+        while True:
+            try:
+                async with self.session_factory() as db:
+                    due = (await db.execute(
+                        select(GenerationJob.id)
+                        .where(
+                            GenerationJob.callback_status == "pending",
+                            GenerationJob.status.in_(TERMINAL_STATUSES),
+                            or_(GenerationJob.callback_next_at.is_(None), GenerationJob.callback_next_at <= datetime.utcnow())
+                        )
+                        .order_by(GenerationJob.callback_next_at)
+                        .limit(self.max_queue)
+                    )).scalars().all()
+                for job_id in due:
+                    if self._queue.full():
+                        break
+                    self.notify(job_id)
+            except Exception as e:
+                logger.error(f"Webhook sweep failed: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def _lease(self, job_id: str) -> Optional[Any]:
+        """Take the job's delivery for one attempt; None if it is not due or someone else has it"""
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            leased = (await db.execute(
+                update(GenerationJob)
+                .where(
+                    GenerationJob.id == job_id,
+                    GenerationJob.status.in_(TERMINAL_STATUSES),
+                    GenerationJob.callback_status == "pending",
+                    or_(GenerationJob.callback_next_at.is_(None), GenerationJob.callback_next_at <= now)
+                )
+                .values(callback_next_at=now + timedelta(seconds=self.timeout * 2))
+                .execution_options(synchronize_session=False)
+            )).rowcount
+            await db.commit()
+            if not leased:
+                return None
+            return (await db.execute(
+                select(
+                    GenerationJob.id, GenerationJob.status, GenerationJob.result, GenerationJob.error_message,
+                    GenerationJob.timings, GenerationJob.completed_at, GenerationJob.callback_url,
+                    GenerationJob.callback_secret, GenerationJob.callback_attempts
+                )
+                .where(GenerationJob.id == job_id)
+            )).first()
+
+    @staticmethod
+    def payload(job) -> Dict[str, Any]:
+        return {
+            "event": f"job.{job.status}",
+            "job_id": job.id,
+            "status": job.status,
+            "result": job.result,
+            "error": job.error_message,
+            "timings": job.timings,
+            "completed_at": job.completed_at.isoformat() if job.completed_at else None,
+        }
+
+    async def _deliver(self, job_id: str):
+        job = await self._lease(job_id)
+        if job is None:
+            return
+        attempt = (job.callback_attempts or 0) + 1
+        body = json.dumps(self.payload(job), default=str).encode()
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            "X-Webhook-Id": job.id,
+            TIMESTAMP_HEADER: timestamp,
+            SIGNATURE_HEADER: sign(job.callback_secret or "", timestamp, body),
+        }
+
+        # Checked again on every attempt: DNS may have changed since submission
+        error, retryable = await callback_refusal(job.callback_url), False
+        if error is None:
+            retryable = True
+            try:
+                # Redirects are not followed, so they cannot lead to an internal host
+                response = await self._client.post(job.callback_url, content=body, headers=headers)
+                if response.status_code >= 300:
+                    error = f"HTTP {response.status_code}"
+                    retryable = response.status_code == 429 or response.status_code >= 500
+            except httpx.HTTPError as e:
+                error = f"{type(e).__name__}: {e}"
+
+        values: Dict[str, Any] = {"callback_attempts": attempt, "callback_error": error}
+        if error is None:
+            values.update(callback_status="delivered", callback_delivered_at=datetime.utcnow(), callback_next_at=None)
+            logger.info(f"Delivered webhook for job {job_id} on attempt {attempt}")
+        elif retryable and attempt < self.retry_attempts:
+            delay = self.retry_backoff * 2 ** (attempt - 1)
+            values["callback_next_at"] = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning(f"Webhook for job {job_id} failed ({error}); retrying in {delay:.1f}s")
+        else:
+            values.update(callback_status="failed", callback_next_at=None)
+            logger.error(f"Giving up on webhook for job {job_id} after {attempt} attempt(s): {error}")
+
+        async with self.session_factory() as db:
+            await db.execute(
+                update(GenerationJob)
+                .where(GenerationJob.id == job_id, GenerationJob.callback_status == "pending")
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+        if "callback_status" not in values:
+            self._retry_later(job_id, delay)
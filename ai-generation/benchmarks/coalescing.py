@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Benchmark job throughput with and without request coalescing
+Submits a burst of compatible single-image jobs to the API in-process. The
+simulated SD backend runs one txt2img call at a time with a fixed per-call
+overhead plus a per-image cost, as a single GPU does
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+# 1x1 transparent PNG
+PLACEHOLDER_PNG = base64.b64encode(bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082'
+)).decode()
+
+
+def simulated_gpu_transport(call_overhead: float, image_cost: float, calls: list) -> httpx.MockTransport:
+    """txt2img takes `call_overhead + batch_size * image_cost` seconds, one call at a time"""
+    gpu = asyncio.Lock()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == '/sdapi/v1/txt2img':
+            payload = json.loads(request.content)
+            batch_size = payload.get('batch_size', 1)
+            async with gpu:
+                await asyncio.sleep(call_overhead + batch_size * image_cost)
+            calls.append(batch_size)
+            seed = len(calls) * 1000
+            return httpx.Response(200, json={
+                'images': [PLACEHOLDER_PNG] * batch_size,
+                'parameters': payload,
+                'info': json.dumps({'all_seeds': list(range(seed, seed + batch_size))})
+            })
+        if request.url.path == '/sdapi/v1/progress':
+            return httpx.Response(200, json={'progress': 0.0, 'eta_relative': 0.0, 'state': {}})
+        return httpx.Response(404)
+    return httpx.MockTransport(handler)
+
+
+async def run_phase(client: httpx.AsyncClient, wrapper, calls: list, jobs: int, window: float, character_id: str):
+    wrapper.scheduler.coalesce_window = window
+    calls.clear()
+
+    started = time.perf_counter()
+    response = await client.post('/api/generate/batch', json={
+        'character_ids': [character_id], 'focus': ['ass'], 'scenes': ['beach'], 'count': jobs
+    })
+    response.raise_for_status()
+    job_ids = response.json()['job_ids']
+
+    pending = set(job_ids)
+    while pending:
+        await asyncio.sleep(0.05)
+        for job_id in list(pending):
+            status = (await client.get(f'/api/status/{job_id}')).json()['status']
+            if status in ('completed', 'failed'):
+                pending.discard(job_id)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'coalesce_window_s': window,
+        'jobs': len(job_ids),
+        'sd_calls': len(calls),
+        'mean_batch': round(sum(calls) / len(calls), 2) if calls else 0,
+        'elapsed_s': round(elapsed, 2),
+        'jobs_per_s': round(len(job_ids) / elapsed, 2),
+    }
+
+
+async def run(args):
+    from api import sd_api_wrapper as wrapper
+    from api.backend_pool import BackendPool
+
+    async def upload_stub(file_data, bucket, key, metadata=None, content_type='image/png'):
+        return f"s3://{bucket}/{key}"
+
+    calls = []
+    wrapper.backend_pool = BackendPool(
+        ['http://sd-benchmark'],
+        max_concurrent_per_backend=args.workers,
+        transport=simulated_gpu_transport(args.call_overhead, args.image_cost, calls)
+    )
+    wrapper.progress_monitor.pool = wrapper.backend_pool
+    wrapper.upload_to_s3 = upload_stub
+    wrapper.scheduler.max_concurrent = args.workers
+    wrapper.scheduler.max_batch = args.max_batch
+
+    character_id = wrapper.character_registry.all()[0]['id']
+
+    await wrapper.app.router.startup()
+    try:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=wrapper.app),
+            base_url='http://api',
+            headers={'Authorization': f"Bearer {os.environ['API_KEY_SECRET']}"}
+        ) as client:
+            uncoalesced = await run_phase(client, wrapper, calls, args.jobs, 0, character_id)
+            coalesced = await run_phase(client, wrapper, calls, args.jobs, args.window, character_id)
+    finally:
+        await wrapper.app.router.shutdown()
+
+    return {
+        'benchmark': 'coalescing',
+        'call_overhead_s': args.call_overhead,
+        'image_cost_s': args.image_cost,
+        'workers': args.workers,
+        'max_batch': args.max_batch,
+        'uncoalesced': uncoalesced,
+        'coalesced': coalesced,
+        'speedup': round(coalesced['jobs_per_s'] / uncoalesced['jobs_per_s'], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare throughput with and without request coalescing")
+    parser.add_argument('--jobs', type=int, default=16, help='Compatible single-image jobs per phase')
+    parser.add_argument('--workers', type=int, default=2, help='Scheduler workers')
+    parser.add_argument('--window', type=float, default=0.2, help='Coalescing window in seconds')
+    parser.add_argument('--max-batch', type=int, default=4, help='Images per coalesced call')
+    parser.add_argument('--call-overhead', type=float, default=0.3, help='Simulated fixed cost per txt2img call')
+    parser.add_argument('--image-cost', type=float, default=0.1, help='Simulated cost per image')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sd-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('API_KEY_SECRET', 'benchmark')
+    os.environ.setdefault('S3_BUCKET_IMAGES', 'benchmark-images')
+    # The API resolves config paths relative to api/
+    os.chdir(os.path.join(ROOT, 'api'))
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
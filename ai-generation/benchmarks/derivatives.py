@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark image derivative encoding
+Encodes WebP (and AVIF, when Pillow supports it) masters and thumbnails of
+synthetic 1024px PNGs in the process pool and reports CPU cost per image
+and bytes saved against the original PNG
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+
+def synthetic_png(size: int, seed: int) -> bytes:
+    """Photo-like test image: smooth gradients with blurred detail and sensor noise"""
+    from PIL import Image, ImageChops, ImageFilter
+
+    red = Image.linear_gradient('L').resize((size, size)).rotate(seed * 37 % 360)
+    green = Image.radial_gradient('L').resize((size, size))
+    blue = ImageChops.multiply(red, green).rotate(90)
+    image = Image.merge('RGB', (red, green, blue))
+    detail = Image.effect_noise((size // 8, size // 8), 60 + seed % 20).resize((size, size)).filter(ImageFilter.GaussianBlur(3))
+    grain = Image.effect_noise((size, size), 12)
+    image = Image.blend(image, Image.merge('RGB', (detail, detail, grain)), 0.35)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+async def run_format(image_format: str, images, args):
+    from api.derivatives import ImageProcessor
+
+    processor = ImageProcessor(
+        image_format=image_format,
+        quality=args.quality,
+        thumbnail_sizes=args.thumbnails,
+        max_workers=args.workers,
+        enabled=True
+    )
+    try:
+        await processor.process(images[0])  # start the worker processes
+        started = time.perf_counter()
+        results = await asyncio.gather(*(processor.process(data) for data in images))
+        elapsed = time.perf_counter() - started
+    finally:
+        await processor.close()
+
+    source = sum(result.source_bytes for result in results)
+    masters = sum(len(d.data) for result in results for d in result.derivatives if d.size is None)
+    thumbnails = {
+        size: round(sum(len(d.data) for result in results for d in result.derivatives if d.size == size) / len(results))
+        for size in args.thumbnails
+    }
+    return {
+        'format': processor.image_format,
+        'quality': args.quality,
+        'cpu_ms_per_image': round(sum(result.cpu_seconds for result in results) / len(results) * 1000, 1),
+        'images_per_s': round(len(results) / elapsed, 2),
+        'png_bytes': round(source / len(results)),
+        'master_bytes': round(masters / len(results)),
+        'thumbnail_bytes': thumbnails,
+        'master_saved_pct': round(100 * (1 - masters / source), 1),
+    }
+
+
+async def run(args):
+    from api.derivatives import avif_supported
+
+    images = [synthetic_png(args.size, seed) for seed in range(args.images)]
+    formats = ['webp'] + (['avif'] if avif_supported() else [])
+    return {
+        'benchmark': 'derivatives',
+        'images': args.images,
+        'workers': args.workers,
+        'results': [await run_format(image_format, images, args) for image_format in formats],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure derivative encoding cost and size savings")
+    parser.add_argument('--images', type=int, default=8, help='Images to encode per format')
+    parser.add_argument('--size', type=int, default=1024, help='Width and height of the test images')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2), help='Worker processes')
+    parser.add_argument('--quality', type=int, default=82, help='Master quality')
+    parser.add_argument('--thumbnails', type=lambda value: [int(size) for size in value.split(',')],
+                        default=[512, 256], help='Comma-separated thumbnail sizes')
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
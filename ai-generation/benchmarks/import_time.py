@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Benchmark API startup cost
+Times a cold import of api.sd_api_wrapper in fresh interpreters, lists the
+slowest top-level imports, and measures the prompt-building hot path
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import api.sd_api_wrapper; "
+    "print(time.perf_counter() - t)"
+)
+
+
+def parse_importtime(stderr: str):
+    """Modules imported directly by the API module, with cumulative time in ms"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # -X importtime indents nested imports by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            modules.append((name.strip(), int(cumulative) / 1000))
+    return sorted(modules, key=lambda m: m[1], reverse=True)
+
+
+def time_import(env, importtime: bool = False):
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', IMPORT_SNIPPET]
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1]) * 1000, result.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API import time and prompt generation cost")
+    parser.add_argument('--runs', type=int, default=5, help='Cold imports to time')
+    parser.add_argument('--top', type=int, default=10, help='Slowest top-level imports to list')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='sd-bench-'), 'bench.db')}"
+    env.setdefault('API_KEY_SECRET', 'benchmark')
+
+    import_ms = [time_import(env)[0] for _ in range(args.runs)]
+    _, trace = time_import(env, importtime=True)
+
+    from scripts.prompt_generator import PromptGenerator
+    generator = PromptGenerator()
+    number = 10000
+    init_us = timeit.timeit(PromptGenerator, number=number) / number * 1e6
+    prompt_us = timeit.timeit(
+        lambda: generator.generate_prompt(character_id='emma_riley', character_lora='emma_riley_lora'),
+        number=number
+    ) / number * 1e6
+
+    print(json.dumps({
+        'benchmark': 'import_time',
+        'runs': args.runs,
+        'import_p50_ms': round(statistics.median(import_ms), 1),
+        'import_min_ms': round(min(import_ms), 1),
+        'import_max_ms': round(max(import_ms), 1),
+        'slowest_imports_ms': {name: round(ms, 1) for name, ms in parse_importtime(trace)[:args.top]},
+        'prompt_generator_init_us': round(init_us, 2),
+        'generate_prompt_us': round(prompt_us, 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test of the generation API
+Drives sd_api_wrapper.app in-process with a weighted mix of /api/generate,
+/api/status and /api/jobs requests. Generation runs for real against mock SD
+backends and a local S3 stand-in. Reports throughput, per-endpoint latency
+percentiles, event-loop lag and peak RSS as JSON, tagged with the commit, so
+runs on different commits can be compared
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+ENDPOINTS = ('generate', 'status', 'jobs')
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """`generate=1,status=8,jobs=1` -> weights per endpoint"""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint {name!r} in --mix; use {', '.join(ENDPOINTS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    return {
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p95_ms': round(percentile(values, 95) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+        'max_ms': round(max(values, default=0) * 1000, 2),
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+async def measure_loop_lag(interval: float, lags: List[float], stop: asyncio.Event):
+    """Record how late each `interval` sleep wakes up"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - started - interval))
+
+
+async def client_loop(
+    client: httpx.AsyncClient,
+    rng: random.Random,
+    weights: Dict[str, float],
+    characters: List[str],
+    job_ids: List[str],
+    latencies: Dict[str, List[float]],
+    statuses: Dict[str, Counter],
+    deadline: float
+):
+    names, cumulative = list(weights), list(weights.values())
+    while time.perf_counter() < deadline:
+        endpoint = rng.choices(names, cumulative)[0]
+        if endpoint == 'status' and not job_ids:
+            endpoint = 'generate'
+
+        started = time.perf_counter()
+        if endpoint == 'generate':
+            response = await client.post('/api/generate', json={
+                'character_id': rng.choice(characters),
+                'focus': rng.choice(['ass', 'tits']),
+            })
+            if response.status_code == 200:
+                job_ids.append(response.json()['job_id'])
+        elif endpoint == 'status':
+            response = await client.get(f'/api/status/{rng.choice(job_ids)}')
+        else:
+            response = await client.get('/api/jobs', params={'limit': 50})
+        latencies[endpoint].append(time.perf_counter() - started)
+        statuses[endpoint][response.status_code] += 1
+
+
+async def run(args):
+    from api import sd_api_wrapper as wrapper
+    from api.backend_pool import BackendPool
+    from api.database import GenerationJob, SessionLocal
+    from api.storage import ImageStorage
+    from scripts.mock_s3 import LocalS3Client
+    from scripts.mock_sd_server import MockSDBackend, MockSDTransport
+    from sqlalchemy import func, select
+
+    mocks = {
+        f"sd-{i}": MockSDBackend(
+            step_seconds=args.step_seconds,
+            call_seconds=args.call_seconds,
+            lora_swap_seconds=args.swap_seconds,
+            failure_rate=args.sd_failure_rate,
+            seed=args.seed + i
+        )
+        for i in range(args.backends)
+    }
+    wrapper.backend_pool = BackendPool(
+        [f"http://{host}" for host in mocks],
+        max_concurrent_per_backend=1,
+        transport=MockSDTransport(mocks)
+    )
+    wrapper.progress_monitor.pool = wrapper.backend_pool
+    wrapper.scheduler.max_concurrent = wrapper.backend_pool.capacity
+    s3 = LocalS3Client(latency=args.s3_latency, seconds_per_mb=args.s3_seconds_per_mb, seed=args.seed)
+    wrapper.storage = ImageStorage(client=s3)
+
+    characters = [character['id'] for character in wrapper.character_registry.all()]
+    weights = parse_mix(args.mix)
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    statuses: Dict[str, Counter] = defaultdict(Counter)
+    job_ids: List[str] = []
+    lags: List[float] = []
+
+    await wrapper.app.router.startup()
+    try:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=wrapper.app),
+            base_url='http://api',
+            headers={'Authorization': f"Bearer {os.environ['API_KEY_SECRET']}"},
+            timeout=60
+        ) as client:
+            stop = asyncio.Event()
+            lag_task = asyncio.create_task(measure_loop_lag(args.lag_interval, lags, stop))
+            started = time.perf_counter()
+            deadline = started + args.duration
+            await asyncio.gather(*(
+                client_loop(client, random.Random(args.seed * 1000 + i), weights, characters,
+                            job_ids, latencies, statuses, deadline)
+                for i in range(args.concurrency)
+            ))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await lag_task
+
+        async with SessionLocal() as db:
+            outcomes = dict((await db.execute(
+                select(GenerationJob.status, func.count()).group_by(GenerationJob.status)
+            )).all())
+    finally:
+        await wrapper.app.router.shutdown()
+
+    requests = sum(len(values) for values in latencies.values())
+    return {
+        'benchmark': 'load_test',
+        'commit': git_commit(),
+        'config': {
+            'duration_s': args.duration,
+            'concurrency': args.concurrency,
+            'mix': weights,
+            'backends': args.backends,
+            'step_seconds': args.step_seconds,
+            'size': args.size,
+            's3_latency_s': args.s3_latency,
+            'seed': args.seed,
+        },
+        'elapsed_s': round(elapsed, 2),
+        'requests': requests,
+        'requests_per_s': round(requests / elapsed, 1),
+        'endpoints': {
+            endpoint: {
+                'requests': len(latencies[endpoint]),
+                'requests_per_s': round(len(latencies[endpoint]) / elapsed, 1),
+                'status_codes': {str(code): count for code, count in sorted(statuses[endpoint].items())},
+                **latency_summary(latencies[endpoint]),
+            }
+            for endpoint in weights
+        },
+        'jobs': {
+            'submitted': len(job_ids),
+            'by_status': outcomes,
+            'completed_per_s': round(outcomes.get('completed', 0) / elapsed, 2),
+        },
+        'event_loop_lag': {'samples': len(lags), **latency_summary(lags)},
+        'sd': {
+            'calls': sum(mock.stats['calls'] for mock in mocks.values()),
+            'failures': sum(mock.stats['failures'] for mock in mocks.values()),
+            'lora_swaps': sum(mock.stats['lora_swaps'] for mock in mocks.values()),
+        },
+        's3': dict(s3.stats),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the generation API against mock SD and S3 backends")
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of load')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent clients')
+    parser.add_argument('--mix', default='generate=1,status=8,jobs=1', help='Relative weights per endpoint')
+    parser.add_argument('--backends', type=int, default=2, help='Mock SD backends')
+    parser.add_argument('--step-seconds', type=float, default=0.002, help='Mock time per sampling step per image')
+    parser.add_argument('--call-seconds', type=float, default=0.05, help='Mock fixed cost per txt2img call')
+    parser.add_argument('--swap-seconds', type=float, default=0.2, help='Mock LoRA load penalty')
+    parser.add_argument('--sd-failure-rate', type=float, default=0.0, help='Fraction of txt2img calls that fail')
+    parser.add_argument('--size', type=int, default=512, help='Generated image width and height')
+    parser.add_argument('--s3-latency', type=float, default=0.02, help='Seconds per S3 put')
+    parser.add_argument('--s3-seconds-per-mb', type=float, default=0.01, help='Extra S3 put time per megabyte')
+    parser.add_argument('--lag-interval', type=float, default=0.01, help='Event-loop lag sampling interval')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the request mix and mock backends')
+    parser.add_argument('--output', help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sd-load-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    os.environ.setdefault('API_KEY_SECRET', 'benchmark')
+    os.environ.setdefault('S3_BUCKET_IMAGES', 'benchmark-images')
+    os.environ['DEFAULT_WIDTH'] = os.environ['DEFAULT_HEIGHT'] = str(args.size)
+    # Measure the hot paths rather than the limits that protect them
+    os.environ.setdefault('RATE_LIMIT_JOBS_PER_MINUTE', '0')
+    os.environ.setdefault('ADMISSION_MAX_WAIT_SECONDS', '0')
+    # The API resolves config paths relative to api/
+    os.chdir(os.path.join(ROOT, 'api'))
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == "__main__":
+    main()
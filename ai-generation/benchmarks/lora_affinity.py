@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Benchmark LoRA swaps and job latency with and without LoRA affinity
+Queues a shuffled burst of jobs for several characters and runs them through
+the real queue, scheduler and backend pool against in-process mock SD
+backends that charge a penalty whenever a call needs a LoRA that is not
+loaded. The baseline routes to the least-loaded backend in queue order
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+
+async def run_phase(args, affinity: bool, workdir: str):
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+    from api.backend_pool import BackendPool
+    from api.database import GenerationJob, ensure_schema
+    from api.job_queue import JobQueue, new_job_id
+    from api.scheduler import JobScheduler
+    from api.sd_client import SDAPIClient
+    from scripts.mock_sd_server import MockSDBackend, MockSDTransport
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(workdir, f'affinity-{affinity}.db')}")
+    await ensure_schema(engine)
+    session_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    mocks = {
+        f"sd-{i}": MockSDBackend(
+            step_seconds=args.step_seconds,
+            call_seconds=args.call_seconds,
+            lora_swap_seconds=args.swap_seconds,
+            lora_slots=1,
+            seed=i
+        )
+        for i in range(args.backends)
+    }
+    pool = BackendPool(
+        [f"http://{host}" for host in mocks],
+        max_concurrent_per_backend=1,
+        lora_slots=1,
+        affinity=affinity,
+        health_interval=3600,
+        transport=MockSDTransport(mocks)
+    )
+    queue = JobQueue(session_factory)
+
+    submitted, latencies = {}, {}
+    done = asyncio.Event()
+
+    async def handler(claim):
+        character_id = claim.request['character_id']
+        payload = SDAPIClient.default_payload(
+            f"photo of {character_id}, <lora:{character_id}_lora:1.0>", "blurry", width=512, height=512
+        )
+        payload['steps'] = args.steps
+        await pool.txt2img(payload, job_id=claim.id)
+        await queue.complete(claim, result={})
+        latencies[claim.id] = time.perf_counter() - submitted[claim.id]
+        if len(latencies) == len(submitted):
+            done.set()
+
+    def warm_characters():
+        return {lora[:-len('_lora')] for lora in pool.warm_loras()}
+
+    scheduler = JobScheduler(
+        queue,
+        handler,
+        max_concurrent=args.backends,
+        poll_interval=0.05,
+        retry_attempts=1,
+        preference=warm_characters if affinity else None,
+        affinity_window=args.window,
+        affinity_max_delay=args.max_delay
+    )
+
+    rng = random.Random(args.seed)
+    characters = [f"character_{i}" for i in range(args.characters)]
+    workload = [character for character in characters for _ in range(args.jobs_per_character)]
+    rng.shuffle(workload)
+
+    await pool.start()
+    started = time.perf_counter()
+    async with session_factory() as db:
+        for character_id in workload:
+            job_id = new_job_id(character_id)
+            db.add(GenerationJob(
+                id=job_id,
+                character_id=character_id,
+                status="pending",
+                request={'character_id': character_id}
+            ))
+            submitted[job_id] = time.perf_counter()
+        await db.commit()
+    await scheduler.start()
+    try:
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+    finally:
+        elapsed = time.perf_counter() - started
+        await scheduler.stop()
+        await pool.close()
+        await engine.dispose()
+
+    values = sorted(latencies.values())
+    return {
+        'affinity': affinity,
+        'jobs': len(values),
+        'lora_swaps': sum(mock.stats['lora_swaps'] for mock in mocks.values()),
+        'swap_seconds': round(sum(mock.stats['lora_swap_seconds'] for mock in mocks.values()), 2),
+        'p50_latency_s': round(statistics.median(values), 3),
+        'p95_latency_s': round(values[int(0.95 * (len(values) - 1))], 3),
+        'max_latency_s': round(values[-1], 3),
+        'elapsed_s': round(elapsed, 2),
+    }
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='sd-bench-')
+    baseline = await run_phase(args, False, workdir)
+    affinity = await run_phase(args, True, workdir)
+    return {
+        'benchmark': 'lora_affinity',
+        'backends': args.backends,
+        'characters': args.characters,
+        'jobs_per_character': args.jobs_per_character,
+        'swap_penalty_s': args.swap_seconds,
+        'window': args.window,
+        'baseline': baseline,
+        'affinity': affinity,
+        'swap_reduction': round(1 - affinity['lora_swaps'] / baseline['lora_swaps'], 3) if baseline['lora_swaps'] else 0,
+        'p50_speedup': round(baseline['p50_latency_s'] / affinity['p50_latency_s'], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare LoRA swaps and latency with and without LoRA affinity")
+    parser.add_argument('--backends', type=int, default=2, help='Mock SD backends, one job at a time each')
+    parser.add_argument('--characters', type=int, default=6, help='Distinct characters (LoRAs) in the workload')
+    parser.add_argument('--jobs-per-character', type=int, default=8)
+    parser.add_argument('--window', type=int, default=8, help='Affinity reordering window in jobs')
+    parser.add_argument('--max-delay', type=float, default=30, help='Seconds after which a job is never passed over')
+    parser.add_argument('--steps', type=int, default=30, help='Sampling steps per image')
+    parser.add_argument('--step-seconds', type=float, default=0.003, help='Simulated time per sampling step')
+    parser.add_argument('--call-seconds', type=float, default=0.02, help='Simulated fixed cost per txt2img call')
+    parser.add_argument('--swap-seconds', type=float, default=0.25, help='Simulated LoRA load penalty')
+    parser.add_argument('--seed', type=int, default=7, help='Seed for the workload order')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Benchmark /api/status latency while generations are in flight
+Runs the API in-process against a simulated SD backend so database work on
+the event loop shows up directly in status latency
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+# 1x1 transparent PNG
+PLACEHOLDER_PNG = base64.b64encode(bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082'
+)).decode()
+
+
+def simulated_sd_transport(latency: float) -> httpx.MockTransport:
+    """Answers txt2img after `latency` seconds and progress immediately"""
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == '/sdapi/v1/txt2img':
+            payload = json.loads(request.content)
+            await asyncio.sleep(latency)
+            return httpx.Response(200, json={
+                'images': [PLACEHOLDER_PNG] * payload.get('batch_size', 1),
+                'parameters': payload,
+                'info': '{}'
+            })
+        if request.url.path == '/sdapi/v1/progress':
+            return httpx.Response(200, json={'progress': 0.5, 'eta_relative': latency / 2, 'state': {}})
+        return httpx.Response(404)
+    return httpx.MockTransport(handler)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run(args):
+    from api import sd_api_wrapper as wrapper
+    from api.backend_pool import BackendPool
+
+    async def upload_stub(file_data, bucket, key, metadata=None, content_type='image/png'):
+        await asyncio.sleep(args.s3_latency)
+        return f"s3://{bucket}/{key}"
+
+    wrapper.backend_pool = BackendPool(
+        ['http://sd-benchmark'],
+        max_concurrent_per_backend=args.generations,
+        transport=simulated_sd_transport(args.sd_latency)
+    )
+    wrapper.upload_to_s3 = upload_stub
+    wrapper.scheduler.max_concurrent = args.generations
+
+    character_ids = [c['id'] for c in wrapper.character_registry.all()]
+
+    await wrapper.app.router.startup()
+    latencies = []
+    try:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=wrapper.app),
+            base_url='http://api',
+            headers={'Authorization': f"Bearer {os.environ['API_KEY_SECRET']}"}
+        ) as client:
+            job_ids = []
+            for character_id in character_ids[:args.generations]:
+                response = await client.post('/api/generate', json={'character_id': character_id, 'focus': 'ass'})
+                job_ids.append(response.json()['job_id'])
+
+            deadline = time.perf_counter() + args.duration
+
+            async def poll(worker: int):
+                i = worker
+                while time.perf_counter() < deadline:
+                    started = time.perf_counter()
+                    response = await client.get(f'/api/status/{job_ids[i % len(job_ids)]}')
+                    response.raise_for_status()
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    i += 1
+
+            await asyncio.gather(*(poll(i) for i in range(args.clients)))
+    finally:
+        await wrapper.app.router.shutdown()
+
+    return {
+        'benchmark': 'status_latency',
+        'generations_in_flight': args.generations,
+        'clients': args.clients,
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / args.duration, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'max_ms': round(max(latencies), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure /api/status latency under generation load")
+    parser.add_argument('--generations', type=int, default=4, help='Concurrent generations')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent status pollers')
+    parser.add_argument('--duration', type=float, default=5.0, help='Measurement window in seconds')
+    parser.add_argument('--sd-latency', type=float, default=10.0, help='Simulated txt2img time in seconds')
+    parser.add_argument('--s3-latency', type=float, default=0.05, help='Simulated S3 upload time in seconds')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sd-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault('API_KEY_SECRET', 'benchmark')
+    os.environ.setdefault('S3_BUCKET_IMAGES', 'benchmark-images')
+    # The API resolves config paths relative to api/
+    os.chdir(os.path.join(ROOT, 'api'))
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+"""
+Shared prompt, tagging, character and S3 helpers
+"""
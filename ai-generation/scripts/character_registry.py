@@ -0,0 +1,106 @@
+"""
+In-memory character registry backed by config/characters.json
+Loads the file once, indexes characters by id and group, and reloads when
+the file changes on disk
+"""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_CHARACTERS_PATH = Path(__file__).resolve().parent.parent / 'config' / 'characters.json'
+
+
+class CharacterRegistry:
+    """
+    Read-only view of characters.json.
+
+    Every lookup stats the file and re-parses it only when its mtime or
+    size changed, so edits are picked up without a restart while the
+    common path costs a single stat call. `etag` identifies the current
+    file contents for HTTP conditional requests.
+    """
+
+    def __init__(self, path: Optional[os.PathLike] = None):
+        self.path = Path(path or os.getenv('CHARACTERS_FILE', DEFAULT_CHARACTERS_PATH))
+        self._lock = threading.Lock()
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._data: Dict[str, Any] = {'characters': []}
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._by_group: Dict[Any, List[Dict[str, Any]]] = {}
+        self._etag = ''
+
+    def _load(self, stamp: Tuple[int, int]):
+        raw = self.path.read_bytes()
+        data = json.loads(raw)
+        characters = data.get('characters', [])
+
+        by_group: Dict[Any, List[Dict[str, Any]]] = {}
+        for character in characters:
+            by_group.setdefault(character.get('group'), []).append(character)
+
+        self._data = data
+        self._by_id = {character['id']: character for character in characters}
+        self._by_group = by_group
+        self._etag = f'"{hashlib.sha1(raw).hexdigest()}"'
+        self._stamp = stamp
+
+    def refresh(self) -> bool:
+        """Reload the file if it changed; returns True if it was reloaded"""
+        stat = self.path.stat()
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self._stamp:
+            return False
+        with self._lock:
+            if stamp != self._stamp:
+                self._load(stamp)
+                return True
+        return False
+
+    @property
+    def etag(self) -> str:
+        self.refresh()
+        return self._etag
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        """The parsed characters.json document"""
+        self.refresh()
+        return self._data
+
+    def all(self) -> List[Dict[str, Any]]:
+        self.refresh()
+        return self._data.get('characters', [])
+
+    def get(self, character_id: str) -> Optional[Dict[str, Any]]:
+        self.refresh()
+        return self._by_id.get(character_id)
+
+    def require(self, character_id: str) -> Dict[str, Any]:
+        """Like get(), but raises ValueError for unknown characters"""
+        character = self.get(character_id)
+        if character is None:
+            raise ValueError(f"Character {character_id} not found")
+        return character
+
+    def by_group(self, group: Any) -> List[Dict[str, Any]]:
+        self.refresh()
+        return list(self._by_group.get(group, []))
+
+    def filter(self, character_ids: List[str]) -> List[Dict[str, Any]]:
+        """Characters matching `character_ids`, in file order"""
+        self.refresh()
+        wanted = set(character_ids)
+        return [c for c in self._data.get('characters', []) if c['id'] in wanted]
+
+
+_registries: Dict[Path, CharacterRegistry] = {}
+
+
+def get_registry(path: Optional[os.PathLike] = None) -> CharacterRegistry:
+    """Shared registry for `path` (defaults to CHARACTERS_FILE / config/characters.json)"""
+    registry = CharacterRegistry(path)
+    return _registries.setdefault(registry.path.resolve(), registry)
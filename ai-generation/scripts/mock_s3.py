@@ -0,0 +1,94 @@
+"""
+Local stand-in for the S3 client used by ImageStorage
+Implements put_object, get_object, head_object and list_objects_v2 on an
+in-memory or on-disk object store with simulated latency, so uploads can be
+exercised without AWS
+"""
+
+import hashlib
+import io
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+
+class LocalS3Client:
+    """
+    Thread-safe object store with the boto3 client calls ImageStorage makes.
+
+    Each put sleeps `latency` seconds plus `seconds_per_mb` per megabyte
+    and fails with a 503 SlowDown error with probability `failure_rate`.
+    With `root`, objects are written under `root/<bucket>/<key>`;
+    otherwise they are kept in memory.
+    """
+
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        latency: float = 0.0,
+        seconds_per_mb: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None
+    ):
+        self.root = root
+        self.latency = latency
+        self.seconds_per_mb = seconds_per_mb
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.objects: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.stats = {"puts": 0, "bytes": 0, "failures": 0}
+        self._lock = threading.Lock()
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def put_object(self, Bucket: str, Key: str, Body, ContentType: str = 'binary/octet-stream', Metadata=None, **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        time.sleep(self.latency + self.seconds_per_mb * len(data) / (1024 * 1024))
+        with self._lock:
+            if self.rng.random() < self.failure_rate:
+                self.stats["failures"] += 1
+                raise ClientError({"Error": {"Code": "SlowDown", "Message": "Simulated failure"}}, "PutObject")
+            self.stats["puts"] += 1
+            self.stats["bytes"] += len(data)
+            self.objects[(Bucket, Key)] = {
+                "ContentType": ContentType,
+                "ContentLength": len(data),
+                "Metadata": dict(Metadata or {}),
+                "Body": None if self.root else data,
+            }
+        if self.root:
+            path = self._path(Bucket, Key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        return {"ETag": f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def _entry(self, bucket: str, key: str, operation: str) -> Dict[str, Any]:
+        with self._lock:
+            entry = self.objects.get((bucket, key))
+        if entry is None:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": key}}, operation)
+        return entry
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        entry = self._entry(Bucket, Key, "HeadObject")
+        return {key: value for key, value in entry.items() if key != "Body"}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs):
+        entry = self._entry(Bucket, Key, "GetObject")
+        data = entry["Body"]
+        if data is None:
+            with open(self._path(Bucket, Key), 'rb') as f:
+                data = f.read()
+        return {**self.head_object(Bucket, Key), "Body": io.BytesIO(data)}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = '', **kwargs):
+        with self._lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        contents = [{"Key": key, "Size": self.objects[(Bucket, key)]["ContentLength"]} for key in keys]
+        return {"Contents": contents, "KeyCount": len(contents), "IsTruncated": False}
@@ -0,0 +1,353 @@
+"""
+Mock Stable Diffusion WebUI backend for local and CI load testing
+Implements the parts of the WebUI API this project calls: txt2img, img2img,
+extra-single-image, progress, task progress, interrupt, options and upscalers. Images are deterministic placeholder PNGs;
+generation time, failures and LoRA swaps are simulated, one call at a time
+as on a single GPU
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+
+LORA_PATTERN = re.compile(r'<lora:([^:>]+)')
+
+UPSCALERS = [
+    {"name": "None", "model_name": None, "model_path": None, "model_url": None, "scale": 4},
+    {"name": "Lanczos", "model_name": None, "model_path": None, "model_url": None, "scale": 4},
+    {"name": "R-ESRGAN 4x+", "model_name": "RealESRGAN_x4plus", "model_path": None, "model_url": None, "scale": 4},
+    {"name": "4x-UltraSharp", "model_name": "4x-UltraSharp", "model_path": None, "model_url": None, "scale": 4},
+]
+
+
+def placeholder_png(width: int, height: int, key: str) -> bytes:
+    """Solid-colour RGB PNG whose colour is derived from `key`"""
+    colour = hashlib.sha256(key.encode()).digest()[:3]
+    row = b'\x00' + colour * width
+    pixels = zlib.compress(row * height, 1)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', pixels) + chunk(b'IEND', b'')
+
+
+def png_size(encoded: str) -> Tuple[int, int]:
+    """Width and height from the IHDR chunk of a base64 PNG"""
+    header = base64.b64decode(encoded.split(',', 1)[-1][:64])
+    return struct.unpack('>II', header[16:24])
+
+
+class MockSDBackend:
+    """
+    Simulated WebUI state.
+
+    A txt2img call takes `call_seconds` plus `step_seconds` per sampling
+    step per image, plus `lora_swap_seconds` for each LoRA in the prompt
+    that is not among the `lora_slots` most recently used. img2img runs
+    `steps * denoising_strength` steps like the WebUI; an extras upscale
+    costs `call_seconds`. A fraction `failure_rate` of calls fail with
+    HTTP 500 before generating.
+    """
+
+    def __init__(
+        self,
+        step_seconds: Optional[float] = None,
+        call_seconds: Optional[float] = None,
+        lora_swap_seconds: Optional[float] = None,
+        lora_slots: Optional[int] = None,
+        failure_rate: Optional[float] = None,
+        seed: Optional[int] = None
+    ):
+        self.step_seconds = step_seconds if step_seconds is not None else float(os.getenv('MOCK_SD_STEP_SECONDS', 0.02))
+        self.call_seconds = call_seconds if call_seconds is not None else float(os.getenv('MOCK_SD_CALL_SECONDS', 0.2))
+        self.lora_swap_seconds = lora_swap_seconds if lora_swap_seconds is not None else float(os.getenv('MOCK_SD_LORA_SWAP_SECONDS', 2))
+        self.lora_slots = lora_slots or int(os.getenv('MOCK_SD_LORA_SLOTS', 1))
+        self.failure_rate = failure_rate if failure_rate is not None else float(os.getenv('MOCK_SD_FAILURE_RATE', 0))
+        self.rng = random.Random(seed if seed is not None else os.getenv('MOCK_SD_SEED'))
+
+        self.options: Dict[str, Any] = {
+            "sd_model_checkpoint": "RealVisXL_V5.0.safetensors",
+            "sd_vae": "Automatic",
+            "CLIP_stop_at_last_layers": 1,
+        }
+        self.loaded_loras: "OrderedDict[str, None]" = OrderedDict()
+        self.stats = {
+            "calls": 0, "images": 0, "upscales": 0, "failures": 0, "interrupts": 0,
+            "lora_swaps": 0, "lora_swap_seconds": 0.0
+        }
+
+        self._gpu = asyncio.Lock()
+        self._waiting = 0
+        self._job: Optional[Dict[str, Any]] = None
+        self._interrupted: Optional[asyncio.Event] = None
+
+    def _load_loras(self, prompt: str) -> float:
+        """Make the prompt's LoRAs resident; returns the simulated load time"""
+        penalty = 0.0
+        for name in dict.fromkeys(LORA_PATTERN.findall(prompt)):
+            if name in self.loaded_loras:
+                self.loaded_loras.move_to_end(name)
+                continue
+            self.loaded_loras[name] = None
+            while len(self.loaded_loras) > self.lora_slots:
+                self.loaded_loras.popitem(last=False)
+            self.stats["lora_swaps"] += 1
+            penalty += self.lora_swap_seconds
+        self.stats["lora_swap_seconds"] += penalty
+        return penalty
+
+    async def txt2img(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = payload.get("prompt", "")
+        width, height = int(payload.get("width", 512)), int(payload.get("height", 512))
+        batch_size = max(1, int(payload.get("batch_size", 1)))
+        steps = max(1, int(payload.get("steps", 20)))
+        seed = int(payload.get("seed", -1))
+
+        async with self._call():
+            if seed == -1:
+                seed = self.rng.randrange(2 ** 32)
+            seeds = [seed + i for i in range(batch_size)]
+            await self._run(steps, batch_size, self._load_loras(prompt), payload.get("force_task_id"))
+
+        images = [
+            base64.b64encode(placeholder_png(width, height, f"{prompt}|{s}|{width}x{height}")).decode()
+            for s in seeds
+        ]
+        self.stats["images"] += len(images)
+        info = {
+            "prompt": prompt,
+            "all_prompts": [prompt] * batch_size,
+            "negative_prompt": payload.get("negative_prompt", ""),
+            "seed": seeds[0],
+            "all_seeds": seeds,
+            "width": width,
+            "height": height,
+            "steps": steps,
+            "sampler_name": payload.get("sampler_name"),
+            "cfg_scale": payload.get("cfg_scale"),
+            "sd_model_name": self.options["sd_model_checkpoint"].rsplit('.', 1)[0],
+        }
+        return {"images": images, "parameters": payload, "info": json.dumps(info)}
+
+    async def img2img(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = payload.get("prompt", "")
+        width, height = int(payload.get("width", 512)), int(payload.get("height", 512))
+        steps = max(1, int(int(payload.get("steps", 20)) * float(payload.get("denoising_strength", 0.75))))
+        seed = int(payload.get("seed", -1))
+        source = (payload.get("init_images") or [""])[0]
+
+        async with self._call():
+            if seed == -1:
+                seed = self.rng.randrange(2 ** 32)
+            await self._run(steps, 1, self._load_loras(prompt), payload.get("force_task_id"))
+
+        image = placeholder_png(width, height, f"{source[:64]}|{prompt}|{seed}|{width}x{height}")
+        self.stats["upscales"] += 1
+        info = {"prompt": prompt, "seed": seed, "all_seeds": [seed], "width": width, "height": height, "steps": steps}
+        return {"images": [base64.b64encode(image).decode()], "parameters": payload, "info": json.dumps(info)}
+
+    async def extra_single_image(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        source = payload.get("image", "")
+        width, height = png_size(source)
+        scale = float(payload.get("upscaling_resize", 2))
+        width, height = int(width * scale), int(height * scale)
+
+        async with self._call():
+            await self._run(0, 1, 0.0)
+
+        image = placeholder_png(width, height, f"{source[:64]}|{payload.get('upscaler_1')}|{width}x{height}")
+        self.stats["upscales"] += 1
+        return {"image": base64.b64encode(image).decode(), "html_info": f"<p>{width}x{height}</p>"}
+
+    @asynccontextmanager
+    async def _call(self):
+        """Hold the simulated GPU for one call; fails `failure_rate` of calls"""
+        self._waiting += 1
+        try:
+            await self._gpu.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            self.stats["calls"] += 1
+            if self.rng.random() < self.failure_rate:
+                self.stats["failures"] += 1
+                raise HTTPException(status_code=500, detail="Simulated backend failure")
+            yield
+        finally:
+            self._gpu.release()
+
+    async def _run(self, steps: int, batch_size: int, load_seconds: float, task_id: Optional[str] = None):
+        """Sleep through loading and sampling, stopping early on interrupt"""
+        total_steps = steps * batch_size
+        self._interrupted = asyncio.Event()
+        self._job = {
+            "task_id": task_id,
+            "started": time.monotonic(),
+            "load_seconds": self.call_seconds + load_seconds,
+            "steps": steps,
+            "batch_size": batch_size,
+            "duration": self.call_seconds + load_seconds + total_steps * self.step_seconds,
+        }
+        try:
+            await asyncio.wait_for(self._interrupted.wait(), timeout=self._job["duration"])
+            self.stats["interrupts"] += 1
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._job = None
+            self._interrupted = None
+
+    def interrupt(self):
+        if self._interrupted is not None:
+            self._interrupted.set()
+
+    def task_progress(self, task_id: str) -> Dict[str, Any]:
+        """/internal/progress for one task; only whether it is executing is simulated"""
+        job = self._job
+        active = job is not None and job["task_id"] == task_id
+        return {
+            "active": active,
+            "queued": False,
+            "completed": False,
+            "progress": self.progress()["progress"] if active else None,
+            "eta": None,
+            "live_preview": None,
+            "id_live_preview": -1,
+            "textinfo": None,
+        }
+
+    def progress(self) -> Dict[str, Any]:
+        job = self._job
+        state = {
+            "skipped": False,
+            "interrupted": False,
+            "job": "",
+            "job_count": self._waiting + (1 if job else 0),
+            "job_no": 0,
+            "sampling_step": 0,
+            "sampling_steps": 0,
+        }
+        if job is None:
+            return {"progress": 0.0, "eta_relative": 0.0, "state": state, "current_image": None, "textinfo": None}
+
+        elapsed = time.monotonic() - job["started"]
+        sampling = max(0.0, elapsed - job["load_seconds"])
+        sampling_total = job["duration"] - job["load_seconds"]
+        fraction = min(1.0, sampling / sampling_total) if sampling_total > 0 else 1.0
+        done_steps = int(fraction * job["steps"] * job["batch_size"])
+        state.update(
+            job="txt2img",
+            job_no=min(job["batch_size"] - 1, done_steps // max(1, job["steps"])),
+            sampling_step=done_steps % max(1, job["steps"]),
+            sampling_steps=job["steps"],
+        )
+        return {
+            "progress": round(fraction, 4),
+            "eta_relative": round(max(0.0, job["duration"] - elapsed), 3),
+            "state": state,
+            "current_image": None,
+            "textinfo": None,
+        }
+
+
+def create_app(backend: Optional[MockSDBackend] = None) -> FastAPI:
+    backend = backend or MockSDBackend()
+    app = FastAPI(title="Mock SD WebUI")
+    app.state.backend = backend
+
+    @app.post("/sdapi/v1/txt2img")
+    async def txt2img(request: Request):
+        return await backend.txt2img(await request.json())
+
+    @app.post("/sdapi/v1/img2img")
+    async def img2img(request: Request):
+        return await backend.img2img(await request.json())
+
+    @app.post("/sdapi/v1/extra-single-image")
+    async def extra_single_image(request: Request):
+        return await backend.extra_single_image(await request.json())
+
+    @app.get("/sdapi/v1/progress")
+    async def progress(skip_current_image: bool = False):
+        return backend.progress()
+
+    @app.post("/internal/progress")
+    async def task_progress(request: Request):
+        return backend.task_progress((await request.json()).get("id_task"))
+
+    @app.post("/sdapi/v1/interrupt")
+    async def interrupt():
+        backend.interrupt()
+        return {}
+
+    @app.get("/sdapi/v1/options")
+    async def get_options():
+        return backend.options
+
+    @app.post("/sdapi/v1/options")
+    async def set_options(request: Request):
+        backend.options.update(await request.json())
+        return None
+
+    @app.get("/sdapi/v1/upscalers")
+    async def upscalers() -> List[Dict[str, Any]]:
+        return UPSCALERS
+
+    @app.get("/mock/stats")
+    async def stats():
+        return {**backend.stats, "loaded_loras": list(backend.loaded_loras)}
+
+    return app
+
+
+class MockSDTransport(httpx.AsyncBaseTransport):
+    """Routes requests to in-process mock backends by host, e.g. http://sd-0 and http://sd-1"""
+
+    def __init__(self, backends: Dict[str, MockSDBackend]):
+        self.backends = backends
+        self._transports = {host: httpx.ASGITransport(app=create_app(backend)) for host, backend in backends.items()}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._transports[request.url.host].handle_async_request(request)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Mock Stable Diffusion WebUI API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7860)
+    parser.add_argument('--step-seconds', type=float, help='Simulated time per sampling step per image')
+    parser.add_argument('--call-seconds', type=float, help='Fixed overhead per generation or upscale call')
+    parser.add_argument('--lora-swap-seconds', type=float, help='Penalty for loading a LoRA that is not resident')
+    parser.add_argument('--lora-slots', type=int, help='LoRAs kept resident at once')
+    parser.add_argument('--failure-rate', type=float, help='Fraction of txt2img calls that fail with HTTP 500')
+    parser.add_argument('--seed', type=int, help='Seed for random failures and image seeds')
+    args = parser.parse_args()
+
+    mock = MockSDBackend(
+        step_seconds=args.step_seconds,
+        call_seconds=args.call_seconds,
+        lora_swap_seconds=args.lora_swap_seconds,
+        lora_slots=args.lora_slots,
+        failure_rate=args.failure_rate,
+        seed=args.seed
+    )
+    uvicorn.run(create_app(mock), host=args.host, port=args.port)
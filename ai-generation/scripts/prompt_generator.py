@@ -110,27 +110,30 @@ class PromptGenerator:
         lighting: Optional[str] = None,
         accessory: Optional[str] = None,
         camera_angle: Optional[str] = None,
-        custom_elements: Optional[List[str]] = None
+        custom_elements: Optional[List[str]] = None,
+        seed: Optional[int] = None
     ) -> Tuple[str, Dict[str, any]]:
         """
         Generate a unique prompt with proper tagging
+        A `seed` makes the random choices, and so the prompt, reproducible
         Returns: (prompt, tags)
         """
+        rng = random.Random(seed) if seed is not None else random
         
         # Select random elements if not specified
-        scene = scene or random.choice(self.scenes)
-        pose = pose or random.choice(self.poses_ass_focus if focus == 'ass' else self.poses_tits_focus)
-        lighting = lighting or random.choice(self.lightings)
-        accessory = accessory or random.choice(self.accessories)
-        camera_angle = camera_angle or random.choice(self.camera_angles)
-        skin_detail = random.choice(self.skin_details)
+        scene = scene or rng.choice(self.scenes)
+        pose = pose or rng.choice(self.poses_ass_focus if focus == 'ass' else self.poses_tits_focus)
+        lighting = lighting or rng.choice(self.lightings)
+        accessory = accessory or rng.choice(self.accessories)
+        camera_angle = camera_angle or rng.choice(self.camera_angles)
+        skin_detail = rng.choice(self.skin_details)
         
         # Determine clothing
         if is_nude:
             clothing = 'nude'
             clothing_desc = 'completely nude, bare skin'
         else:
-            clothing = random.choice(self.clothing_items)
+            clothing = rng.choice(self.clothing_items)
             clothing_desc = f'wearing {clothing}'
         
         # Build focus emphasis
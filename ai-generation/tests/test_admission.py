@@ -0,0 +1,86 @@
+import math
+
+import pytest
+
+from api.admission import AdmissionController, Rejected
+
+# One backend at MAX_CONCURRENT_GENERATIONS=2
+CAPACITY = 2
+
+
+def ui_batches(count, include_nude):
+    """Batch sizes the admin screen submits for one character, in order"""
+    sizes = []
+    for group in (count // 2, math.ceil(count / 2)):
+        nude = math.ceil(group / 4) if include_nude else 0
+        sizes += [size for size in (group - nude, nude) if size]
+    return sizes
+
+
+@pytest.fixture
+def admission():
+    return AdmissionController(batch_max_wait=3600, default_duration=20, timeout=300)
+
+
+@pytest.mark.parametrize('count', [30, 40, 100])
+@pytest.mark.parametrize('include_nude', [False, True])
+def test_admin_screen_batches_are_admitted_on_an_idle_queue(admission, count, include_nude):
+    queued = 0
+    for size in ui_batches(count, include_nude):
+        admission.check(queued, 0, size, CAPACITY, batch=True)
+        queued += size
+
+
+def test_batch_size_does_not_count_against_its_own_deadline(admission):
+    admission.check(0, 0, 1000, CAPACITY, batch=True)
+
+
+def test_interactive_requests_must_finish_within_the_timeout(admission):
+    # 28 images ahead drain in 280s at 20s per image on two slots, leaving 20s for one image
+    admission.check(27, 2, 1, CAPACITY)
+    with pytest.raises(Rejected) as rejected:
+        admission.check(28, 2, 1, CAPACITY)
+    assert rejected.value.reason == 'queue_full'
+    assert rejected.value.retry_after == math.ceil(20 * 29 / 2 - 280)
+
+
+def test_interactive_budget_counts_the_requests_images(admission):
+    # Four images take 80s, so they must start within 220s
+    admission.check(21, 2, 4, CAPACITY)
+    with pytest.raises(Rejected):
+        admission.check(22, 2, 4, CAPACITY)
+
+
+def test_interactive_budget_follows_the_timeout():
+    admission = AdmissionController(default_duration=20, timeout=600)
+    admission.check(57, 2, 1, CAPACITY)
+    with pytest.raises(Rejected):
+        admission.check(58, 2, 1, CAPACITY)
+
+
+def test_max_wait_overrides_the_timeout():
+    admission = AdmissionController(max_wait=100, default_duration=20, timeout=600)
+    admission.check(9, 2, 4, CAPACITY)
+    with pytest.raises(Rejected):
+        admission.check(10, 2, 4, CAPACITY)
+
+
+def test_durations_are_observed_per_image(admission):
+    admission.observe(80, images=4)
+    assert admission.duration == 20
+
+
+def test_batches_have_their_own_budget(admission):
+    admission.check(300, 2, 100, CAPACITY, batch=True)
+    with pytest.raises(Rejected):
+        admission.check(400, 2, 100, CAPACITY, batch=True)
+
+
+def test_zero_budgets_disable_the_check():
+    AdmissionController(max_wait=0, batch_max_wait=0, default_duration=20).check(10 ** 6, 2, 1, CAPACITY)
+
+
+def test_no_capacity_is_rejected(admission):
+    with pytest.raises(Rejected) as rejected:
+        admission.check(0, 0, 1, 0)
+    assert rejected.value.reason == 'no_backend'
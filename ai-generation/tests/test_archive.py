@@ -0,0 +1,136 @@
+import asyncio
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from api.archive import JobArchive
+from api.database import GenerationJob, ensure_schema
+
+NOW = datetime(2026, 10, 17, 12, 0, 0)
+OLD = NOW - timedelta(days=40)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'jobs.db'}")
+    asyncio.run(ensure_schema(engine))
+    archive = JobArchive(
+        async_sessionmaker(engine, expire_on_commit=False),
+        root=str(tmp_path / 'archive'),
+        retention_days=30,
+        batch_size=2
+    )
+    yield archive
+    asyncio.run(engine.dispose())
+
+
+def add_jobs(archive, *jobs):
+    async def add():
+        async with archive.session_factory() as db:
+            db.add_all(jobs)
+            await db.commit()
+    asyncio.run(add())
+
+
+def job_ids(archive):
+    async def ids():
+        async with archive.session_factory() as db:
+            return set((await db.execute(select(GenerationJob.id))).scalars())
+    return asyncio.run(ids())
+
+
+def test_archives_every_finished_status(archive):
+    add_jobs(
+        archive,
+        GenerationJob(id='completed', status='completed', completed_at=OLD, result={'images': []}),
+        GenerationJob(id='failed', status='failed', completed_at=OLD, error_message='boom'),
+        GenerationJob(id='cancelled', status='cancelled', completed_at=OLD, error_message='Cancelled'),
+        GenerationJob(id='pending', status='pending'),
+        GenerationJob(id='recent', status='cancelled', completed_at=NOW - timedelta(days=1)),
+    )
+
+    assert asyncio.run(archive.run_once(now=NOW)) == 3
+    assert job_ids(archive) == {'pending', 'recent'}
+
+    cancelled = asyncio.run(archive.get('cancelled'))
+    assert cancelled.status == 'cancelled'
+    assert cancelled.error_message == 'Cancelled'
+    assert cancelled.completed_at == OLD
+    assert asyncio.run(archive.get('failed')).error_message == 'boom'
+    assert asyncio.run(archive.get('pending')) is None
+
+
+def test_keeps_jobs_with_pending_webhooks_and_drops_secrets(archive):
+    add_jobs(
+        archive,
+        GenerationJob(id='waiting', status='cancelled', completed_at=OLD, callback_url='http://hook', callback_status='pending'),
+        GenerationJob(id='delivered', status='completed', completed_at=OLD, callback_url='http://hook',
+                      callback_secret='s3cret', callback_status='delivered'),
+    )
+
+    assert asyncio.run(archive.run_once(now=NOW)) == 1
+    assert job_ids(archive) == {'waiting'}
+
+    path = os.path.join(archive.root, archive.partition(OLD.date()))
+    with gzip.open(path, 'rt') as f:
+        records = [json.loads(line) for line in f]
+    assert [record['id'] for record in records] == ['delivered']
+    assert 'callback_secret' not in records[0]
+
+
+def test_appends_members_to_a_date_partition(archive):
+    add_jobs(archive, *(GenerationJob(id=f'job-{i}', status='completed', completed_at=OLD) for i in range(5)))
+
+    assert asyncio.run(archive.run_once(now=NOW)) == 5
+
+    path = os.path.join(archive.root, archive.partition(OLD.date()))
+    with gzip.open(path, 'rt') as f:
+        assert len(f.readlines()) == 5
+    for i in range(5):
+        assert asyncio.run(archive.get(f'job-{i}')).id == f'job-{i}'
+
+
+def test_concurrent_sweeps_archive_each_job_once(archive, tmp_path):
+    add_jobs(archive, *(GenerationJob(id=f'job-{i:02d}', status='completed', completed_at=OLD) for i in range(20)))
+
+    async def sweep_from_two_processes():
+        # A second engine, as another uvicorn worker would have
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'jobs.db'}")
+        other = JobArchive(
+            async_sessionmaker(engine, expire_on_commit=False),
+            root=archive.root,
+            retention_days=30,
+            batch_size=2
+        )
+        try:
+            return await asyncio.gather(archive.run_once(now=NOW), other.run_once(now=NOW))
+        finally:
+            await engine.dispose()
+
+    assert sum(asyncio.run(sweep_from_two_processes())) == 20
+    assert job_ids(archive) == set()
+
+    path = os.path.join(archive.root, archive.partition(OLD.date()))
+    with gzip.open(path, 'rt') as f:
+        ids = [json.loads(line)['id'] for line in f]
+    assert sorted(ids) == [f'job-{i:02d}' for i in range(20)]
+    for i in range(20):
+        assert asyncio.run(archive.get(f'job-{i:02d}')).id == f'job-{i:02d}'
+
+
+def test_takes_over_jobs_from_an_expired_archive_lease(archive):
+    add_jobs(
+        archive,
+        GenerationJob(id='abandoned', status='completed', completed_at=OLD,
+                      lease_owner='archive:dead:1:abc', lease_expires_at=datetime.utcnow() - timedelta(seconds=1)),
+        GenerationJob(id='in-progress', status='completed', completed_at=OLD,
+                      lease_owner='archive:busy:2:def', lease_expires_at=datetime.utcnow() + timedelta(hours=1)),
+    )
+
+    assert asyncio.run(archive.run_once(now=NOW)) == 1
+    assert job_ids(archive) == {'in-progress'}
@@ -0,0 +1,158 @@
+import asyncio
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from api.backend_pool import BackendPool
+from api.database import GenerationJob, ensure_schema
+from api.job_queue import JobQueue
+from api.scheduler import JobScheduler
+from api.sd_client import SDAPIClient
+from scripts.mock_sd_server import MockSDBackend, MockSDTransport
+
+BACKENDS = 2
+CHARACTERS = 4
+JOBS_PER_CHARACTER = 4
+# Claims by the two workers race by up to a database round trip
+CLAIM_SLACK = 0.05
+
+
+async def run_jobs(path, affinity, max_delay=30.0, lora_swap_seconds=0.1):
+    """
+    Run a shuffled burst of jobs for several characters through the queue,
+    scheduler and pool against mock backends with one LoRA slot each, as
+    benchmarks/lora_affinity.py does. Returns the LoRA swaps, each job's
+    latency, and the queue order and claim time of each job.
+    """
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    await ensure_schema(engine)
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    mocks = {
+        f"sd-{i}": MockSDBackend(step_seconds=0.002, call_seconds=0.01, lora_swap_seconds=lora_swap_seconds, lora_slots=1, seed=i)
+        for i in range(BACKENDS)
+    }
+    pool = BackendPool(
+        [f"http://{host}" for host in mocks],
+        max_concurrent_per_backend=1,
+        lora_slots=1,
+        affinity=affinity,
+        health_interval=3600,
+        transport=MockSDTransport(mocks)
+    )
+    queue = JobQueue(session_factory)
+    claimed, latencies = {}, {}
+    done = asyncio.Event()
+
+    async def handler(claim):
+        claimed[claim.id] = time.perf_counter() - started
+        character_id = claim.request['character_id']
+        payload = SDAPIClient.default_payload(
+            f"photo of {character_id}, <lora:{character_id}_lora:1.0>", "blurry", width=64, height=64
+        )
+        payload['steps'] = 10
+        await pool.txt2img(payload, job_id=claim.id)
+        await queue.complete(claim, result={})
+        latencies[claim.id] = time.perf_counter() - started
+        if len(latencies) == len(order):
+            done.set()
+
+    scheduler = JobScheduler(
+        queue,
+        handler,
+        max_concurrent=BACKENDS,
+        poll_interval=1,
+        retry_attempts=1,
+        preference=lambda: {lora[:-len('_lora')] for lora in pool.warm_loras()} if affinity else (),
+        affinity_window=8,
+        affinity_max_delay=max_delay
+    )
+
+    workload = [f"character_{i}" for i in range(CHARACTERS) for _ in range(JOBS_PER_CHARACTER)]
+    random.Random(7).shuffle(workload)
+    order = [f"job_{idx:02d}_{character_id}" for idx, character_id in enumerate(workload)]
+    created = datetime.utcnow()
+    await pool.start()
+    async with session_factory() as db:
+        db.add_all(
+            GenerationJob(
+                id=job_id,
+                character_id=character_id,
+                status="pending",
+                request={'character_id': character_id},
+                created_at=created + timedelta(microseconds=idx)
+            )
+            for idx, (job_id, character_id) in enumerate(zip(order, workload))
+        )
+        await db.commit()
+    started = time.perf_counter()
+    await scheduler.start()
+    try:
+        await asyncio.wait_for(done.wait(), timeout=60)
+        # Let idle workers finish their last claim query before they are cancelled
+        await asyncio.sleep(0.1)
+    finally:
+        await scheduler.stop()
+        await pool.close()
+        await engine.dispose()
+
+    swaps = sum(mock.stats['lora_swaps'] for mock in mocks.values())
+    return swaps, latencies, order, claimed
+
+
+def test_affinity_reduces_lora_swaps_and_median_latency(tmp_path):
+    # Swaps slow enough that the latency difference is not lost in scheduling noise
+    baseline_swaps, baseline_latencies, _, _ = asyncio.run(
+        run_jobs(tmp_path / 'baseline.db', affinity=False, lora_swap_seconds=0.3)
+    )
+    swaps, latencies, _, _ = asyncio.run(run_jobs(tmp_path / 'affinity.db', affinity=True, lora_swap_seconds=0.3))
+
+    assert swaps < baseline_swaps
+    assert statistics.median(latencies.values()) < statistics.median(baseline_latencies.values())
+
+
+@pytest.mark.parametrize('max_delay', [0.3, 0.6])
+def test_no_job_is_passed_over_after_max_delay(tmp_path, max_delay):
+    swaps, _, order, claimed = asyncio.run(run_jobs(tmp_path / 'affinity.db', affinity=True, max_delay=max_delay))
+
+    # Every job was queued at the start, so a job claimed clearly ahead of an
+    # older one that was still pending must have been claimed within max_delay
+    jumped = [
+        claimed[later]
+        for idx, earlier in enumerate(order)
+        for later in order[idx + 1:]
+        if claimed[earlier] - claimed[later] > CLAIM_SLACK
+    ]
+    assert jumped, "affinity never reordered the queue"
+    assert max(jumped) < max_delay + CLAIM_SLACK
+
+
+def test_warm_job_is_claimed_ahead_of_a_fresh_head_only(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'jobs.db'}")
+    queue = JobQueue(async_sessionmaker(engine, expire_on_commit=False))
+    now = datetime.utcnow()
+
+    async def claim(head_waited):
+        async with queue.session_factory() as db:
+            db.add_all([
+                GenerationJob(id='cold', character_id='cold', status='pending', created_at=now - timedelta(seconds=head_waited)),
+                GenerationJob(id='warm', character_id='warm', status='pending', created_at=now),
+            ])
+            await db.commit()
+        claim = await queue.claim(prefer={'warm'}, window=8, max_delay=120)
+        async with queue.session_factory() as db:
+            await db.execute(GenerationJob.__table__.delete())
+            await db.commit()
+        return claim.id
+
+    async def run():
+        await ensure_schema(engine)
+        try:
+            return await claim(head_waited=60), await claim(head_waited=121)
+        finally:
+            await engine.dispose()
+
+    assert asyncio.run(run()) == ('warm', 'cold')
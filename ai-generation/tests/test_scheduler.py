@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from api.database import GenerationJob, ensure_schema
+from api.job_queue import JobQueue
+from api.scheduler import JobScheduler
+
+
+@pytest.fixture
+def queue(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'jobs.db'}")
+    asyncio.run(ensure_schema(engine))
+    yield JobQueue(async_sessionmaker(engine, expire_on_commit=False))
+    asyncio.run(engine.dispose())
+
+
+def run_failing_job(queue, cancel_after=None):
+    """Run one job whose handler always fails; returns its handler calls, failure hook calls and final status"""
+    calls, failures = [], []
+
+    async def handler(claim):
+        calls.append(claim.id)
+        raise RuntimeError("boom")
+
+    async def on_failure(claim, error):
+        failures.append(claim.id)
+
+    async def run():
+        async with queue.session_factory() as db:
+            db.add(GenerationJob(id='job', status='pending'))
+            await db.commit()
+        scheduler = JobScheduler(
+            queue, handler, on_failure=on_failure,
+            max_concurrent=1, retry_attempts=3, retry_backoff=0.2, poll_interval=0.05
+        )
+        await scheduler.start()
+        try:
+            if cancel_after is not None:
+                await asyncio.sleep(cancel_after)
+                await queue.cancel('job')
+            for _ in range(100):
+                await asyncio.sleep(0.05)
+                async with queue.session_factory() as db:
+                    status = (await db.get(GenerationJob, 'job')).status
+                if status != 'processing' and not scheduler.in_flight:
+                    return calls, failures, status
+        finally:
+            await scheduler.stop()
+
+    return asyncio.run(run())
+
+
+def test_fails_after_retries(queue):
+    calls, failures, status = run_failing_job(queue)
+
+    assert len(calls) == 3
+    assert failures == ['job']
+    assert status == 'failed'
+
+
+def test_job_cancelled_between_attempts_is_not_retried_or_failed(queue):
+    # Cancelled while the worker backs off after the first failure
+    calls, failures, status = run_failing_job(queue, cancel_after=0.1)
+
+    assert len(calls) == 1
+    assert failures == []
+    assert status == 'cancelled'
@@ -0,0 +1,78 @@
+import asyncio
+from datetime import datetime
+
+import httpx
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from api.database import GenerationJob, ensure_schema
+from api.webhooks import WebhookDispatcher, callback_refusal, is_public_address
+
+
+@pytest.mark.parametrize('address', [
+    '127.0.0.1', '10.1.2.3', '172.16.0.1', '192.168.1.1', '169.254.169.254',
+    '100.64.0.1', '0.0.0.0', '224.0.0.1', '::1', 'fe80::1', 'fd00::1', '::ffff:127.0.0.1',
+])
+def test_internal_addresses_are_not_public(address):
+    assert not is_public_address(address)
+
+
+@pytest.mark.parametrize('address', ['93.184.216.34', '2606:2800:220:1:248:1893:25c8:1946'])
+def test_public_addresses(address):
+    assert is_public_address(address)
+
+
+@pytest.mark.parametrize('url', [
+    'http://169.254.169.254/latest/meta-data/',
+    'http://127.0.0.1:8080/hook',
+    'http://localhost/hook',
+    'http://10.0.0.5/hook',
+    'http://[::1]/hook',
+    'http://[::ffff:169.254.169.254]/hook',
+    'ftp://93.184.216.34/hook',
+    'http:///hook',
+])
+def test_refuses_internal_callbacks_by_default(url):
+    assert asyncio.run(callback_refusal(url, allowed_hosts='')) is not None
+
+
+def test_allows_public_callbacks_by_default():
+    assert asyncio.run(callback_refusal('https://93.184.216.34/hook', allowed_hosts='')) is None
+
+
+def test_allow_list_overrides_address_checks():
+    allowed = 'backend.internal, 10.0.0.5'
+    assert asyncio.run(callback_refusal('http://10.0.0.5/hook', allowed_hosts=allowed)) is None
+    assert asyncio.run(callback_refusal('http://169.254.169.254/latest', allowed_hosts=allowed)) is not None
+
+
+def test_delivery_to_internal_host_fails_without_a_request(tmp_path):
+    sent = []
+    transport = httpx.MockTransport(lambda request: sent.append(request) or httpx.Response(200))
+
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'jobs.db'}")
+        await ensure_schema(engine)
+        session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        async with session_factory() as db:
+            db.add(GenerationJob(
+                id='job', status='completed', completed_at=datetime.utcnow(),
+                callback_url='http://169.254.169.254/latest', callback_secret='x' * 16, callback_status='pending'
+            ))
+            await db.commit()
+
+        dispatcher = WebhookDispatcher(session_factory, transport=transport)
+        await dispatcher.start()
+        try:
+            await dispatcher._deliver('job')
+        finally:
+            await dispatcher.stop()
+        async with session_factory() as db:
+            job = await db.get(GenerationJob, 'job')
+        await engine.dispose()
+        return job
+
+    job = asyncio.run(run())
+    assert sent == []
+    assert job.callback_status == 'failed'
+    assert 'not a public address' in job.callback_error
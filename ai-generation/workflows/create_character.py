@@ -11,18 +11,28 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from generate_training_data import TrainingDataGenerator
+from generate_training_data import TrainingDataGenerator, load_webui_auth
 from train_lora import LoRATrainer
+from api.backend_pool import BackendPool
+from scripts.character_registry import get_registry
 from scripts.prompt_generator import PromptGenerator
 from scripts.tag_extractor import TagExtractor
 from scripts.s3_sync import S3Uploader
-import httpx
 import base64
+from typing import List, Optional, Union
 
 class CharacterCreationWorkflow:
-    def __init__(self, sd_api_url: str = "http://localhost:7860"):
+    def __init__(
+        self,
+        sd_api_url: Union[str, List[str]] = "http://localhost:7860",
+        backend_pool: Optional[BackendPool] = None
+    ):
         self.sd_api_url = sd_api_url
-        self.training_generator = TrainingDataGenerator(sd_api_url)
+        self.backend_pool = backend_pool or BackendPool(
+            [sd_api_url] if isinstance(sd_api_url, str) else list(sd_api_url),
+            auth=load_webui_auth()
+        )
+        self.training_generator = TrainingDataGenerator(sd_api_url, backend_pool=self.backend_pool)
         self.lora_trainer = LoRATrainer()
         self.prompt_generator = PromptGenerator()
         self.tag_extractor = TagExtractor()
@@ -54,10 +64,12 @@ class CharacterCreationWorkflow:
                 'step': 'training_data_generation',
                 'status': training_result[character_id]['status'],
                 'files_generated': training_result[character_id].get('count', 0),
+                'files_failed': len(training_result[character_id].get('failed', [])),
                 'timestamp': datetime.utcnow().isoformat()
             })
             
-            if training_result[character_id]['status'] != 'success':
+            # A partial set still goes to manual approval, which lists what is missing
+            if training_result[character_id]['status'] not in ('success', 'partial'):
                 raise Exception("Failed to generate training data")
             
             # Step 2: Manual approval (or auto-approve)
@@ -66,6 +78,8 @@ class CharacterCreationWorkflow:
                 print("MANUAL APPROVAL REQUIRED")
                 print("="*60)
                 print(f"Training data generated in: ../models/training_data/{character_id}/")
+                for failure in training_result[character_id].get('failed', []):
+                    print(f"Missing image {failure['image_index'] + 1} ({failure['variation']}): {failure['error']}")
                 print("Please review the images and ensure they meet quality standards.")
                 print("\nCheck for:")
                 print("- Consistent facial features")
@@ -106,12 +120,13 @@ class CharacterCreationWorkflow:
             
             # Step 4: Generate final images
             print("\nStep 4: Generating final images...")
-            final_images = await self.generate_final_images(character_id)
+            final_images, failed_images = await self.generate_final_images(character_id)
             
             workflow_log['steps'].append({
                 'step': 'final_generation',
-                'status': 'success' if final_images else 'failed',
+                'status': ('partial' if failed_images else 'success') if final_images else 'failed',
                 'images_generated': len(final_images),
+                'images_failed': failed_images,
                 'timestamp': datetime.utcnow().isoformat()
             })
             
@@ -157,87 +172,84 @@ class CharacterCreationWorkflow:
         return workflow_log
     
     async def generate_final_images(self, character_id: str, count: int = 20):
-        """Generate final images using trained LoRA"""
-        # Load character data
-        with open('../config/characters.json', 'r') as f:
-            characters = json.load(f)['characters']
-        character = next((c for c in characters if c['id'] == character_id), None)
-        
-        if not character:
-            raise ValueError(f"Character {character_id} not found")
+        """Generate final images using trained LoRA; returns the images and the ones that failed"""
+        character = get_registry().require(character_id)
         
         final_images = []
         output_dir = Path(f"../models/final_images/{character_id}")
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        async with httpx.AsyncClient(timeout=600) as client:
-            # Generate 10 ass-focused and 10 tits-focused images
-            for focus in ['ass', 'tits']:
-                for i in range(count // 2):
-                    try:
-                        # Generate varied prompt
-                        prompt, tags = self.prompt_generator.generate_prompt(
-                            character_id=character_id,
-                            character_lora=f"{character_id}_lora",
-                            focus=focus,
-                            is_nude=False  # Start with clothed variations
-                        )
-                        
-                        # API payload
-                        payload = {
-                            "prompt": prompt,
-                            "negative_prompt": "blurry, deformed, ugly, bad anatomy",
-                            "steps": 50,
-                            "sampler_name": "DPM++ 2M Karras",
-                            "cfg_scale": 7.5,
-                            "width": 1024,
-                            "height": 1024,
-                            "seed": -1  # Random seed for variety
-                        }
-                        
-                        print(f"  Generating {focus} image {i+1}/{count//2}...")
-                        
-                        response = await client.post(
-                            f"{self.sd_api_url}/sdapi/v1/txt2img",
-                            json=payload
-                        )
-                        response.raise_for_status()
-                        
-                        result = response.json()
-                        images = result.get('images', [])
-                        
-                        if images:
-                            # Save image
-                            img_data = base64.b64decode(images[0])
-                            timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-                            filename = f"{character_id}_{focus}_{timestamp}_{i}.png"
-                            filepath = output_dir / filename
-                            
-                            with open(filepath, 'wb') as f:
-                                f.write(img_data)
-                            
-                            # Extract tags
-                            extracted_tags = self.tag_extractor.extract_from_prompt(prompt, character)
-                            
-                            final_images.append({
-                                'path': str(filepath),
-                                'filename': filename,
-                                'prompt': prompt,
-                                'tags': extracted_tags.to_dict(),
-                                'focus': focus,
-                                'parameters': result.get('parameters', {})
-                            })
-                            
-                            print(f"    ✓ Generated: {filename}")
-                    
-                    except Exception as e:
-                        print(f"    ✗ Error generating image: {e}")
-                        continue
-                    
-                    # Small delay
-                    await asyncio.sleep(2)
+        async def generate_one(focus: str, i: int):
+            async with slots:
+                # Generate varied prompt
+                prompt, tags = self.prompt_generator.generate_prompt(
+                    character_id=character_id,
+                    character_lora=f"{character_id}_lora",
+                    focus=focus,
+                    is_nude=False  # Start with clothed variations
+                )
+                
+                # API payload
+                payload = {
+                    "prompt": prompt,
+                    "negative_prompt": "blurry, deformed, ugly, bad anatomy",
+                    "steps": 50,
+                    "sampler_name": "DPM++ 2M Karras",
+                    "cfg_scale": 7.5,
+                    "width": 1024,
+                    "height": 1024,
+                    "seed": -1  # Random seed for variety
+                }
+                
+                print(f"  Generating {focus} image {i+1}/{count//2}...")
+                
+                result = await self.backend_pool.txt2img(payload)
+                images = result.get('images', [])
+                
+                if not images:
+                    raise RuntimeError("No image returned")
+                
+                # Save image
+                img_data = base64.b64decode(images[0])
+                timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+                filename = f"{character_id}_{focus}_{timestamp}_{i}.png"
+                filepath = output_dir / filename
+                
+                with open(filepath, 'wb') as f:
+                    f.write(img_data)
+                
+                # Extract tags
+                extracted_tags = self.tag_extractor.extract_from_prompt(prompt, character)
+                
+                final_images.append({
+                    'path': str(filepath),
+                    'filename': filename,
+                    'prompt': prompt,
+                    'tags': extracted_tags.to_dict(),
+                    'focus': focus,
+                    'parameters': result.get('parameters', {})
+                })
+                
+                print(f"    ✓ Generated: {filename}")
+        
+        # Generate 10 ass-focused and 10 tits-focused images across all backends,
+        # only as many at once as the backends run so none waits out SD_ACQUIRE_TIMEOUT
+        await self.backend_pool.start()
+        slots = asyncio.Semaphore(self.backend_pool.capacity)
+        planned = [(focus, i) for focus in ['ass', 'tits'] for i in range(count // 2)]
+        results = await asyncio.gather(
+            *(generate_one(focus, i) for focus, i in planned),
+            return_exceptions=True
+        )
+        failed = [
+            {'focus': focus, 'index': i, 'error': str(result)}
+            for (focus, i), result in zip(planned, results)
+            if isinstance(result, Exception)
+        ]
+        for failure in failed:
+            print(f"    ✗ Error generating {failure['focus']} image {failure['index'] + 1}: {failure['error']}")
         
-        return final_images
+        return final_images, failed
     
     async def upload_to_s3(self, character_id: str, images: list, lora_path: str):
         """Upload images and LoRA to S3"""
@@ -280,16 +292,24 @@ async def main():
     parser = argparse.ArgumentParser(description="Complete character creation workflow")
     parser.add_argument('character_id', help='Character ID to create')
     parser.add_argument('--auto-approve', action='store_true', help='Skip manual approval')
-    parser.add_argument('--sd-url', default='http://localhost:7860', help='SD API URL')
+    parser.add_argument('--sd-url', nargs='+', default=['http://localhost:7860'], help='SD API URL(s)')
     
     args = parser.parse_args()
     
     workflow = CharacterCreationWorkflow(sd_api_url=args.sd_url)
-    result = await workflow.create_character(args.character_id, auto_approve=args.auto_approve)
+    try:
+        result = await workflow.create_character(args.character_id, auto_approve=args.auto_approve)
+    finally:
+        await workflow.backend_pool.close()
     
     print(f"\nWorkflow status: {result['status']}")
     if result['status'] == 'failed':
         print(f"Error: {result.get('error', 'Unknown error')}")
+        return 1
+    # Completed, but with images missing
+    if any(step['status'] == 'partial' for step in result['steps']):
+        return 1
+    return 0
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    sys.exit(asyncio.run(main()))
\ No newline at end of file
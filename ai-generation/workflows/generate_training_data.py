@@ -4,7 +4,6 @@ Creates 5-10 nude base images per character for training
 """
 
 import asyncio
-import httpx
 import json
 import base64
 import os
@@ -13,12 +12,31 @@ from pathlib import Path
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from api.backend_pool import BackendPool
+from api.sd_client import load_sd_auth
+from scripts.character_registry import get_registry
 from scripts.prompt_generator import PromptGenerator
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple, Union
+
+def load_webui_auth():
+    """Read the WebUI API key written by the installer"""
+    api_key_path = Path("../setup/stable-diffusion-webui/api_key.txt")
+    if api_key_path.exists():
+        return load_sd_auth(api_key_path.read_text().strip())
+    return None
 
 class TrainingDataGenerator:
-    def __init__(self, sd_api_url: str = "http://localhost:7860"):
+    def __init__(
+        self,
+        sd_api_url: Union[str, List[str]] = "http://localhost:7860",
+        backend_pool: Optional[BackendPool] = None
+    ):
         self.sd_api_url = sd_api_url
+        # Share one pool across workflows so every backend stays busy
+        self.backend_pool = backend_pool or BackendPool(
+            [sd_api_url] if isinstance(sd_api_url, str) else list(sd_api_url),
+            auth=load_webui_auth()
+        )
         self.prompt_generator = PromptGenerator()
         self.output_dir = Path("../models/training_data")
         self.output_dir.mkdir(parents=True, exist_ok=True)
@@ -37,13 +55,11 @@ class TrainingDataGenerator:
             "standing twist, looking over shoulder"
         ]
     
-    async def generate_base_images(self, character: Dict) -> List[str]:
-        """Generate nude base images for a character"""
+    async def generate_base_images(self, character: Dict) -> Tuple[List[str], List[Dict]]:
+        """Generate nude base images for a character; returns the saved files and the variations that failed"""
         character_dir = self.output_dir / character['id']
         character_dir.mkdir(exist_ok=True)
         
-        generated_files = []
-        
         print(f"\nGenerating training data for {character['name']}...")
         
         # Build base description from character data
@@ -57,92 +73,98 @@ class TrainingDataGenerator:
             features = ', '.join(character['distinctive_features'])
             base_description += f", {features}"
         
-        # Read API key
-        api_key_path = Path("../setup/stable-diffusion-webui/api_key.txt")
-        if api_key_path.exists():
-            api_key = api_key_path.read_text().strip()
-            auth = (api_key.split(':')[0], api_key.split(':')[1])
-        else:
-            auth = None
-            
-        async with httpx.AsyncClient(timeout=600, auth=auth) as client:
-            for idx, variation in enumerate(self.training_variations):
-                try:
-                    # Generate training prompt
-                    prompt = self.prompt_generator.generate_training_prompt(
-                        base_description=base_description,
-                        variation=variation,
-                        is_nude=True
-                    )
-                    
-                    # Negative prompt for quality and ensure nudity
-                    negative_prompt = """blurry, deformed, ugly, bad anatomy, disfigured, 
-                    poorly drawn face, mutation, mutated, extra limb, ugly, poorly drawn hands, 
-                    missing limb, floating limbs, disconnected limbs, malformed hands, 
-                    out of focus, long neck, long body, childish, child-like, underage,
-                    clothing, clothes, underwear, bra, panties, bikini, swimsuit, fabric, textile"""
-                    
-                    # API payload with optimal settings for RealVisXL V5.0
-                    payload = {
-                        "prompt": prompt,
-                        "negative_prompt": negative_prompt,
-                        "steps": 35,
-                        "sampler_name": "DPM++ 2M SDE Karras",
-                        "cfg_scale": 5.0,  # Lower for SDXL models
-                        "width": 1024,
-                        "height": 1024,
-                        "seed": 42 + idx,  # Consistent seeds for reproducibility
-                    }
-                    
-                    print(f"  Generating image {idx + 1}/10: {variation[:30]}...")
-                    
-                    # Generate image
-                    response = await client.post(
-                        f"{self.sd_api_url}/sdapi/v1/txt2img",
-                        json=payload
-                    )
-                    response.raise_for_status()
-                    
-                    result = response.json()
-                    images = result.get('images', [])
-                    
-                    if images:
-                        # Save image
-                        img_data = base64.b64decode(images[0])
-                        filename = f"{character['id']}_training_{idx:03d}.png"
-                        filepath = character_dir / filename
-                        
-                        with open(filepath, 'wb') as f:
-                            f.write(img_data)
-                        
-                        generated_files.append(str(filepath))
-                        
-                        # Save metadata
-                        metadata = {
-                            "character_id": character['id'],
-                            "character_name": character['name'],
-                            "image_index": idx,
-                            "variation": variation,
-                            "prompt": prompt,
-                            "negative_prompt": negative_prompt,
-                            "parameters": payload,
-                            "generated_at": datetime.utcnow().isoformat()
-                        }
-                        
-                        meta_filepath = character_dir / f"{character['id']}_training_{idx:03d}_meta.json"
-                        with open(meta_filepath, 'w') as f:
-                            json.dump(metadata, f, indent=2)
-                        
-                        print(f"    ✓ Saved: {filename}")
-                    
-                except Exception as e:
-                    print(f"    ✗ Error generating image {idx + 1}: {e}")
-                    continue
+        # Negative prompt for quality and ensure nudity
+        negative_prompt = """blurry, deformed, ugly, bad anatomy, disfigured, 
+        poorly drawn face, mutation, mutated, extra limb, ugly, poorly drawn hands, 
+        missing limb, floating limbs, disconnected limbs, malformed hands, 
+        out of focus, long neck, long body, childish, child-like, underage,
+        clothing, clothes, underwear, bra, panties, bikini, swimsuit, fabric, textile"""
+        
+        async def generate_variation(idx: int, variation: str) -> str:
+            async with slots:
+                # Generate training prompt
+                prompt = self.prompt_generator.generate_training_prompt(
+                    base_description=base_description,
+                    variation=variation,
+                    is_nude=True
+                )
+                
+                # API payload with optimal settings for RealVisXL V5.0
+                payload = {
+                    "prompt": prompt,
+                    "negative_prompt": negative_prompt,
+                    "steps": 35,
+                    "sampler_name": "DPM++ 2M SDE Karras",
+                    "cfg_scale": 5.0,  # Lower for SDXL models
+                    "width": 1024,
+                    "height": 1024,
+                    "seed": 42 + idx,  # Consistent seeds for reproducibility
+                }
+                
+                filename = f"{character['id']}_training_{idx:03d}.png"
+                filepath = character_dir / filename
+                meta_filepath = character_dir / f"{character['id']}_training_{idx:03d}_meta.json"
+                
+                # The seed is fixed, so an image saved from the same payload is reused as is
+                if filepath.exists() and meta_filepath.exists():
+                    with open(meta_filepath) as f:
+                        if json.load(f).get('parameters') == payload:
+                            print(f"  Reusing image {idx + 1}/{len(self.training_variations)}: {filename}")
+                            return str(filepath)
+                
+                print(f"  Generating image {idx + 1}/{len(self.training_variations)}: {variation[:30]}...")
+                
+                # Generate image on the least-loaded backend
+                result = await self.backend_pool.txt2img(payload)
+                images = result.get('images', [])
                 
-                # Small delay between generations
-                await asyncio.sleep(2)
+                if not images:
+                    raise RuntimeError("No image returned")
+                
+                # Save image
+                img_data = base64.b64decode(images[0])
+                
+                with open(filepath, 'wb') as f:
+                    f.write(img_data)
+                
+                # Save metadata
+                metadata = {
+                    "character_id": character['id'],
+                    "character_name": character['name'],
+                    "image_index": idx,
+                    "variation": variation,
+                    "prompt": prompt,
+                    "negative_prompt": negative_prompt,
+                    "parameters": payload,
+                    "generated_at": datetime.utcnow().isoformat()
+                }
+                
+                with open(meta_filepath, 'w') as f:
+                    json.dump(metadata, f, indent=2)
+                
+                print(f"    ✓ Saved: {filename}")
+                return str(filepath)
+        
+        # Only as many requests in flight as the backends run at once, so none
+        # waits out SD_ACQUIRE_TIMEOUT in the pool
+        await self.backend_pool.start()
+        slots = asyncio.Semaphore(self.backend_pool.capacity)
+        results = await asyncio.gather(*(
+            generate_variation(idx, variation)
+            for idx, variation in enumerate(self.training_variations)
+        ), return_exceptions=True)
+        generated_files = [path for path in results if isinstance(path, str)]
+        failed = [
+            {"image_index": idx, "variation": variation, "error": str(result)}
+            for idx, (variation, result) in enumerate(zip(self.training_variations, results))
+            if isinstance(result, Exception)
+        ]
+        for failure in failed:
+            print(f"    ✗ Error generating image {failure['image_index'] + 1}: {failure['error']}")
         
         print(f"  Generated {len(generated_files)} training images for {character['name']}")
+        if failed:
+            print(f"  {len(failed)} of {len(self.training_variations)} images failed")
         
         # Create summary file
         summary = {
@@ -150,6 +172,7 @@ class TrainingDataGenerator:
             "character_name": character['name'],
             "total_images": len(generated_files),
             "image_files": [os.path.basename(f) for f in generated_files],
+            "failed_images": failed,
             "generated_at": datetime.utcnow().isoformat(),
             "ready_for_training": len(generated_files) >= 5
         }
@@ -158,16 +181,11 @@ class TrainingDataGenerator:
         with open(summary_path, 'w') as f:
             json.dump(summary, f, indent=2)
         
-        return generated_files
+        return generated_files, failed
     
     async def generate_for_character_batch(self, character_ids: List[str]):
         """Generate training data for a batch of characters"""
-        # Load character data
-        with open('../config/characters.json', 'r') as f:
-            all_characters = json.load(f)['characters']
-        
-        # Filter to requested characters
-        characters = [c for c in all_characters if c['id'] in character_ids]
+        characters = get_registry().filter(character_ids)
         
         if not characters:
             print(f"No characters found with IDs: {character_ids}")
@@ -178,11 +196,12 @@ class TrainingDataGenerator:
         results = {}
         for character in characters:
             try:
-                files = await self.generate_base_images(character)
+                files, failed = await self.generate_base_images(character)
                 results[character['id']] = {
-                    'status': 'success',
+                    'status': 'partial' if failed else 'success',
                     'files': files,
-                    'count': len(files)
+                    'count': len(files),
+                    'failed': failed
                 }
             except Exception as e:
                 print(f"Failed to generate data for {character['name']}: {e}")
@@ -211,24 +230,31 @@ async def main():
     import argparse
     parser = argparse.ArgumentParser(description="Generate training data for characters")
     parser.add_argument('--characters', nargs='+', help='Character IDs to process')
-    parser.add_argument('--sd-url', default='http://localhost:7860', help='Stable Diffusion API URL')
+    parser.add_argument('--sd-url', nargs='+', default=['http://localhost:7860'], help='Stable Diffusion API URL(s)')
     parser.add_argument('--test', action='store_true', help='Test with first character only')
     
     args = parser.parse_args()
     
     generator = TrainingDataGenerator(sd_api_url=args.sd_url)
+    try:
+        results = await run_cli(generator, args)
+    finally:
+        await generator.backend_pool.close()
     
+    # Non-zero exit when any character is missing images
+    return 0 if results and all(r['status'] == 'success' for r in results.values()) else 1
+
+async def run_cli(generator: TrainingDataGenerator, args) -> Optional[Dict]:
     if args.test:
         # Test with Emma Riley
-        await generator.generate_for_character_batch(['emma_riley'])
+        return await generator.generate_for_character_batch(['emma_riley'])
     elif args.characters:
         # Generate for specified characters
-        await generator.generate_for_character_batch(args.characters)
+        return await generator.generate_for_character_batch(args.characters)
     else:
         # Interactive mode
         print("Available characters:")
-        with open('../config/characters.json', 'r') as f:
-            characters = json.load(f)['characters']
+        characters = get_registry().all()
         
         for i, char in enumerate(characters):
             print(f"{i+1}. {char['name']} ({char['id']}) - {char['ethnicity']}")
@@ -242,9 +268,10 @@ async def main():
             character_ids = [characters[i]['id'] for i in indices if 0 <= i < len(characters)]
         
         if character_ids:
-            await generator.generate_for_character_batch(character_ids)
+            return await generator.generate_for_character_batch(character_ids)
         else:
             print("No valid characters selected.")
+            return None
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    sys.exit(asyncio.run(main()))
\ No newline at end of file
@@ -28,7 +28,7 @@ import {
 } from 'react-native-paper';
 import { MaterialCommunityIcons } from '@expo/vector-icons';
 import AdminRoute from '../../components/AdminRoute';
-import { aiGenerationAPI } from '../../../services/api/admin/aiGeneration';
+import { aiGenerationAPI, PartialBatchError } from '../../../services/api/admin/aiGeneration';
 import { format } from 'date-fns';
 
 interface Character {
@@ -161,7 +161,16 @@ export default function AIGeneration() {
               setPolling(true);
             } catch (error) {
               console.error('Failed to start generation:', error);
-              Alert.alert('Error', 'Failed to start generation');
+              if (error instanceof PartialBatchError) {
+                Alert.alert(
+                  'Partially Started',
+                  `Started generation of ${error.jobs.length} of ${generationSettings.count} images; the rest were refused. Check the job queue for progress.`,
+                  [{ text: 'OK', onPress: () => loadData() }]
+                );
+                setPolling(true);
+              } else {
+                Alert.alert('Error', 'Failed to start generation');
+              }
             } finally {
               setLoading(false);
             }
@@ -16,6 +16,41 @@ export interface GenerateImageRequest {
   lighting?: string;
   accessory?: string;
   batch_size?: number;
+  hires?: boolean;
+  mode?: 'full' | 'draft';
+  callback_url?: string;
+  callback_secret?: string;
+}
+
+export interface GenerateBatchRequest {
+  character_ids: string[];
+  focus?: Array<'ass' | 'tits'>;
+  is_nude?: boolean[];
+  scenes?: Array<string | null>;
+  poses?: Array<string | null>;
+  lightings?: Array<string | null>;
+  accessories?: Array<string | null>;
+  count?: number;
+  batch_size?: number;
+  priority?: number;
+  hires?: boolean;
+  mode?: 'full' | 'draft';
+  callback_url?: string;
+  callback_secret?: string;
+}
+
+export interface RefineRequest {
+  seeds?: number[];
+  priority?: number;
+  hires?: boolean;
+  callback_url?: string;
+  callback_secret?: string;
+}
+
+export interface BatchGenerationResponse {
+  job_ids: string[];
+  status: string;
+  message: string;
 }
 
 export interface GenerationJob {
@@ -27,19 +62,65 @@ export interface GenerationJob {
 export interface JobStatus {
   job_id: string;
   status: string;
+  stage?: 'base' | 'upscale';
+  mode?: 'full' | 'draft';
+  refined_from?: string | null;
+  gpu_seconds?: number | null;
+  gpu_seconds_saved?: number | null;
   progress: number;
   result?: {
     images: Array<{
       url: string;
       filename: string;
       tags: Record<string, any>;
+      seed?: number | null;
+      derivatives?: Record<string, {
+        url: string;
+        key: string;
+        format: string;
+        width: number;
+        height: number;
+        bytes: number;
+      }>;
     }>;
     prompt: string;
     parameters: Record<string, any>;
+    hires?: {
+      mode: 'img2img' | 'extras';
+      upscaler: string;
+      scale: number;
+      steps?: number;
+      denoise?: number;
+    };
   };
   error?: string;
+  callback?: {
+    url: string;
+    status: 'pending' | 'delivered' | 'failed';
+    attempts: number;
+    error?: string | null;
+    delivered_at?: string | null;
+  } | null;
 }
 
+export class AIGenerationAPIError extends Error {
+  constructor(public status: number, public retryAfterSeconds?: number) {
+    super(`API error: ${status}`);
+    this.name = 'AIGenerationAPIError';
+  }
+}
+
+/** Thrown by batchGenerate when some batches were queued before one failed */
+export class PartialBatchError extends Error {
+  constructor(public jobs: GenerationJob[], public reason: unknown) {
+    super(`Queued ${jobs.length} jobs before failing: ${reason instanceof Error ? reason.message : reason}`);
+    this.name = 'PartialBatchError';
+  }
+}
+
+// 429s are retried after Retry-After while the total wait stays under this
+const MAX_RETRY_WAIT_MS = 120000;
+
 class AIGenerationAPI {
   private headers = {
     'Content-Type': 'application/json',
@@ -65,6 +146,26 @@ class AIGenerationAPI {
     }
   }
 
+  async generateBatch(request: GenerateBatchRequest): Promise<BatchGenerationResponse> {
+    try {
+      const response = await fetch(`${AI_API_URL}/api/generate/batch`, {
+        method: 'POST',
+        headers: this.headers,
+        body: JSON.stringify(request),
+      });
+
+      if (!response.ok) {
+        const retryAfter = Number(response.headers.get('Retry-After'));
+        throw new AIGenerationAPIError(response.status, Number.isFinite(retryAfter) && retryAfter > 0 ? retryAfter : undefined);
+      }
+
+      return await response.json();
+    } catch (error) {
+      console.error('Generate batch error:', error);
+      throw error;
+    }
+  }
+
   async getJobStatus(jobId: string): Promise<JobStatus> {
     try {
       const response = await fetch(`${AI_API_URL}/api/status/${jobId}`, {
@@ -125,6 +226,63 @@ class AIGenerationAPI {
     }
   }
 
+  async cancelJob(jobId: string): Promise<GenerationJob> {
+    try {
+      const response = await fetch(`${AI_API_URL}/api/jobs/${jobId}`, {
+        method: 'DELETE',
+        headers: this.headers,
+      });
+
+      if (!response.ok) {
+        throw new Error(`API error: ${response.status}`);
+      }
+
+      return await response.json();
+    } catch (error) {
+      console.error('Cancel job error:', error);
+      throw error;
+    }
+  }
+
+  /**
+   * EventSource URL for a job's progress events. EventSource cannot send the
+   * API key header, so the URL carries a short-lived token for this job only.
+   */
+  async getJobEventsUrl(jobId: string, preview = false): Promise<string> {
+    const response = await fetch(`${AI_API_URL}/api/jobs/${jobId}/stream-token`, {
+      method: 'POST',
+      headers: this.headers,
+    });
+
+    if (!response.ok) {
+      throw new Error(`API error: ${response.status}`);
+    }
+
+    const { token } = await response.json();
+    const params = new URLSearchParams({ token });
+    if (preview) params.append('preview', 'true');
+    return `${AI_API_URL}/api/jobs/${jobId}/events?${params}`;
+  }
+
+  async refineDraft(jobId: string, request: RefineRequest = {}): Promise<BatchGenerationResponse> {
+    try {
+      const response = await fetch(`${AI_API_URL}/api/jobs/${jobId}/refine`, {
+        method: 'POST',
+        headers: this.headers,
+        body: JSON.stringify(request),
+      });
+
+      if (!response.ok) {
+        throw new Error(`API error: ${response.status}`);
+      }
+
+      return await response.json();
+    } catch (error) {
+      console.error('Refine draft error:', error);
+      throw error;
+    }
+  }
+
   async batchGenerate(
     characterId: string,
     count: number,
@@ -135,31 +293,44 @@ class AIGenerationAPI {
   ): Promise<GenerationJob[]> {
     const jobs: GenerationJob[] = [];
     const { focus = 'mixed', includeNude = false } = options;
+    let waitedMs = 0;
 
     // Calculate distribution
     const assCount = focus === 'ass' ? count : focus === 'mixed' ? Math.floor(count / 2) : 0;
     const titsCount = focus === 'tits' ? count : focus === 'mixed' ? Math.ceil(count / 2) : 0;
 
-    // Generate ass-focused images
-    for (let i = 0; i < assCount; i++) {
-      const job = await this.generateImage({
-        character_id: characterId,
-        focus: 'ass',
-        is_nude: includeNude && i % 4 === 0, // 25% nude if enabled
-        batch_size: 1,
-      });
-      jobs.push(job);
-    }
-
-    // Generate tits-focused images
-    for (let i = 0; i < titsCount; i++) {
-      const job = await this.generateImage({
-        character_id: characterId,
-        focus: 'tits',
-        is_nude: includeNude && i % 4 === 0, // 25% nude if enabled
-        batch_size: 1,
-      });
-      jobs.push(job);
+    // One batch request per focus/nudity group; 25% nude if enabled
+    for (const [groupFocus, groupCount] of [['ass', assCount], ['tits', titsCount]] as const) {
+      const nudeCount = includeNude ? Math.ceil(groupCount / 4) : 0;
+      for (const [isNude, jobCount] of [[false, groupCount - nudeCount], [true, nudeCount]] as const) {
+        if (jobCount === 0) continue;
+        let batch: BatchGenerationResponse;
+        for (;;) {
+          try {
+            batch = await this.generateBatch({
+              character_ids: [characterId],
+              focus: [groupFocus],
+              is_nude: [isNude],
+              count: jobCount,
+              batch_size: 1,
+            });
+            break;
+          } catch (error) {
+            const delayMs = error instanceof AIGenerationAPIError && error.status === 429 && error.retryAfterSeconds
+              ? error.retryAfterSeconds * 1000
+              : undefined;
+            if (delayMs !== undefined && waitedMs + delayMs <= MAX_RETRY_WAIT_MS) {
+              waitedMs += delayMs;
+              await new Promise(resolve => setTimeout(resolve, delayMs));
+              continue;
+            }
+            // Earlier batches are already queued; hand them back so they can be tracked or cancelled
+            if (jobs.length > 0) throw new PartialBatchError(jobs, error);
+            throw error;
+          }
+        }
+        jobs.push(...batch.job_ids.map(job_id => ({ job_id, status: batch.status, message: batch.message })));
+      }
     }
 
     return jobs;